@@ -2,61 +2,347 @@
 # Author: Tymoteusz Maj 
 # GitHub: https://github.com/Xeraoo
 
+import time
+
+# Startup phases and when they ended, reported by --startup-time
+startup_marks = [('start', time.perf_counter())]
+
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QAction, QFileDialog, QLabel, QVBoxLayout,
     QWidget, QComboBox, QPushButton, QHBoxLayout, QTabWidget, QTextEdit,
     QLineEdit, QMessageBox, QListWidget, QListWidgetItem, QPlainTextEdit,
-    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QSlider
+    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QSlider, QDateEdit, QSpinBox, QActionGroup,
+    QProgressBar, QTableWidget, QTableWidgetItem, QCheckBox, QHeaderView
 )
 from PyQt5.QtGui import QPixmap, QColor, QPalette, QImage, QTransform, QPainter
-from PyQt5.QtCore import Qt, QSettings, pyqtSignal, QThread
-import rasterio
+from PyQt5.QtCore import Qt, QSettings, pyqtSignal, QThread, QObject, QRunnable, QThreadPool, QDate, QTimer
+from rasterio.windows import Window
 import numpy as np
+from collections import OrderedDict, deque
+import threading
 from datetime import date, timedelta
-from sentinelsat import SentinelAPI
-import ee
 import sys
-from matplotlib.colors import LinearSegmentedColormap
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
-from datetime import date
 
 # Import additional libraries
-import requests
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import shape
 import os
 
-# Initialize Google Earth Engine
-try:
-    ee.Initialize()
-except ee.EEException:
-    pass
+from raster_analysis.tiles import TiledBand, RasterStack, RasterPyramid, RESAMPLING_METHODS, finestGrid
+from raster_analysis.stretch import (
+    STRETCH_SAMPLE_SIZE, fileMtime, stretch_cache, lut_cache
+)
+from raster_analysis.bandmath import INDICES, ParallelBandMath
+from raster_analysis.safe import SafeProduct, CHANNEL_BANDS
+from raster_analysis.stats import stats_cache
+from raster_analysis.render import render_graph, bandSource, ndviSource
+from raster_analysis.scratch import scratch_arrays
+from raster_analysis.export import CogOptions, COG_COMPRESSION, COG_COMPRESSIONS, exportBands
+from raster_analysis.profiling import profiler
+from raster_analysis.diskcache import cacheKey, disk_cache, sourceFingerprint
+
+startup_marks.append(('imports', time.perf_counter()))
 
 # Global variables for Copernicus credentials
 copernicus_user = os.getenv("copernicus_user")  # Copernicus User
 copernicus_password = os.getenv("copernicus_password")  # Copernicus Password
 
-# Initialize Google Earth Engine
-try:
-    ee.Initialize()
-except ee.EEException:
+# Optional dependencies loaded on first use of their feature, never before the window shows
+DEFERRED_MODULES = ['ee', 'sentinelsat', 'requests', 'shapely', 'matplotlib', 'pandas', 'geopandas']
+
+# Earth Engine, imported and initialized by the first login or script run: ee.Initialize
+# makes network round-trips that must not delay startup
+earth_engine = None
+earth_engine_lock = threading.Lock()
+
+def initializeEarthEngine():
+    # The initialized ee module and the seconds its import and initialization took now
+    global earth_engine
+    with earth_engine_lock:
+        if earth_engine is not None:
+            return earth_engine, 0.0
+        started = time.perf_counter()
+        import ee
+        ee.Initialize()
+        earth_engine = ee
+        return ee, time.perf_counter() - started
+
+def reportStartup():
+    # Time of each startup phase, and the deferred dependencies that were loaded anyway
+    lines = []
+    for (_, previous), (phase, mark) in zip(startup_marks, startup_marks[1:]):
+        lines.append(f"{phase:<12} {1000 * (mark - previous):8.1f} ms")
+    lines.append(f"{'total':<12} {1000 * (startup_marks[-1][1] - startup_marks[0][1]):8.1f} ms")
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+    lines.append(f"deferred modules loaded at startup: {', '.join(loaded) or 'none'}")
+    print("\n".join(lines))
+
+# Edge of a display tile in pixels of its pyramid level
+TILE_SIZE = 256
+
+# Rendered tiles kept for reuse when panning back or switching between layers
+TILE_CACHE_SIZE = 512
+
+# Idle frame buffers kept for reuse by tile workers
+FRAME_POOL_SIZE = 64
+
+# Quiet time after the last zoom slider move before the view is redrawn
+ZOOM_COALESCE_MS = 40
+
+# How often the Performance tab refreshes while it is shown
+PROFILE_REFRESH_MS = 1000
+
+# Size caps offered for the disk cache of rendered planes and computed indices, in GB
+DISK_CACHE_SIZES_GB = [1, 2, 5, 10, 20]
+
+# Earth Engine scripts running at once, and scripts allowed to wait for a free slot
+GEE_MAX_RUNNING = 2
+GEE_QUEUE_SIZE = 4
+
+# Channels of the Raster Display tab, in the order the files are opened
+CHANNEL_NAMES = {'red': 0, 'green': 1, 'blue': 2, 'nir': 3, 'rededge': 4}
+
+# Band of a multi-band stack shown on each channel until the band selectors say otherwise:
+# Sentinel-2 band order (B01, B02, ...) for full stacks, R, G, B, NIR for short ones
+STACK_DEFAULT_BANDS = {'red': 4, 'green': 3, 'blue': 2, 'nir': 8, 'rededge': 5}
+SHORT_STACK_DEFAULT_BANDS = {'red': 1, 'green': 2, 'blue': 3, 'nir': 4}
+
+# Loaded channels shown as red, green and blue by each composite
+COMPOSITES = {
+    'RGB': ('red', 'green', 'blue'),
+    'NIR': ('nir', 'red', 'green'),
+    'Red Edge': ('nir', 'rededge', 'red'),
+}
+
+# Legend colormap of each composite
+COMPOSITE_COLORMAPS = {'RGB': 'RGB', 'NIR': 'CIR', 'Red Edge': 'Red Edge'}
+
+# Band selector driving each channel of a multi-band stack
+SELECTOR_CHANNELS = {'Red': 'red', 'Green': 'green', 'Blue': 'blue', 'NIR': 'nir'}
+
+class TileCache:
+    # Bounded LRU of rendered tile pixmaps keyed by (layer, level, tile x, tile y);
+    # only touched from the GUI thread
+    def __init__(self, max_tiles=TILE_CACHE_SIZE):
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+
+    def get(self, key):
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        self._tiles[key] = pixmap
+        self._tiles.move_to_end(key)
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+
+    def invalidate(self, band_key):
+        # Drops the tiles of every layer computed from the band
+        for key in [k for k in self._tiles if render_graph.dependsOn(k[0], band_key)]:
+            del self._tiles[key]
+
+    def clear(self):
+        self._tiles.clear()
+
+class FrameBuffer:
+    # Pooled 32-bit-per-pixel frame that tiles are rendered into and handed to Qt without
+    # copying. Rows are 4 * width bytes, so every scanline is 32-bit aligned as QImage
+    # requires. The QImage only views the pixels: it is valid until release() returns the
+    # buffer to its pool, which happens once the GUI thread has uploaded it to a pixmap.
+    def __init__(self, pool, max_pixels):
+        self.pool = pool
+        self._pixels = np.full(max_pixels * 4, 255, dtype=np.uint8)
+        self.height = 0
+        self.width = 0
+        self.image = None
+
+    def resize(self, height, width):
+        self.height = height
+        self.width = width
+        self.image = None
+
+    @property
+    def pixels(self):
+        # Interleaved (height, width, 4) view: R, G, B, X/A
+        return self._pixels[:self.height * self.width * 4].reshape(self.height, self.width, 4)
+
+    @property
+    def packed(self):
+        # Same pixels as one uint32 per pixel, for colormap gathers
+        return self.pixels.view(np.uint32)[:, :, 0]
+
+    def setChannel(self, channel, plane):
+        # Interleaves a stretched uint8 plane into one byte of every pixel
+        self.pixels[:, :, channel] = plane
+
+    def publish(self, image_format=QImage.Format_RGBX8888):
+        self.image = QImage(self._pixels.data, self.width, self.height, 4 * self.width, image_format)
+        return self
+
+    def release(self):
+        self.image = None
+        self.pool.release(self)
+
+class FrameBufferPool:
+    def __init__(self, max_height=TILE_SIZE, max_width=TILE_SIZE, max_free=FRAME_POOL_SIZE):
+        self.max_pixels = max_height * max_width
+        self.max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, height, width):
+        with self._lock:
+            frame = self._free.pop() if self._free else None
+        if frame is None or height * width > self.max_pixels:
+            frame = FrameBuffer(self, max(self.max_pixels, height * width))
+        frame.resize(height, width)
+        # Composites never write alpha, and a recycled frame may hold the transparent
+        # pixels of a colormapped layer
+        frame.pixels[:, :, 3] = 255
+        return frame
+
+    def release(self, frame):
+        with self._lock:
+            if len(self._free) < self.max_free and frame._pixels.size == self.max_pixels * 4:
+                self._free.append(frame)
+
+frame_pool = FrameBufferPool()
+
+class TileSignals(QObject):
+    tileReady = pyqtSignal(object, object)  # tile key, published FrameBuffer or None
+    tileFailed = pyqtSignal(object, str)  # tile key, error message
+
+class TileWorker(QRunnable):
+    # Renders one tile off the GUI thread; skipped if the tile scrolled away while queued
+    def __init__(self, key, renderer, level, window, signals, isWanted):
+        super().__init__()
+        self.key = key
+        self.renderer = renderer
+        self.level = level
+        self.window = window
+        self.signals = signals
+        self.isWanted = isWanted
+
+    def run(self):
+        frame = None
+        try:
+            if self.isWanted(self.key):
+                with profiler.span('render'):
+                    frame = self.renderer(self.level, self.window)
+        except Exception as e:
+            self.signals.tileFailed.emit(self.key, str(e))
+        self.signals.tileReady.emit(self.key, frame)
+
+
+class TaskCancelled(Exception):
     pass
 
+class TaskSignals(QObject):
+    progress = pyqtSignal(int, int)  # blocks done, blocks in total
+    finished = pyqtSignal(object)    # the task function's result
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+class Task(QRunnable):
+    # One heavy raster operation on the task pool. The function is given checkpoint, to be
+    # passed on as the operation's per-block progress callback: it reports progress and,
+    # once cancel() has been called, raises TaskCancelled so the operation stops at its
+    # next block instead of running to the end.
+    def __init__(self, function):
+        super().__init__()
+        self.function = function
+        self.signals = TaskSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def checkpoint(self, done, total):
+        if self._cancelled.is_set():
+            raise TaskCancelled()
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            result = self.function(self.checkpoint)
+        except TaskCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+def stageProgress(checkpoint, stage, stages):
+    # Progress of one of several equal stages, reported as progress of the whole
+    return lambda done, total: checkpoint(stage * total + done, stages * total)
+
+@profiler.timed('load')
+def openInputs(file_paths, checkpoint):
+    # Opens the bands of the chosen files on the task pool, without touching any widget:
+    # a Sentinel-2 product .zip, a single multi-band stack, or one file per channel
+    inputs = {'bands': {}, 'stack': None, 'reflectance': (1.0, 0.0), 'scl': None, 'errors': []}
+    nodata = None  # Of band files that declare none: the black edges of Sentinel-2 JP2 tiles
+    try:
+        if len(file_paths) == 1 and file_paths[0].lower().endswith('.zip'):
+            # Bands stay inside the archive and are decoded block by block on demand
+            product = SafeProduct(file_paths[0])
+            paths = {channel: product.bandPath(CHANNEL_BANDS[name]) for name, channel in CHANNEL_NAMES.items()}
+            inputs['reflectance'] = product.reflectance(CHANNEL_BANDS['red'])
+            inputs['scl'] = product.classificationPath()
+            nodata = product.nodata
+        else:
+            if len(file_paths) == 1:
+                stack = RasterStack(file_paths[0])
+                if stack.count > 1:
+                    inputs['stack'] = stack
+                    return inputs
+                stack.close()
+            paths = dict(enumerate(file_paths))
+
+        for done, (channel, path) in enumerate(paths.items()):
+            checkpoint(done, len(paths))
+            try:
+                inputs['bands'][channel] = TiledBand(path, 1, default_nodata=nodata)  # Wczytujemy tylko pierwszy kanał
+            except Exception as e:
+                inputs['errors'].append(f"Could not load raster file {path}: {e}")
+        checkpoint(len(paths), len(paths))
+    except BaseException:
+        closeInputs(inputs)
+        raise
+    return inputs
+
+def closeInputs(inputs):
+    for band in inputs['bands'].values():
+        band.close()
+    if inputs['stack'] is not None:
+        inputs['stack'].close()
+
 class GEEThread(QThread):
+    # Runs one Earth Engine script (see raster_analysis.earthengine.runScript). ee is the
+    # client module to run against; by default the real one, initialized on first use.
     finished = pyqtSignal()
     update_status = pyqtSignal(str)
+    image_ready = pyqtSignal(str)  # Path of an image the script downloaded
 
-    def __init__(self, script):
+    def __init__(self, script, directory=".", ee=None):
         super().__init__()
         self.script = script
+        self.directory = directory
+        self.ee = ee
 
     def run(self):
+        from raster_analysis.earthengine import runScript
+
         try:
+            ee = self.ee
+            if ee is None:
+                ee, seconds = initializeEarthEngine()
+                if seconds:
+                    self.update_status.emit(f"Google Earth Engine initialized in {seconds:.2f} s.")
             self.update_status.emit("Running script in Google Earth Engine...")
-            # Simulate long-running task
-            import time
-            time.sleep(2)
+            for path in runScript(self.script, ee, self.directory, self.update_status.emit):
+                self.image_ready.emit(path)
             self.update_status.emit("Script execution completed successfully.")
         except Exception as e:
             self.update_status.emit(f"Error executing script: {str(e)}")
@@ -66,79 +352,53 @@ class GEEThread(QThread):
 class CopernicusThread(QThread):
     finished = pyqtSignal()
     update_status = pyqtSignal(str)
+    products_found = pyqtSignal(list)
 
-    def __init__(self, ft):
+    def __init__(self, ft, username=None, password=None, directory=".", start=None, end=None, max_cloud=100.0):
         super().__init__()
         self.ft = ft
+        self.username = username or copernicus_user
+        self.password = password or copernicus_password
+        self.directory = directory
+        # Yesterday to today unless a date range is given
+        self.end = end or date.today()
+        self.start = start or self.end - timedelta(days=1)
+        self.max_cloud = max_cloud
 
     def run(self):
+        # requests and shapely are only loaded once a search starts
+        from raster_analysis.copernicus import CatalogueQuery, CatalogueSearch, DownloadManager
+
         try:
             self.update_status.emit("Fetching Sentinel-2 L2A products...")
-            today = date.today()
-            today_string = today.strftime("%Y-%m-%d")
-            yesterday = today - timedelta(days=1)
-            yesterday_string = yesterday.strftime("%Y-%m-%d")
-
-            # Function to get access token from Copernicus
-            def get_keycloak(username: str, password: str) -> str:
-                data = {
-                    "client_id": "cdse-public",
-                    "username": username,
-                    "password": password,
-                    "grant_type": "password",
-                }
+
+            # Fetch Sentinel-2 L2A products; filters run on the server and results are kept locally
+            query = CatalogueQuery(self.ft, self.start, self.end, "S2MSI2A", self.max_cloud)
+            search = CatalogueSearch(status=self.update_status.emit)
+            try:
+                products = search.search(query)
+            finally:
+                search.index.close()
+
+            if products:
+                print(f"Total Sentinel-2 L2A tiles found: {len(products)}")
+                self.products_found.emit(products)
+
+                # Download all available tiles in parallel
+                manager = DownloadManager(self.username, self.password, self.directory,
+                                          status=self.update_status.emit)
                 try:
-                    r = requests.post(
-                        "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
-                        data=data,
-                    )
-                    r.raise_for_status()
-                except Exception as e:
-                    raise Exception(
-                        f"Keycloak token creation failed. Response from the server was: {r.json()}"
-                    )
-                return r.json()["access_token"]
-
-            # Fetch Sentinel-2 L2A products
-            json_ = requests.get(
-                f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?"
-                f"$filter=Collection/Name eq 'SENTINEL-2' and "
-                f"OData.CSC.Intersects(area=geography'SRID=4326;{self.ft}') and "
-                f"ContentDate/Start gt {yesterday_string}T00:00:00.000Z and "
-                f"ContentDate/Start lt {today_string}T00:00:00.000Z&$count=True&$top=1000"
-            ).json()
-
-            # Process the JSON response
-            p = pd.DataFrame.from_dict(json_["value"])
-            if p.shape[0] > 0:
-                p["geometry"] = p["GeoFootprint"].apply(shape)
-                productDF = gpd.GeoDataFrame(p).set_geometry("geometry")
-                productDF = productDF[~productDF["Name"].str.contains("L1C")]
-                print(f"Total Sentinel-2 L2A tiles found: {len(productDF)}")
-
-                # Download all available tiles
-                for index, feat in enumerate(productDF.iterfeatures()):
-                    try:
-                        session = requests.Session()
-                        keycloak_token = get_keycloak(copernicus_user, copernicus_password)
-                        session.headers.update({"Authorization": f"Bearer {keycloak_token}"})
-                        url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({feat['properties']['Id']})/$value"
-                        response = session.get(url, allow_redirects=False)
-                        while response.status_code in (301, 302, 303, 307):
-                            url = response.headers["Location"]
-                            response = session.get(url, allow_redirects=False)
-                        print(f"Downloading {feat['properties']['Name']}...")
-                        file = session.get(url, verify=False, allow_redirects=True)
-
-                        with open(f"{feat['properties']['identifier']}.zip", "wb") as p:
-                            p.write(file.content)
-
-                    except Exception as e:
-                        print(f"Problem downloading {feat['properties']['Name']}: {e}")
-
-                self.update_status.emit("Sentinel-2 L2A products downloaded successfully.")
+                    results = manager.downloadAll(products)
+                finally:
+                    manager.close()
+
+                failed = [name for name, result in results.items() if isinstance(result, Exception)]
+                if failed:
+                    self.update_status.emit(f"{len(results) - len(failed)} of {len(results)} Sentinel-2 L2A products downloaded.")
+                else:
+                    self.update_status.emit("Sentinel-2 L2A products downloaded successfully.")
             else:
-                self.update_status.emit("No Sentinel-2 L2A products found for today.")
+                self.update_status.emit(f"No Sentinel-2 L2A products found from {self.start} to {self.end}.")
 
         except Exception as e:
             self.update_status.emit(f"Error: {str(e)}")
@@ -152,6 +412,20 @@ class RasterAnalysisApp(QMainWindow):
 
         self.settings = QSettings("Tymoteusz Maj", "RasterAnalysisApp")
         self.theme_selection = self.settings.value("theme_selection", "Dark")
+        self.export_compression = self.settings.value("export_compression", COG_COMPRESSION)
+        # Earth Engine script threads, and scripts waiting for one (at most GEE_QUEUE_SIZE)
+        self.geeRunning = []
+        self.geeWaiting = deque()
+        self.mask_clouds = self.settings.value("mask_clouds", True, type=bool)
+        scratch_directory = self.settings.value("scratch_directory", "")
+        if scratch_directory:
+            scratch_arrays.setDirectory(scratch_directory)
+        cache_directory = self.settings.value("disk_cache_directory", "")
+        if cache_directory:
+            disk_cache.setDirectory(cache_directory)
+        self.disk_cache_gb = self.settings.value("disk_cache_gb", disk_cache.max_bytes // 1024 ** 3, type=int)
+        disk_cache.max_bytes = self.disk_cache_gb * 1024 ** 3
+        render_graph.persist_planes = self.settings.value("disk_cache_tiles", False, type=bool)
 
         self.initUI()
 
@@ -161,11 +435,27 @@ class RasterAnalysisApp(QMainWindow):
             QMessageBox.warning(self, "Error", "Please enter a script.")
             return
 
-        self.thread = GEEThread(script_text)
-        self.thread.finished.connect(lambda: self.runScriptButton.setEnabled(True))
-        self.thread.update_status.connect(self.updateStatus)
-        self.runScriptButton.setEnabled(False)
-        self.thread.start()
+        if len(self.geeWaiting) >= GEE_QUEUE_SIZE:
+            QMessageBox.warning(self, "Error", f"{GEE_QUEUE_SIZE} scripts are already waiting to run.")
+            return
+        self.geeWaiting.append(script_text)
+        if len(self.geeRunning) >= GEE_MAX_RUNNING:
+            self.updateStatus(f"Script queued; {len(self.geeWaiting)} waiting.")
+        self.startWaitingScripts()
+
+    def startWaitingScripts(self):
+        while self.geeWaiting and len(self.geeRunning) < GEE_MAX_RUNNING:
+            thread = GEEThread(self.geeWaiting.popleft(), self.settings.value("gee_directory", "."))
+            thread.update_status.connect(self.updateStatus)
+            thread.image_ready.connect(lambda path: self.loadFiles([path]))
+            thread.finished.connect(lambda thread=thread: self.scriptFinished(thread))
+            self.geeRunning.append(thread)
+            thread.start()
+
+    def scriptFinished(self, thread):
+        thread.wait()
+        self.geeRunning.remove(thread)
+        self.startWaitingScripts()
 
     def updateStatus(self, status):
         self.scriptOutput.appendPlainText(status)
@@ -185,6 +475,44 @@ class RasterAnalysisApp(QMainWindow):
         saveAction.triggered.connect(self.saveFile)
         fileMenu.addAction(saveAction)
 
+        compressionMenu = fileMenu.addMenu('Export Compression')
+        compressionGroup = QActionGroup(self)
+        for compression in COG_COMPRESSIONS:
+            compressionAction = QAction(compression, self, checkable=True)
+            compressionAction.setChecked(compression == self.export_compression)
+            compressionAction.triggered.connect(lambda _, c=compression: self.changeExportCompression(c))
+            compressionGroup.addAction(compressionAction)
+            compressionMenu.addAction(compressionAction)
+
+        maskCloudsAction = QAction('Mask Clouds', self, checkable=True)
+        maskCloudsAction.setChecked(self.mask_clouds)
+        maskCloudsAction.toggled.connect(self.changeMaskClouds)
+        fileMenu.addAction(maskCloudsAction)
+
+        scratchAction = QAction('Scratch Directory...', self)
+        scratchAction.triggered.connect(self.chooseScratchDirectory)
+        fileMenu.addAction(scratchAction)
+
+        # NDVI stretches and exported indices are kept across sessions, stretched tiles on request
+        cacheMenu = fileMenu.addMenu('Disk Cache')
+        cacheDirectoryAction = QAction('Directory...', self)
+        cacheDirectoryAction.triggered.connect(self.chooseCacheDirectory)
+        cacheMenu.addAction(cacheDirectoryAction)
+        cacheTilesAction = QAction('Cache Display Tiles', self, checkable=True)
+        cacheTilesAction.setChecked(render_graph.persist_planes)
+        cacheTilesAction.toggled.connect(self.changeCacheTiles)
+        cacheMenu.addAction(cacheTilesAction)
+        cacheSizeGroup = QActionGroup(self)
+        for size_gb in DISK_CACHE_SIZES_GB:
+            cacheSizeAction = QAction(f"{size_gb} GB", self, checkable=True)
+            cacheSizeAction.setChecked(size_gb == self.disk_cache_gb)
+            cacheSizeAction.triggered.connect(lambda _, size=size_gb: self.changeCacheSize(size))
+            cacheSizeGroup.addAction(cacheSizeAction)
+            cacheMenu.addAction(cacheSizeAction)
+        clearCacheAction = QAction('Clear', self)
+        clearCacheAction.triggered.connect(self.clearDiskCache)
+        cacheMenu.addAction(clearCacheAction)
+
         themeMenu = menubar.addMenu('Theme')
 
         darkThemeAction = QAction('Dark', self)
@@ -216,6 +544,11 @@ class RasterAnalysisApp(QMainWindow):
         self.graphicsView.setRenderHint(QPainter.SmoothPixmapTransform)
         self.rasterLayout.addWidget(self.graphicsView)
 
+        self.legendLabel = QLabel()
+        self.legendLabel.setFixedHeight(20)
+        self.legendLabel.setScaledContents(True)
+        self.rasterLayout.addWidget(self.legendLabel)
+
         self.optionsLayout = QHBoxLayout()
         self.rasterLayout.addLayout(self.optionsLayout)
 
@@ -233,18 +566,38 @@ class RasterAnalysisApp(QMainWindow):
             self.optionsLayout.addWidget(label)
             comboBox = QComboBox()
             comboBox.addItems([str(i) for i in range(1, 13)])
+            comboBox.currentIndexChanged.connect(self.changeStackBands)
             self.bandSelectors[color] = comboBox
             self.optionsLayout.addWidget(comboBox)
 
+        self.resamplingLabel = QLabel("Resampling:")
+        self.optionsLayout.addWidget(self.resamplingLabel)
+
+        self.resamplingComboBox = QComboBox()
+        self.resamplingComboBox.addItems(RESAMPLING_METHODS)
+        self.resamplingComboBox.currentIndexChanged.connect(self.changeResampling)
+        self.optionsLayout.addWidget(self.resamplingComboBox)
+
         self.ndviButton = QPushButton("Calculate NDVI")
         self.ndviButton.clicked.connect(self.calculateNDVI)
         self.optionsLayout.addWidget(self.ndviButton)
 
+        self.indexComboBox = QComboBox()
+        self.indexComboBox.addItems(list(INDICES))
+        self.optionsLayout.addWidget(self.indexComboBox)
+
+        self.exportIndexButton = QPushButton("Export Index")
+        self.exportIndexButton.clicked.connect(self.exportIndex)
+        self.optionsLayout.addWidget(self.exportIndexButton)
+
+        self.statsButton = QPushButton("Statistics")
+        self.statsButton.clicked.connect(self.calculateBasicStats)
+        self.optionsLayout.addWidget(self.statsButton)
+
         self.zoomSlider = QSlider(Qt.Horizontal)
         self.zoomSlider.setMinimum(1)
         self.zoomSlider.setMaximum(100)
         self.zoomSlider.setValue(50)
-        self.zoomSlider.valueChanged.connect(self.zoomImage)
         self.rasterLayout.addWidget(self.zoomSlider)
 
         self.geeTab = QWidget()
@@ -265,6 +618,15 @@ class RasterAnalysisApp(QMainWindow):
         self.tabs.addTab(self.scriptingTab, "Scripting Google Earth Engine")
 
         self.scriptEditor = QTextEdit()
+        self.scriptEditor.setAcceptRichText(False)
+        self.scriptEditor.setPlaceholderText(
+            "# Python with ee, regionStats(image, geometry, scale), runTask(task) and\n"
+            "# download(image, name, (west, south, east, north), scale); downloads open in the raster view\n"
+            "image = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED').filterDate('2024-06-01', '2024-07-01').median()\n"
+            "ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI')\n"
+            "area = ee.Geometry.Rectangle([10.29, 45.94, 10.85, 46.34])\n"
+            "print(regionStats(ndvi, area, 100))\n"
+            "download(ndvi, 'ndvi', (10.29, 45.94, 10.85, 46.34), 0.0001)")
         self.scriptingLayout.addWidget(self.scriptEditor)
 
         self.runScriptButton = QPushButton("Run Script")
@@ -293,6 +655,28 @@ class RasterAnalysisApp(QMainWindow):
         self.passwordInput.setEchoMode(QLineEdit.Password)
         self.acquisitionLayout.addWidget(self.passwordInput)
 
+        self.startDateLabel = QLabel("Start Date:")
+        self.acquisitionLayout.addWidget(self.startDateLabel)
+
+        self.startDateInput = QDateEdit(QDate.currentDate().addDays(-1))
+        self.startDateInput.setCalendarPopup(True)
+        self.acquisitionLayout.addWidget(self.startDateInput)
+
+        self.endDateLabel = QLabel("End Date:")
+        self.acquisitionLayout.addWidget(self.endDateLabel)
+
+        self.endDateInput = QDateEdit(QDate.currentDate())
+        self.endDateInput.setCalendarPopup(True)
+        self.acquisitionLayout.addWidget(self.endDateInput)
+
+        self.cloudLabel = QLabel("Max Cloud Cover (%):")
+        self.acquisitionLayout.addWidget(self.cloudLabel)
+
+        self.cloudInput = QSpinBox()
+        self.cloudInput.setRange(0, 100)
+        self.cloudInput.setValue(100)
+        self.acquisitionLayout.addWidget(self.cloudInput)
+
         self.downloadButton = QPushButton("Download Sentinel Image")
         self.downloadButton.clicked.connect(self.downloadSentinelImage)
         self.acquisitionLayout.addWidget(self.downloadButton)
@@ -301,11 +685,88 @@ class RasterAnalysisApp(QMainWindow):
         self.productsListWidget.itemDoubleClicked.connect(self.downloadSelectedProduct)
         self.acquisitionLayout.addWidget(self.productsListWidget)
 
+        # Timing and peak memory of loading, stretching, colormapping, rendering and downloads
+        self.performanceTab = QWidget()
+        self.performanceLayout = QVBoxLayout()
+        self.performanceTab.setLayout(self.performanceLayout)
+        self.tabs.addTab(self.performanceTab, "Performance")
+
+        self.profileTable = QTableWidget(0, 6)
+        self.profileTable.setHorizontalHeaderLabels(["Span", "Calls", "Total (ms)", "Mean (ms)", "Max (ms)", "Peak (MB)"])
+        self.profileTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.profileTable.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.performanceLayout.addWidget(self.profileTable)
+
+        profileButtons = QHBoxLayout()
+        self.trackMemoryCheckBox = QCheckBox("Track peak memory (slower)")
+        self.trackMemoryCheckBox.setChecked(profiler.tracking_memory)
+        self.trackMemoryCheckBox.toggled.connect(profiler.trackMemory)
+        profileButtons.addWidget(self.trackMemoryCheckBox)
+        resetProfileButton = QPushButton("Reset")
+        resetProfileButton.clicked.connect(self.resetProfile)
+        profileButtons.addWidget(resetProfileButton)
+        exportProfileButton = QPushButton("Export JSON...")
+        exportProfileButton.clicked.connect(self.exportProfile)
+        profileButtons.addWidget(exportProfileButton)
+        self.performanceLayout.addLayout(profileButtons)
+
+        self.profileTimer = QTimer(self)
+        self.profileTimer.setInterval(PROFILE_REFRESH_MS)
+        self.profileTimer.timeout.connect(self.showProfile)
+        self.tabs.currentChanged.connect(self.changeTab)
+
         self.applyTheme()
 
         self.rasterData = {}
         self.rasterProfiles = {}
-        self.pixmapItem = None
+        self.rasterPyramids = {}
+        # (scale, offset) turning loaded pixel values into reflectance
+        self.rasterReflectance = (1.0, 0.0)
+        # Multi-band file whose bands the band selectors pick, if one is loaded
+        self.rasterStack = None
+        # Scene classification of a loaded L2A product, and its pyramid on the display grid
+        self.rasterClassification = None
+        self.classificationPyramid = None
+
+        # Layer currently shown: pyramid giving the scene geometry, a thread-safe
+        # (level, window) -> QImage renderer and a key identifying its band combo and stretch
+        self.displayPyramid = None
+        self.displayRenderer = None
+        self.displayKey = None
+        self.fitScale = 1.0
+
+        self.tilePool = QThreadPool()
+        self.tileSignals = TileSignals()
+        self.tileSignals.tileReady.connect(self.onTileReady)
+        self.tileSignals.tileFailed.connect(self.onTileFailed)
+        self.tileCache = TileCache()
+        self.tileItems = {}
+        self.wantedTiles = set()
+        self.pendingTiles = set()
+        # Scroll and zoom events arriving in a burst are coalesced into one redraw
+        self.renderTimer = QTimer(self)
+        self.renderTimer.setSingleShot(True)
+        self.renderTimer.timeout.connect(self.renderView)
+        self.graphicsView.horizontalScrollBar().valueChanged.connect(self.renderTimer.start)
+        self.graphicsView.verticalScrollBar().valueChanged.connect(self.renderTimer.start)
+        self.zoomTimer = QTimer(self)
+        self.zoomTimer.setSingleShot(True)
+        self.zoomTimer.setInterval(ZOOM_COALESCE_MS)
+        self.zoomTimer.timeout.connect(self.zoomImage)
+        self.zoomSlider.valueChanged.connect(self.zoomTimer.start)
+
+        # Loading, stretch statistics, NDVI and exports run as tasks, one per name at a
+        # time: starting a task cancels the previous one of the same name
+        self.taskPool = QThreadPool()
+        self.tasks = {}
+        self.taskProgress = QProgressBar()
+        self.taskProgress.setMaximumWidth(300)
+        self.taskProgress.hide()
+        self.cancelTasksButton = QPushButton("Cancel")
+        self.cancelTasksButton.clicked.connect(self.cancelTasks)
+        self.cancelTasksButton.hide()
+        self.statusBar().addPermanentWidget(self.taskProgress)
+        self.statusBar().addPermanentWidget(self.cancelTasksButton)
 
         self.show()
 
@@ -360,27 +821,362 @@ class RasterAnalysisApp(QMainWindow):
         self.applyTheme()
         self.settings.setValue("theme_selection", self.theme_selection)
 
+    def changeExportCompression(self, compression):
+        self.export_compression = compression
+        self.settings.setValue("export_compression", compression)
+
+    def changeMaskClouds(self, mask_clouds):
+        self.mask_clouds = mask_clouds
+        self.settings.setValue("mask_clouds", mask_clouds)
+        self.updateRasterDisplay()
+
+    def sclSource(self):
+        # Scene classification masking statistics, stretches and indices, when enabled and loaded
+        if not self.mask_clouds or self.rasterClassification is None:
+            return None
+        return (self.rasterClassification, 1)
+
+    def classificationLevels(self, grid):
+        # Pyramid of the scene classification on a band grid, resampled by nearest neighbour
+        # since its values are classes
+        scl_source = self.sclSource()
+        if scl_source is None:
+            return None
+        pyramid = self.classificationPyramid
+        if pyramid is None or pyramid.band.file_path != scl_source[0] or pyramid.band.grid != grid:
+            if pyramid is not None:
+                pyramid.band.close()
+            pyramid = RasterPyramid(TiledBand(scl_source[0], 1, grid=grid, resampling='nearest'))
+            self.classificationPyramid = pyramid
+        return pyramid
+
+    def chooseScratchDirectory(self):
+        # Large intermediates (cached pyramid levels, ...) are memory-mapped from here
+        directory = QFileDialog.getExistingDirectory(self, "Scratch Directory", scratch_arrays.directory or "")
+        if directory:
+            scratch_arrays.setDirectory(directory)
+            self.settings.setValue("scratch_directory", directory)
+
+    def chooseCacheDirectory(self):
+        directory = QFileDialog.getExistingDirectory(self, "Disk Cache Directory", disk_cache.directory or "")
+        if directory:
+            disk_cache.setDirectory(directory)
+            self.settings.setValue("disk_cache_directory", directory)
+
+    def changeCacheTiles(self, cache_tiles):
+        render_graph.persist_planes = cache_tiles
+        self.settings.setValue("disk_cache_tiles", cache_tiles)
+
+    def changeCacheSize(self, size_gb):
+        # Eviction down to a smaller cap runs on the task pool, off the GUI thread
+        self.disk_cache_gb = size_gb
+        self.settings.setValue("disk_cache_gb", size_gb)
+        self.startTask('cache', lambda _: disk_cache.setMaxBytes(size_gb * 1024 ** 3), lambda _: None,
+                       "Trimming cache")
+
+    def clearDiskCache(self):
+        entries, nbytes = disk_cache.usage()
+        self.startTask('cache', lambda _: disk_cache.clear(), lambda _: self.statusBar().showMessage(
+            f"Removed {entries} cached entries ({nbytes / 1024 ** 2:.0f} MB)", 5000), "Clearing cache")
+
+    def startTask(self, name, function, done, label, discard=None):
+        # Runs function(checkpoint) on the task pool and hands its result to done on the GUI
+        # thread. A result that arrives after a newer task of the same name was started is
+        # stale: it goes to discard, if given, instead.
+        previous = self.tasks.get(name)
+        if previous is not None:
+            previous.cancel()
+        task = Task(function)
+        self.tasks[name] = task
+
+        def current():
+            return self.tasks.get(name) is task
+
+        def finish():
+            if current():
+                del self.tasks[name]
+            self.updateTaskProgress()
+
+        def finished(result):
+            if current():
+                finish()
+                done(result)
+            else:
+                finish()
+                if discard is not None:
+                    discard(result)
+
+        def failed(message):
+            stale = not current()
+            finish()
+            if not stale:
+                QMessageBox.critical(self, "Error", f"{label} failed: {message}")
+
+        task.signals.progress.connect(lambda n, total: self.showTaskProgress(task, label, n, total))
+        task.signals.finished.connect(finished)
+        task.signals.failed.connect(failed)
+        task.signals.cancelled.connect(finish)
+        self.taskPool.start(task)
+
+    def showTaskProgress(self, task, label, done, total):
+        if task not in self.tasks.values():
+            return
+        self.taskProgress.setFormat(f"{label}: %p%")
+        self.taskProgress.setRange(0, max(total, 1))
+        self.taskProgress.setValue(done)
+        self.taskProgress.show()
+        self.cancelTasksButton.show()
+
+    def updateTaskProgress(self):
+        if not self.tasks:
+            self.taskProgress.hide()
+            self.cancelTasksButton.hide()
+
+    def cancelTasks(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    def changeTab(self, index):
+        # The Performance tab is only refreshed while it is shown
+        if self.tabs.widget(index) is self.performanceTab:
+            self.showProfile()
+            self.profileTimer.start()
+        else:
+            self.profileTimer.stop()
+
+    def showProfile(self):
+        spans = profiler.snapshot()
+        self.profileTable.setRowCount(len(spans))
+        for row, (name, stats) in enumerate(spans.items()):
+            values = [name, str(stats['count']), f"{1000 * stats['total_s']:.1f}", f"{1000 * stats['mean_s']:.2f}",
+                      f"{1000 * stats['max_s']:.1f}",
+                      f"{stats['peak_bytes'] / (1024 * 1024):.1f}" if profiler.tracking_memory else "-"]
+            for column, value in enumerate(values):
+                self.profileTable.setItem(row, column, QTableWidgetItem(value))
+
+    def resetProfile(self):
+        profiler.reset()
+        self.showProfile()
+
+    def exportProfile(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Profile", "profile.json", "JSON files (*.json)")
+        if file_path:
+            try:
+                profiler.exportJson(file_path)
+            except OSError as e:
+                QMessageBox.critical(self, "Error", f"Could not write {file_path}: {e}")
+
     def openFiles(self):
         file_dialog = QFileDialog()
-        file_paths, _ = file_dialog.getOpenFileNames(self, "Open Files", "", "GeoTIFF files (*.tif *.tiff)")
+        file_paths, _ = file_dialog.getOpenFileNames(self, "Open Files", "",
+                                                      "GeoTIFF files (*.tif *.tiff);;Sentinel-2 products (*.zip)")
         if file_paths:
             self.loadFiles(file_paths)
 
     def loadFiles(self, file_paths):
+        # Datasets are opened on the task pool; the GUI thread only installs the result
+        self.startTask('load', lambda checkpoint: openInputs(file_paths, checkpoint), self.installInputs,
+                       "Loading", discard=closeInputs)
+
+    def installInputs(self, inputs):
+        # Nothing may render from the old bands once they are closed
+        self.clearDisplay()
+        for band in set(self.rasterData.values()):
+            self.releaseBand(band)
         self.rasterData.clear()
-        for i, file_path in enumerate(file_paths):
-            self.loadRaster(file_path, i)
+        self.rasterProfiles.clear()
+        self.rasterPyramids.clear()
+        self.rasterReflectance = inputs['reflectance']
+        self.rasterStack = None
+        if self.classificationPyramid is not None:
+            self.classificationPyramid.band.close()
+            self.classificationPyramid = None
+        self.rasterClassification = inputs['scl']
+        if inputs['stack'] is not None:
+            self.installStack(inputs['stack'])
+        for channel, band in inputs['bands'].items():
+            self.rasterData[channel] = band
+            self.rasterProfiles[channel] = band.profile
+            self.rasterPyramids[channel] = RasterPyramid(band)
+        for error in inputs['errors']:
+            QMessageBox.critical(self, "Error", error)
+        self.alignLoadedBands()
         self.updateRasterDisplay()
 
-    def loadRaster(self, file_path, channel_index):
-        try:
-            with rasterio.open(file_path) as src:
-                data = src.read(1)  # Wczytujemy tylko pierwszy kanał
-                self.rasterData[channel_index] = data
-                self.rasterProfiles[channel_index] = src.profile
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Could not load raster file {file_path}: {e}")
+    def installStack(self, stack):
+        # A single multi-band file: every channel comes from its bands, through one dataset
+        # handle and one read per block for all channels
+        defaults = STACK_DEFAULT_BANDS if stack.count >= max(STACK_DEFAULT_BANDS.values()) else SHORT_STACK_DEFAULT_BANDS
+        for color, comboBox in self.bandSelectors.items():
+            comboBox.blockSignals(True)
+            comboBox.clear()
+            comboBox.addItems([str(i) for i in range(1, stack.count + 1)])
+            comboBox.setCurrentIndex(min(defaults[SELECTOR_CHANNELS[color]], stack.count) - 1)
+            comboBox.blockSignals(False)
+
+        self.rasterStack = stack
+        band_indexes = {name: min(band_index, stack.count) for name, band_index in defaults.items()}
+        band_indexes.update({SELECTOR_CHANNELS[color]: int(comboBox.currentText())
+                             for color, comboBox in self.bandSelectors.items()})
+        self.mapStackBands(band_indexes)
+
+    def mapStackBands(self, band_indexes):
+        # band_indexes maps channel names to bands of the loaded stack
+        previous = set(self.rasterData.values())
+        for name, band_index in band_indexes.items():
+            band = self.rasterStack.band(band_index)
+            channel = CHANNEL_NAMES[name]
+            if self.rasterData.get(channel) is not band:
+                self.rasterData[channel] = band
+                self.rasterProfiles[channel] = band.profile
+                self.rasterPyramids[channel] = RasterPyramid(band)
+        # Bands no channel shows any more; the stack stays open while any band is in use
+        for band in previous - set(self.rasterData.values()):
+            band.close()
+
+    def changeStackBands(self):
+        if self.rasterStack is None:
+            return
+        self.mapStackBands({SELECTOR_CHANNELS[color]: int(comboBox.currentText())
+                            for color, comboBox in self.bandSelectors.items()})
+        self.updateRasterDisplay()
+
+    def releaseBand(self, band):
+        # Closes a band being unloaded and drops what was rendered from it, since the file
+        # may be rewritten before it is opened again. Bands swapped out by the band
+        # selectors keep their planes, ready for when they are selected again.
+        render_graph.invalidateBand(band.key)
+        self.tileCache.invalidate(band.key)
+        band.close()
+
+    def alignLoadedBands(self):
+        # Bands of coarser resolution (20 m red edge next to 10 m visible bands, say) are
+        # warped on the fly onto the finest loaded grid, so composites and indices line up
+        if not self.rasterData:
+            return
+        grid = finestGrid(self.rasterData.values())
+        resampling = self.resamplingComboBox.currentText()
+        for channel, band in list(self.rasterData.items()):
+            aligned = band.realigned(grid, resampling)
+            if aligned is not band:
+                band.close()
+                self.rasterData[channel] = aligned
+                self.rasterProfiles[channel] = aligned.profile
+                self.rasterPyramids[channel] = RasterPyramid(aligned)
+
+    def changeResampling(self):
+        if any(band.aligned for band in self.rasterData.values()):
+            self.alignLoadedBands()
+            self.updateRasterDisplay()
+
+    def showLayer(self, pyramid, renderer, key):
+        # Scene coordinates are full-resolution pixels of the layer
+        refit = self.displayPyramid is None or self.displayPyramid.shape != pyramid.shape
+        self.displayPyramid = pyramid
+        self.displayRenderer = renderer
+        self.displayKey = key
+
+        if refit:
+            height, width = pyramid.shape
+            self.graphicsScene.setSceneRect(0, 0, width, height)
+            with profiler.span('fitInView'):
+                self.graphicsView.fitInView(self.graphicsScene.sceneRect(), Qt.KeepAspectRatio)
+            self.fitScale = self.graphicsView.transform().m11()
+            self.zoomSlider.blockSignals(True)
+            self.zoomSlider.setValue(50)
+            self.zoomSlider.blockSignals(False)
+
+        self.renderView()
+
+    def clearDisplay(self):
+        # Forgets the layer on screen: queued tiles are dropped, tiles being rendered are
+        # waited for, and scrolling renders nothing until the next showLayer()
+        self.wantedTiles = set()
+        self.tilePool.clear()
+        self.tilePool.waitForDone()
+        self.pendingTiles.clear()
+        for item in self.tileItems.values():
+            self.graphicsScene.removeItem(item)
+        self.tileItems.clear()
+        self.displayPyramid = None
+        self.displayRenderer = None
+        self.displayKey = None
+
+    def renderView(self):
+        # Show the visible tiles of the coarsest pyramid level that stays sharp; missing
+        # tiles are rendered by the worker pool and added as they arrive
+        if self.displayPyramid is None:
+            return
+
+        pyramid = self.displayPyramid
+        level = pyramid.levelForScale(self.graphicsView.transform().m11())
+        factor = pyramid.factors[level]
+        level_height, level_width = pyramid.levelShape(level)
+        tile_span = TILE_SIZE * factor
+
+        visible = self.graphicsView.mapToScene(self.graphicsView.viewport().rect()).boundingRect()
+        first_x = max(0, int(visible.left() // tile_span))
+        first_y = max(0, int(visible.top() // tile_span))
+        last_x = min(-(-level_width // TILE_SIZE) - 1, int(visible.right() // tile_span))
+        last_y = min(-(-level_height // TILE_SIZE) - 1, int(visible.bottom() // tile_span))
+
+        self.wantedTiles = set()
+        for tile_y in range(first_y, last_y + 1):
+            for tile_x in range(first_x, last_x + 1):
+                key = (self.displayKey, level, tile_x, tile_y)
+                self.wantedTiles.add(key)
+                if key in self.tileItems:
+                    self.tileItems[key].setZValue(1)
+                    continue
+                pixmap = self.tileCache.get(key)
+                if pixmap is not None:
+                    self.addTileItem(key, pixmap)
+                elif key not in self.pendingTiles:
+                    window = Window(tile_x * TILE_SIZE, tile_y * TILE_SIZE,
+                                    min(TILE_SIZE, level_width - tile_x * TILE_SIZE),
+                                    min(TILE_SIZE, level_height - tile_y * TILE_SIZE))
+                    self.pendingTiles.add(key)
+                    self.tilePool.start(TileWorker(key, self.displayRenderer, level, window,
+                                                   self.tileSignals, lambda key: key in self.wantedTiles))
+
+        # Tiles of other levels or layers stay underneath as placeholders until the view is complete
+        complete = all(key in self.tileItems for key in self.wantedTiles)
+        for key in list(self.tileItems):
+            if key in self.wantedTiles:
+                continue
+            if not complete and (key[0] != self.displayKey or key[1] != level):
+                self.tileItems[key].setZValue(0)
+                continue
+            self.graphicsScene.removeItem(self.tileItems.pop(key))
+
+    def addTileItem(self, key, pixmap):
+        _, level, tile_x, tile_y = key
+        factor = self.displayPyramid.factors[level]
+        item = QGraphicsPixmapItem(pixmap)
+        item.setTransform(QTransform().scale(factor, factor))
+        item.setPos(tile_x * TILE_SIZE * factor, tile_y * TILE_SIZE * factor)
+        item.setZValue(1)
+        self.graphicsScene.addItem(item)
+        self.tileItems[key] = item
+
+    def onTileReady(self, key, frame):
+        self.pendingTiles.discard(key)
+        if frame is None:
+            return
+
+        # The upload to the pixmap is the only copy; the frame goes straight back to the pool
+        with profiler.span('pixmap'):
+            pixmap = QPixmap.fromImage(frame.image)
+        frame.release()
+        self.tileCache.put(key, pixmap)
+        if key in self.wantedTiles and key not in self.tileItems:
+            self.addTileItem(key, pixmap)
+            if all(wanted in self.tileItems for wanted in self.wantedTiles):
+                self.renderView()
 
+    def onTileFailed(self, key, message):
+        _, level, tile_x, tile_y = key
+        self.statusBar().showMessage(f"Could not render tile {tile_x}, {tile_y} of level {level}: {message}", 5000)
 
     def saveFile(self):
         file_dialog = QFileDialog()
@@ -393,189 +1189,216 @@ class RasterAnalysisApp(QMainWindow):
             QMessageBox.warning(self, "Error", "No raster data to save.")
             return
 
-        try:
-            profile = next(iter(self.rasterProfiles.values()))
-            data = next(iter(self.rasterData.values()))
-            with rasterio.open(file_path, 'w', **profile) as dst:
-                dst.write(data)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Could not save raster file: {e}")
+        # What is on screen gets saved: a computed index as float32, otherwise the loaded
+        # channels as one multi-band file, always as a Cloud-Optimized GeoTIFF
+        if self.displayKey is not None and self.displayKey[0] == 'ndvi':
+            write = self.indexWriter('NDVI', file_path)
+        else:
+            # The task opens its own handles, so it is unaffected by loading other files meanwhile
+            sources = [(band.file_path, band.band_index, band.grid, band.resampling, band.default_nodata)
+                       for _, band in sorted(self.rasterData.items())]
+            options = CogOptions(self.export_compression)
+
+            def write(checkpoint):
+                bands = [TiledBand(path, band_index, grid=grid, resampling=resampling, default_nodata=nodata)
+                         for path, band_index, grid, resampling, nodata in sources]
+                try:
+                    return exportBands(bands, file_path, options, checkpoint)
+                finally:
+                    for band in bands:
+                        band.close()
+
+        self.startTask('save', write, lambda _: self.statusBar().showMessage(f"Saved {file_path}", 5000),
+                       "Saving")
 
     def updateRasterDisplay(self):
         if not self.rasterData:
             return
 
-        red = self.rasterData.get(0)
-        green = self.rasterData.get(1)
-        blue = self.rasterData.get(2)
-        nir = self.rasterData.get(3)
-
-        if red is None or green is None or blue is None or nir is None:
-            QMessageBox.warning(self, "Error", "Please load all four channels.")
-            return
-
         color_mode = self.colorComboBox.currentText()
 
-        if color_mode == "Custom":
-            red_band = int(self.bandSelectors['Red'].currentText()) - 1
-            green_band = int(self.bandSelectors['Green'].currentText()) - 1
-            blue_band = int(self.bandSelectors['Blue'].currentText()) - 1
-        elif color_mode == "RGB":
-            red_band, green_band, blue_band = 0, 1, 2
-        elif color_mode == "NIR":
-            red_band, green_band, blue_band = 3, 2, 1
-        elif color_mode == "Red Edge":
-            red_band, green_band, blue_band = 2, 3, 4
-
-        rgb = np.stack([red, green, blue], axis=2)
-
-        min_val = np.percentile(rgb, 2)
-        max_val = np.percentile(rgb, 98)
-        rgb = np.clip((rgb - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
-
-        # Ustawienia palety kolorystycznej
-        if color_mode == "RGB":
-            colormap = LinearSegmentedColormap.from_list("RGB", ["#800000", "#ff0000", "#00ff00", "#0000ff", "#000080"])
-        elif color_mode == "NIR":
-            colormap = LinearSegmentedColormap.from_list("CIR", ["#ffffcc", "#ffeda0", "#fed976", "#feb24c", "#fd8d3c", "#fc4e2a", "#e31a1c"])
-        elif color_mode == "Red Edge":
-            colormap = LinearSegmentedColormap.from_list("Red Edge", ["#fee8c8", "#fdd49e", "#fdbb84", "#fc8d59", "#ef6548", "#d7301f", "#990000"])
-        else:
-            colormap = LinearSegmentedColormap.from_list("Custom", ["#800080", "#ff0000", "#ffff00", "#00ff00", "#0000ff", "#ff00ff", "#00ffff"])
-
-        height, width, _ = rgb.shape
-        bytes_per_line = 3 * width
-        q_image = QImage(rgb.data, width, height, bytes_per_line, QImage.Format_RGB888)
-
-        # Konwersja obrazu RGB do QPixmap
-        pixmap = QPixmap.fromImage(q_image)
-
-        # Rysowanie legendy palety kolorystycznej na wizualizacji zdjęcia
-        painter = QPainter(pixmap)
-        colormap_image = np.array([colormap(i / 255.0) for i in range(256)]) * 255
-        colormap_image = colormap_image.astype(np.uint8)
-        colormap_qimage = QImage(colormap_image.data, 256, 1, QImage.Format_RGB888)
-        painter.drawImage(0, 0, colormap_qimage.scaled(pixmap.width(), 50))
-        painter.end()
-
-        if self.pixmapItem:
-            self.graphicsScene.removeItem(self.pixmapItem)
-
-        self.pixmapItem = QGraphicsPixmapItem(pixmap)
-        self.graphicsScene.addItem(self.pixmapItem)
-
-        self.graphicsView.fitInView(self.pixmapItem, Qt.KeepAspectRatio)
-
-        # Zaktualizowanie wizualizacji dla NDVI
         if color_mode == "NDVI":
-            ndvi = (nir - red) / (nir + red)
-            ndvi = np.nan_to_num(ndvi)
-            ndvi = ((ndvi + 1) * 127.5).astype(np.uint8)  # Mapowanie z (-1, 1) do (0, 255)
-
-            q_image_ndvi = QImage(ndvi.data, width, height, width, QImage.Format_Grayscale8)
-            pixmap_ndvi = QPixmap.fromImage(q_image_ndvi)
-
-            if self.pixmapItem:
-                self.graphicsScene.removeItem(self.pixmapItem)
-
-            self.pixmapItem = QGraphicsPixmapItem(pixmap_ndvi)
-            self.graphicsScene.addItem(self.pixmapItem)
-
-            self.graphicsView.fitInView(self.pixmapItem, Qt.KeepAspectRatio)
-
-
-    def calculateBasicStats(self):
-        file_path, data = next(iter(self.rasterData.items()))
-        stats = {}
-        for i, band in enumerate(data, start=1):
-            mean_val = np.mean(band)
-            max_val = np.amax(band)
-            stats[f'Band {i} Mean'] = mean_val
-            stats[f'Band {i} Max'] = max_val
-        QMessageBox.information(self, "Basic Stats", f"Basic statistics:\n{stats}")
-
-
-    def displayRasterImage(self, red_band, green_band, blue_band):
-        file_path, data = next(iter(self.rasterData.items()))
-        profile = self.rasterProfiles[file_path]
-
-        if profile['count'] < max(red_band, green_band, blue_band):
-            QMessageBox.warning(self, "Error", "Selected bands are not available in the raster file.")
+            self.calculateNDVI()
             return
 
-        red = data[red_band - 1]
-        green = data[green_band - 1]
-        blue = data[blue_band - 1]
-        alpha = np.ones_like(red) * 255  # Adding alpha channel
-
-        rgb = np.stack([red, green, blue, alpha], axis=2)  # Adding alpha channel
+        if color_mode == "Custom" and self.rasterStack is None:
+            # Band selectors number the opened files; with a stack they already chose the
+            # bands behind channels 0-2
+            channels = [int(self.bandSelectors[color].currentText()) - 1 for color in ('Red', 'Green', 'Blue')]
+        elif color_mode == "Custom":
+            channels = [CHANNEL_NAMES[name] for name in ('red', 'green', 'blue')]
+        else:
+            channels = [CHANNEL_NAMES[name] for name in COMPOSITES[color_mode]]
 
-        min_val = np.percentile(rgb, 2)
-        max_val = np.percentile(rgb, 98)
-        rgb = np.clip((rgb - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+        pyramids = [self.rasterPyramids.get(channel) for channel in channels]
+        if any(pyramid is None for pyramid in pyramids):
+            QMessageBox.warning(self, "Error", f"{color_mode} needs channels {', '.join(str(c + 1) for c in channels)} loaded.")
+            return
 
-        height, width, _ = rgb.shape
-        bytes_per_line = 4 * width  # 4 channels (RGBA)
-        q_image = QImage(rgb.data, width, height, bytes_per_line, QImage.Format_RGBA8888)  # Format with alpha channel
-        pixmap = QPixmap.fromImage(q_image)
+        # Legenda palety kolorystycznej pod wizualizacją zdjęcia
+        self.showComposite(pyramids, COMPOSITE_COLORMAPS.get(color_mode, "Custom"))
+
+    def showComposite(self, pyramids, colormap_name):
+        # Per-band stretch limits come from the statistics cache, computed on the task pool
+        # the first time a band is shown; a newer selection cancels the computation
+        scl_source = self.sclSource()
+
+        def compute(checkpoint):
+            return [stretch_cache.bandLimits(p, stageProgress(checkpoint, i, len(pyramids)), scl_source)
+                    for i, p in enumerate(pyramids)]
+
+        def show(limits):
+            self.showLegend(colormap_name, pyramids, scl_source)
+            self.showLayer(pyramids[0], self.compositeRenderer(pyramids, limits),
+                           render_graph.layerKey('composite', [bandSource(p) for p in pyramids],
+                                                 'p2-98' if scl_source is None else ('p2-98', scl_source)))
+
+        self.startTask('display', compute, show, "Computing stretch")
+
+    def compositeRenderer(self, pyramids, limits):
+        # Channel planes come from the render graph, so a band already shown in another
+        # composite is not stretched again
+        sources = [bandSource(p) for p in pyramids]
+
+        def render(level, window):
+            frame = frame_pool.acquire(int(window.height), int(window.width))
+            try:
+                for channel, (source, band_limits) in enumerate(zip(sources, limits)):
+                    frame.setChannel(channel, render_graph.plane(source, band_limits, level, window))
+                return frame.publish()
+            except Exception:
+                frame.release()
+                raise
+
+        return render
+
+    def showLegend(self, colormap_name, pyramids=(), scl_source=None):
+        # The first entry of the table is the transparent code of masked pixels
+        lut = np.ascontiguousarray(lut_cache.colormapLut(colormap_name)[1:])
+        legend = QImage(lut.data, 255, 1, 4 * 255, QImage.Format_RGBA8888).copy()
+        self.legendLabel.setPixmap(QPixmap.fromImage(legend))
+
+        # Value ranges of the shown bands, when their statistics are already known
+        ranges = []
+        for pyramid in pyramids:
+            stats = stats_cache.peek(pyramid.band.file_path, pyramid.band.band_index, scl_source,
+                                     pyramid.band.default_nodata)
+            if stats is not None:
+                low, high = stats.percentiles((stretch_cache.low, stretch_cache.high))
+                ranges.append(f"{os.path.basename(pyramid.band.file_path)} band {pyramid.band.band_index}: "
+                              f"{low:g} - {high:g}")
+        self.legendLabel.setToolTip("\n".join(ranges))
 
-        if self.pixmapItem:
-            self.graphicsScene.removeItem(self.pixmapItem)
+    def calculateBasicStats(self):
+        bands = [(channel, band.file_path, band.band_index, band.default_nodata)
+                 for channel, band in sorted(self.rasterData.items())]
+        scl_source = self.sclSource()
 
-        self.pixmapItem = QGraphicsPixmapItem(pixmap)
-        self.graphicsScene.addItem(self.pixmapItem)
+        def compute(checkpoint):
+            lines = []
+            for i, (channel, file_path, band_index, nodata) in enumerate(bands):
+                stats = stats_cache.bandStats(file_path, band_index, progress=stageProgress(checkpoint, i, len(bands)),
+                                              scl_source=scl_source, default_nodata=nodata)
+                lines.append(f"Band {channel + 1}: mean {stats.mean:.4g}, std {stats.std:.4g}, "
+                             f"min {stats.minimum:g}, max {stats.maximum:g}, "
+                             f"{stats.count} valid / {stats.nodata_count} nodata pixels")
+            return lines
 
-        self.graphicsView.fitInView(self.pixmapItem, Qt.KeepAspectRatio)
+        self.startTask('stats', compute, lambda lines: QMessageBox.information(
+            self, "Basic Stats", "Basic statistics:\n" + "\n".join(lines)), "Statistics")
 
 
     def zoomImage(self):
-        if not self.pixmapItem:
+        if self.displayPyramid is None:
             return
 
-        scale_factor = self.zoomSlider.value() / 50.0
-        transform = QTransform().scale(scale_factor, scale_factor)
-        self.pixmapItem.setTransform(transform)
-        self.graphicsView.setSceneRect(self.pixmapItem.boundingRect())
-        self.graphicsView.centerOn(self.pixmapItem)
+        scale_factor = self.fitScale * self.zoomSlider.value() / 50.0
+        center = self.graphicsView.mapToScene(self.graphicsView.viewport().rect().center())
+        self.graphicsView.setTransform(QTransform().scale(scale_factor, scale_factor))
+        self.graphicsView.centerOn(center)
+        self.renderView()
 
     def calculateNDVI(self):
         if not self.rasterData:
             return
 
-        red = self.rasterData.get(0)
-        green = self.rasterData.get(1)
-        blue = self.rasterData.get(2)
-        nir = self.rasterData.get(3)
+        red = self.rasterPyramids.get(CHANNEL_NAMES['red'])
+        nir = self.rasterPyramids.get(CHANNEL_NAMES['nir'])
 
-        if red is None or green is None or blue is None or nir is None:
-            QMessageBox.warning(self, "Error", "Please load all four channels.")
+        if red is None or nir is None:
+            QMessageBox.warning(self, "Error", "NDVI needs the red and NIR channels loaded.")
             return
 
-        ndvi = (nir - red) / (nir + red + 1e-8)  # Dodajemy 1e-8 aby uniknąć dzielenia przez zero
+        classification = self.classificationLevels(red.band.grid)
+        source = ndviSource(red, nir, classification, self.rasterReflectance)
+        ndviLevel = source[1]
 
-        min_val = np.nanpercentile(ndvi, 2)
-        max_val = np.nanpercentile(ndvi, 98)
-        ndvi = np.clip((ndvi - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+        band_ids = tuple(p.band.key + (fileMtime(p.band.file_path),) for p in (red, nir))
+        if classification is not None:
+            band_ids += (classification.band.key,)
+        sample_level = red.levelForSize(STRETCH_SAMPLE_SIZE)
 
-        height, width = ndvi.shape
-        bytes_per_line = width
-        q_image = QImage(ndvi.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
-        pixmap = QPixmap.fromImage(q_image)
+        # Limits of the sample are worth keeping across sessions: the sample reads the whole scene
+        fingerprint = sourceFingerprint(source[0])
+        disk_key = None if fingerprint is None else cacheKey(
+            'limits', fingerprint, sample_level, stretch_cache.low, stretch_cache.high)
 
-        if self.pixmapItem:
-            self.graphicsScene.removeItem(self.pixmapItem)
+        def compute(checkpoint):
+            checkpoint(0, 1)
+            return stretch_cache.limits((source[0][0],) + band_ids, lambda: ndviLevel(sample_level),
+                                        disk_key=disk_key)
 
-        self.pixmapItem = QGraphicsPixmapItem(pixmap)
-        self.graphicsScene.addItem(self.pixmapItem)
-
-        self.graphicsView.fitInView(self.pixmapItem, Qt.KeepAspectRatio)
+        def show(limits):
+            def render(level, window):
+                frame = frame_pool.acquire(int(window.height), int(window.width))
+                try:
+                    render_graph.colormapped(source, limits, 'NDVI', level, window, frame.packed)
+                    return frame.publish(QImage.Format_RGBA8888)
+                except Exception:
+                    frame.release()
+                    raise
+
+            self.showLegend('NDVI')
+            self.showLayer(red, render, render_graph.layerKey('ndvi', [source], 'p2-98', 'NDVI'))
+
+        self.startTask('display', compute, show, "Computing NDVI stretch")
+
+    def exportIndex(self):
+        index = self.indexComboBox.currentText()
+        bands = {name: self.rasterData[channel] for name, channel in CHANNEL_NAMES.items()
+                 if channel in self.rasterData}
+        missing = [name for name in INDICES[index][0] if name not in bands]
+        if missing:
+            QMessageBox.warning(self, "Error", f"{index} needs the {', '.join(missing)} channel(s) loaded.")
+            return
 
+        file_dialog = QFileDialog()
+        file_path, _ = file_dialog.getSaveFileName(self, "Export Index", f"{index}.tif", "GeoTIFF files (*.tif *.tiff)")
+        if not file_path:
+            return
 
+        self.startTask('export', self.indexWriter(index, file_path),
+                       lambda _: QMessageBox.information(self, "Success", f"{index} written to {file_path}."),
+                       f"Exporting {index}")
+
+    def indexWriter(self, index, file_path):
+        # Everything the task needs is read from the widgets here, on the GUI thread
+        sources = {name: (self.rasterData[channel].file_path, self.rasterData[channel].band_index)
+                   for name, channel in CHANNEL_NAMES.items() if channel in self.rasterData}
+        scale, offset = self.rasterReflectance
+        resampling = self.resamplingComboBox.currentText()
+        options = CogOptions(self.export_compression)
+        scl_source = self.sclSource()
+        nodata = next(iter(self.rasterData.values())).default_nodata
+        return lambda checkpoint: ParallelBandMath(sources, scale, reflectance_offset=offset, resampling=resampling,
+                                                   scl_source=scl_source, default_nodata=nodata).run(
+            index, file_path, checkpoint, cog=options)
 
     def authorizeGoogleEarthEngine(self):
         try:
-            ee.Initialize()
-            QMessageBox.information(self, "Success", "Successfully logged in to Google Earth Engine.")
+            _, seconds = initializeEarthEngine()
+            QMessageBox.information(self, "Success", "Successfully logged in to Google Earth Engine." +
+                                    (f" Initialization took {seconds:.2f} s." if seconds else ""))
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Could not log in to Google Earth Engine: {e}")
 
@@ -589,13 +1412,28 @@ class RasterAnalysisApp(QMainWindow):
         # Define ft here based on your logic, e.g., from user input or a predefined area
         ft = 'POLYGON((10.2886962890625 45.93587125244685,10.8544921875 45.93587125244685,10.8544921875 46.33776088279935,10.2886962890625 46.33776088279935,10.2886962890625 45.93587125244685))'
         
+        start = self.startDateInput.date().toPyDate()
+        end = self.endDateInput.date().toPyDate()
+        if end <= start:
+            QMessageBox.warning(self, "Error", "The end date must be after the start date.")
+            return
+
         # Fetch Sentinel-2 L2A products using CopernicusThread
-        self.thread = CopernicusThread(ft)
+        self.thread = CopernicusThread(ft, username, password, start=start, end=end,
+                                       max_cloud=self.cloudInput.value())
         self.thread.finished.connect(lambda: self.downloadButton.setEnabled(True))
         self.thread.update_status.connect(self.updateStatus)
+        self.thread.products_found.connect(self.showProducts)
         self.downloadButton.setEnabled(False)
         self.thread.start()
 
+    def showProducts(self, products):
+        self.productsListWidget.clear()
+        for product in products:
+            item = QListWidgetItem(product["Name"])
+            item.setData(Qt.UserRole, product["Id"])
+            self.productsListWidget.addItem(item)
+
     def downloadSelectedProduct(self, item):
         username = self.usernameInput.text()
         password = self.passwordInput.text()
@@ -605,6 +1443,8 @@ class RasterAnalysisApp(QMainWindow):
             QMessageBox.warning(self, "Error", "Please ensure all fields are filled and a product is selected.")
             return
 
+        from sentinelsat import SentinelAPI
+
         api = SentinelAPI(username, password, 'https://scihub.copernicus.eu/dhus')
         # Przykład zapytania o dane
 
@@ -622,6 +1462,18 @@ class RasterAnalysisApp(QMainWindow):
             QMessageBox.critical(self, "Error", f"Could not download product: {e}")
 
 if __name__ == '__main__':
+    # --startup-time: report how long each startup phase took, once the event loop runs, and quit
+    startup_time = '--startup-time' in sys.argv
+    if startup_time:
+        sys.argv.remove('--startup-time')
     app = QApplication(sys.argv)
+    startup_marks.append(('application', time.perf_counter()))
     ex = RasterAnalysisApp()
+    startup_marks.append(('window', time.perf_counter()))
+    if startup_time:
+        def firstEvent():
+            startup_marks.append(('first event', time.perf_counter()))
+            reportStartup()
+            app.quit()
+        QTimer.singleShot(0, firstEvent)
     sys.exit(app.exec_())
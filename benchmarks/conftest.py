@@ -0,0 +1,70 @@
+# Synthetic Sentinel-2-like scenes for the benchmarks, written once per session
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_analysis.diskcache import disk_cache
+from raster_analysis.render import render_graph
+from raster_analysis.stats import stats_cache, STATS_SIDECAR_SUFFIX
+from raster_analysis.stretch import stretch_cache
+from raster_analysis.tiles import block_cache
+
+# Scene edges in pixels: a small crop, a quarter tile and a full 10 m Sentinel-2 tile
+SCENE_SIZES = {'1k': 1000, '5k': 5000, '11k': 10980}
+
+# Bands written for every scene, with a typical mean digital number
+SCENE_BANDS = {'blue': 900, 'green': 1100, 'red': 1000, 'nir': 3000}
+
+# Columns of nodata on the western edge, as on the swath edge of real tiles
+NODATA_FRACTION = 0.1
+
+def writeBand(path, size, mean, seed):
+    # Smooth field plus noise as uint16 in 512 px tiles, written row block by row block
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1, 'width': size, 'height': size,
+               'crs': 'EPSG:32633', 'transform': from_origin(500000, 5600020, 10, 10), 'nodata': 0,
+               'tiled': True, 'blockxsize': 512, 'blockysize': 512}
+    rng = np.random.default_rng(seed)
+    columns = np.arange(size)
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row_off in range(0, size, 512):
+            rows = np.arange(row_off, min(size, row_off + 512))[:, None]
+            field = mean * (1.0 + 0.5 * np.sin(rows / 700.0) * np.cos(columns / 900.0))
+            block = field + rng.normal(0.0, mean * 0.05, field.shape)
+            block = np.clip(block, 1, 65535).astype(np.uint16)
+            block[:, :int(size * NODATA_FRACTION)] = 0
+            dst.write(block, 1, window=((row_off, row_off + block.shape[0]), (0, size)))
+
+@pytest.fixture(scope='session', params=list(SCENE_SIZES), ids=list(SCENE_SIZES))
+def scene(request, tmp_path_factory):
+    # {band name: path} of one synthetic scene
+    size = SCENE_SIZES[request.param]
+    directory = tmp_path_factory.mktemp(f"scene_{request.param}")
+    paths = {}
+    for seed, (name, mean) in enumerate(SCENE_BANDS.items()):
+        paths[name] = str(directory / f"{name}.tif")
+        writeBand(paths[name], size, mean, seed)
+    return paths
+
+@pytest.fixture(scope='session', autouse=True)
+def noDiskCache():
+    # Timings are of the computations, never of copies out of an earlier run's disk cache
+    directory = disk_cache.directory
+    disk_cache.setDirectory(None)
+    yield
+    disk_cache.setDirectory(directory)
+
+def clearCaches(paths):
+    # Every benchmark round starts cold: nothing cached in memory or in statistics sidecars
+    block_cache.clear()
+    render_graph.clear()
+    stretch_cache.clear()
+    stats_cache.clear()
+    for path in paths:
+        try:
+            os.remove(path + STATS_SIDECAR_SUFFIX)
+        except OSError:
+            pass
@@ -0,0 +1,98 @@
+# Throughput of the hot paths behind calculateNDVI, updateRasterDisplay and saveRaster on
+# synthetic 1k, 5k and 11k scenes, each round starting with cold caches. Run with
+#   python -m pytest benchmarks --benchmark-only
+
+import os
+
+import numpy as np
+from rasterio.windows import Window
+
+from raster_analysis.bandmath import computeIndex
+from raster_analysis.export import CogOptions, exportBands
+from raster_analysis.render import bandSource, ndviSource, render_graph
+from raster_analysis.stretch import STRETCH_SAMPLE_SIZE, stretch_cache
+from raster_analysis.tiles import RasterPyramid, TiledBand
+
+from conftest import clearCaches
+
+# Must match the GUI's tile size and a full-HD viewport fitted to the scene
+TILE_SIZE = 256
+VIEWPORT = (1920, 1080)
+
+ROUNDS = 3
+
+def megapixels(path):
+    band = TiledBand(path)
+    try:
+        return band.width * band.height / 1e6
+    finally:
+        band.close()
+
+def recordThroughput(benchmark, pixels):
+    benchmark.extra_info['megapixels'] = pixels
+    if benchmark.stats is not None:  # None under --benchmark-disable, which runs each once as a test
+        benchmark.extra_info['megapixels_per_s'] = pixels / benchmark.stats.stats.mean
+
+def viewportTiles(pyramid):
+    # Level and tile windows the GUI renders with the whole scene fitted to the viewport
+    scale = min(VIEWPORT[0] / pyramid.shape[1], VIEWPORT[1] / pyramid.shape[0])
+    level = pyramid.levelForScale(scale)
+    height, width = pyramid.levelShape(level)
+    return level, [Window(col_off, row_off, min(TILE_SIZE, width - col_off), min(TILE_SIZE, height - row_off))
+                   for row_off in range(0, height, TILE_SIZE) for col_off in range(0, width, TILE_SIZE)]
+
+def test_ndvi_index(benchmark, scene, tmp_path):
+    out_path = str(tmp_path / 'ndvi.tif')
+    bands = {'red': scene['red'], 'nir': scene['nir']}
+    benchmark.pedantic(computeIndex, args=('NDVI', bands, out_path, 1 / 10000, os.cpu_count()),
+                       setup=lambda: clearCaches(scene.values()), rounds=ROUNDS)
+    recordThroughput(benchmark, megapixels(scene['red']))
+
+def test_ndvi_display(benchmark, scene):
+    # calculateNDVI: NDVI stretch limits from an overview-sized sample, then colormapped tiles
+    def render():
+        red, nir = RasterPyramid(TiledBand(scene['red'])), RasterPyramid(TiledBand(scene['nir']))
+        source = ndviSource(red, nir)
+        sample_level = red.levelForSize(STRETCH_SAMPLE_SIZE)
+        limits = stretch_cache.limits(source[0], lambda: source[1](sample_level))
+        level, windows = viewportTiles(red)
+        for window in windows:
+            out = np.empty((int(window.height), int(window.width)), dtype=np.uint32)
+            render_graph.colormapped(source, limits, 'NDVI', level, window, out)
+        red.band.close()
+        nir.band.close()
+
+    benchmark.pedantic(render, setup=lambda: clearCaches(scene.values()), rounds=ROUNDS)
+    recordThroughput(benchmark, megapixels(scene['red']))
+
+def test_composite_display(benchmark, scene):
+    # updateRasterDisplay: per-band stretch limits, then three stretched planes per tile
+    def render():
+        pyramids = [RasterPyramid(TiledBand(scene[name])) for name in ('red', 'green', 'blue')]
+        limits = [stretch_cache.bandLimits(pyramid) for pyramid in pyramids]
+        level, windows = viewportTiles(pyramids[0])
+        for window in windows:
+            frame = np.empty((int(window.height), int(window.width), 4), dtype=np.uint8)
+            frame[:, :, 3] = 255
+            for channel, (pyramid, band_limits) in enumerate(zip(pyramids, limits)):
+                frame[:, :, channel] = render_graph.plane(bandSource(pyramid), band_limits, level, window)
+        for pyramid in pyramids:
+            pyramid.band.close()
+
+    benchmark.pedantic(render, setup=lambda: clearCaches(scene.values()), rounds=ROUNDS)
+    recordThroughput(benchmark, megapixels(scene['red']))
+
+def test_save_raster(benchmark, scene, tmp_path):
+    # saveRaster: the loaded channels written as one multi-band COG
+    out_path = str(tmp_path / 'composite.tif')
+
+    def save():
+        bands = [TiledBand(scene[name]) for name in ('red', 'green', 'blue')]
+        try:
+            exportBands(bands, out_path, CogOptions())
+        finally:
+            for band in bands:
+                band.close()
+
+    benchmark.pedantic(save, setup=lambda: clearCaches(scene.values()), rounds=ROUNDS)
+    recordThroughput(benchmark, megapixels(scene['red']))
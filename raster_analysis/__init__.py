@@ -0,0 +1,40 @@
+# GUI-free core of the Raster Analysis Application: raster access, band math, stretches,
+# Copernicus search/download and the batch pipeline
+
+import importlib
+
+# Public names and the submodule defining each. Submodules are imported on first access
+# of one of their names, so importing the package, or raster_analysis.tiles, does not
+# also load requests, shapely and matplotlib.
+EXPORTS = {
+    'tiles': ['BlockCache', 'TiledBand', 'RasterStack', 'RasterPyramid', 'PixelGrid', 'alignBands',
+              'finestGrid', 'openBands', 'block_cache'],
+    'scratch': ['ScratchArrays', 'scratch_arrays'],
+    'diskcache': ['DiskCache', 'disk_cache'],
+    'masks': ['BandMask', 'SCL_MASKED_CLASSES', 'openMask'],
+    'stats': ['BandStats', 'StatsCache', 'computeBandStats', 'stats_cache'],
+    'stretch': ['StretchCache', 'LutCache', 'histogramPercentiles', 'stretch_cache', 'lut_cache'],
+    'bandmath': ['INDICES', 'BandMathEngine', 'ParallelBandMath', 'computeIndex'],
+    'copernicus': ['CatalogueQuery', 'CatalogueIndex', 'CatalogueSearch', 'DownloadManager', 'KeycloakToken'],
+    'safe': ['SafeProduct'],
+    'export': ['CogOptions', 'CogWriter', 'exportBands', 'translateToCog'],
+    'composite': ['COMPOSITE_METHODS', 'Scene', 'TemporalComposite', 'compositeGrid'],
+    'earthengine': ['TiledDownload', 'regionStats', 'runScript', 'waitForTask'],
+    'pipeline': ['Pipeline'],
+    'profiling': ['Profiler', 'profiler'],
+}
+
+MODULE_OF = {name: module for module, names in EXPORTS.items() for name in names}
+
+__all__ = list(MODULE_OF)
+
+def __getattr__(name):
+    module = MODULE_OF.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
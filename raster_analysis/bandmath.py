@@ -0,0 +1,371 @@
+# Block-streaming spectral index computation, serial and parallel
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from .diskcache import cacheKey, disk_cache, fileFingerprint
+from .export import openOutput
+from .profiling import profiler
+from .masks import BLOCK_EMPTY, openMask
+from .tiles import DEFAULT_RESAMPLING, alignBands, finestGrid, openBands
+
+# Edge of the internal tiles of computed GeoTIFFs, and of the blocks they are computed in
+OUTPUT_BLOCK_SIZE = 512
+
+def blockView(buffer, height, width):
+    # Contiguous (height, width) view at the start of a flat preallocated buffer
+    return buffer[:height * width].reshape(height, width)
+
+# Spectral indices on float32 reflectance blocks. Each writes into `out` and may use
+# `tmp` as scratch, so a block is computed without allocating full-size temporaries.
+def safeDivide(num, den, out, mask):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(num, den, out=out)
+    np.isinf(out, out=mask)
+    np.copyto(out, np.nan, where=mask)
+    return out
+
+def normalizedDifference(a, b, out, tmp, mask):
+    np.subtract(a, b, out=out)
+    np.add(a, b, out=tmp)
+    return safeDivide(out, tmp, out, mask)
+
+def ndviIndex(bands, out, tmp, mask):
+    return normalizedDifference(bands['nir'], bands['red'], out, tmp, mask)
+
+def ndwiIndex(bands, out, tmp, mask):
+    return normalizedDifference(bands['green'], bands['nir'], out, tmp, mask)
+
+def ndreIndex(bands, out, tmp, mask):
+    return normalizedDifference(bands['nir'], bands['rededge'], out, tmp, mask)
+
+def saviIndex(bands, out, tmp, mask, soil_factor=0.5):
+    nir, red = bands['nir'], bands['red']
+    np.subtract(nir, red, out=out)
+    np.multiply(out, 1 + soil_factor, out=out)
+    np.add(nir, red, out=tmp)
+    np.add(tmp, soil_factor, out=tmp)
+    return safeDivide(out, tmp, out, mask)
+
+def eviIndex(bands, out, tmp, mask):
+    nir, red, blue = bands['nir'], bands['red'], bands['blue']
+    # 2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)
+    np.multiply(red, 6.0, out=tmp)
+    np.add(tmp, nir, out=tmp)
+    np.multiply(blue, 7.5, out=out)
+    np.subtract(tmp, out, out=tmp)
+    np.add(tmp, 1.0, out=tmp)
+    np.subtract(nir, red, out=out)
+    np.multiply(out, 2.5, out=out)
+    return safeDivide(out, tmp, out, mask)
+
+# Index name -> (bands it needs, block function)
+INDICES = {
+    'NDVI': (('nir', 'red'), ndviIndex),
+    'NDWI': (('green', 'nir'), ndwiIndex),
+    'EVI': (('nir', 'red', 'blue'), eviIndex),
+    'SAVI': (('nir', 'red'), saviIndex),
+    'NDRE': (('nir', 'rededge'), ndreIndex),
+}
+
+def indexDiskKey(index, band_sources, reflectance_scale, reflectance_offset, resampling, scl_source,
+                 block_size, cog, default_nodata=None):
+    # Key of an index raster in the disk cache: the fingerprints of its input files and
+    # every parameter its pixels and layout follow from; None while the cache is off
+    if not disk_cache.enabled:
+        return None
+    inputs = []
+    for name in INDICES[index][0]:
+        path, band_index = band_sources[name]
+        inputs.append((name, fileFingerprint(path), band_index))
+    if scl_source is not None:
+        inputs.append(('scl', fileFingerprint(scl_source[0]), scl_source[1]))
+    if any(fingerprint is None for _, fingerprint, _ in inputs):
+        return None
+    options = None if cog is None else tuple(sorted(vars(cog).items()))
+    return cacheKey('index', index, tuple(inputs), float(reflectance_scale), float(reflectance_offset),
+                    resampling, block_size, options, default_nodata)
+
+def cachedIndex(disk_key, out_path, compute, progress=None):
+    # Copies a raster computed before to out_path, or computes it and keeps a copy
+    if disk_cache.getFile(disk_key, out_path):
+        if progress is not None:
+            progress(1, 1)
+        return out_path
+    compute()
+    disk_cache.putFile(disk_key, out_path)
+    return out_path
+
+class BandMathEngine:
+    # Streams a spectral index over raster blocks into a tiled, compressed float32 GeoTIFF.
+    # Bands are given by name ('red', 'nir', ...) and must share one grid (see alignBands). Memory use is a
+    # few blocks per band whatever the scene size, and nothing here needs a GUI.
+    # Pixel values become reflectance as (value + reflectance_offset) * reflectance_scale.
+    # Pixels that are nodata in any band, or masked by the optional BandMask, come out as
+    # NaN; blocks the mask covers entirely are neither read nor computed.
+    def __init__(self, bands, reflectance_scale=1.0, block_size=OUTPUT_BLOCK_SIZE, reflectance_offset=0.0,
+                 mask=None):
+        self.bands = bands
+        self.reflectance_scale = reflectance_scale
+        self.reflectance_offset = reflectance_offset
+        self.block_size = block_size
+        self.mask = mask
+        self.reference = next(iter(bands.values()))
+
+    def outputProfile(self):
+        profile = dict(self.reference.profile)
+        profile.update(driver='GTiff', dtype='float32', count=1, nodata=np.nan,
+                       tiled=True, blockxsize=self.block_size, blockysize=self.block_size,
+                       compress='deflate', predictor=3, interleave='band', BIGTIFF='IF_SAFER')
+        profile.pop('photometric', None)
+        return profile
+
+    def readGroups(self, names):
+        # Bands of one multi-band file are read together; every other band on its own
+        groups = {}
+        for name in names:
+            stack = self.bands[name].stack
+            groups.setdefault(id(stack) if stack is not None else name, []).append(name)
+        return list(groups.values())
+
+    def allocateBuffers(self, names):
+        # Flat buffers, so that the view for a smaller edge block is still contiguous
+        size = self.block_size * self.block_size
+        groups = self.readGroups(names)
+        raw = [np.empty(len(group) * size, dtype=self.bands[group[0]].dtype) for group in groups]
+        scaled = {name: np.empty(size, dtype=np.float32) for name in names}
+        return (groups, raw, scaled, np.empty(size, dtype=np.float32), np.empty(size, dtype=bool),
+                np.empty(size, dtype=bool))
+
+    def computeBlock(self, index, window, buffers, out):
+        names, function = INDICES[index]
+        groups, raw, scaled, tmp, mask, invalid = buffers
+        height, width = int(window.height), int(window.width)
+        result = blockView(out, height, width)
+        invalid = blockView(invalid, height, width)
+
+        coverage, valid = self.mask.window(window) if self.mask is not None else (None, None)
+        if coverage == BLOCK_EMPTY:
+            result.fill(np.nan)
+            return result
+        if valid is None:
+            invalid.fill(False)
+        else:
+            np.logical_not(valid, out=invalid)
+
+        block_bands = {}
+        for group, buffer in zip(groups, raw):
+            planes = buffer[:len(group) * height * width].reshape(len(group), height, width)
+            first = self.bands[group[0]]
+            if len(group) == 1:
+                first.readWindow(window, out=planes[0])
+            else:
+                first.stack.readWindow([self.bands[name].band_index for name in group], window, out=planes)
+            for name, plane in zip(group, planes):
+                nodata = self.bands[name].nodata
+                if nodata is not None and not np.isnan(nodata):
+                    nodata_pixels = blockView(mask, height, width)
+                    np.equal(plane, nodata, out=nodata_pixels)
+                    invalid |= nodata_pixels
+                block = blockView(scaled[name], height, width)
+                np.copyto(block, plane, casting='unsafe')
+                if self.reflectance_offset:
+                    np.add(block, self.reflectance_offset, out=block)
+                if self.reflectance_scale != 1.0:
+                    np.multiply(block, self.reflectance_scale, out=block)
+                block_bands[name] = block
+
+        if invalid.all():
+            result.fill(np.nan)
+            return result
+        function(block_bands, result, blockView(tmp, height, width), blockView(mask, height, width))
+        np.copyto(result, np.nan, where=invalid)
+        return result
+
+    def run(self, index, out_path, progress=None, cog=None):
+        # cog: CogOptions to write a Cloud-Optimized GeoTIFF instead of a plain one
+        names, _ = INDICES[index]
+        missing = [name for name in names if name not in self.bands]
+        if missing:
+            raise ValueError(f"{index} needs bands: {', '.join(missing)}")
+
+        buffers = self.allocateBuffers(names)
+        out = np.empty(self.block_size * self.block_size, dtype=np.float32)
+        with profiler.span('index'), openOutput(out_path, self.outputProfile(), cog) as dst:
+            windows = [window for _, window in dst.block_windows(1)]
+            for done, window in enumerate(windows, start=1):
+                dst.write(self.computeBlock(index, window, buffers, out), 1, window=window)
+                if progress is not None:
+                    progress(done, len(windows))
+        return out_path
+
+class IndexWorker:
+    # State of one pool worker: its own dataset handles, since GDAL handles cannot be
+    # shared between threads, and buffers reused for every block it computes
+    def __init__(self, band_sources, reflectance_scale, block_size, reflectance_offset=0.0,
+                 grid=None, resampling=DEFAULT_RESAMPLING, scl_source=None, default_nodata=None):
+        bands = openBands(band_sources, grid, resampling, default_nodata=default_nodata)
+        self.engine = BandMathEngine(bands, reflectance_scale, block_size, reflectance_offset,
+                                     openMask(bands.values(), scl_source))
+        self.buffers = {}
+        self.out = np.empty(block_size * block_size, dtype=np.float32)
+
+    def compute(self, index, window):
+        if index not in self.buffers:
+            self.buffers[index] = self.engine.allocateBuffers(INDICES[index][0])
+        # The copy is handed to the writer; the worker's buffers are reused for its next block
+        return self.engine.computeBlock(index, window, self.buffers[index], self.out).copy()
+
+    def close(self):
+        if self.engine.mask is not None:
+            self.engine.mask.close()
+        for band in self.engine.bands.values():
+            band.close()
+
+# Worker of the current process when ParallelBandMath runs on a process pool
+process_worker = None
+
+def initProcessWorker(band_sources, reflectance_scale, block_size, reflectance_offset, grid, resampling,
+                      scl_source, default_nodata):
+    global process_worker
+    process_worker = IndexWorker(band_sources, reflectance_scale, block_size, reflectance_offset,
+                                 grid, resampling, scl_source, default_nodata)
+
+def computeInProcess(index, window):
+    return process_worker.compute(index, window)
+
+class ParallelBandMath:
+    # Computes an index over output blocks on a thread or process pool and writes them
+    # from the calling thread, either in file order or as soon as each block is ready.
+    # band_sources maps band names to (file path, band index). Bands of different
+    # resolutions are resampled on the fly onto the finest grid among them. scl_source is
+    # an optional scene classification band, (file path, band index), whose clouds, shadows
+    # and nodata are masked out. default_nodata is the nodata value of band files that
+    # declare none, such as the JP2 bands of Sentinel-2 products.
+    def __init__(self, band_sources, reflectance_scale=1.0, workers=None, use_processes=False,
+                 ordered=False, block_size=OUTPUT_BLOCK_SIZE, reflectance_offset=0.0,
+                 resampling=DEFAULT_RESAMPLING, scl_source=None, default_nodata=None):
+        self.band_sources = band_sources
+        self.scl_source = scl_source
+        self.default_nodata = default_nodata
+        self.reflectance_scale = reflectance_scale
+        self.reflectance_offset = reflectance_offset
+        self.resampling = resampling
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.ordered = ordered
+        self.block_size = block_size
+        self._local = threading.local()
+        self._thread_workers = []
+        self._workers_lock = threading.Lock()
+
+    def threadWorker(self, sources, grid):
+        worker = getattr(self._local, 'worker', None)
+        if worker is None:
+            worker = IndexWorker(sources, self.reflectance_scale, self.block_size, self.reflectance_offset,
+                                 grid, self.resampling, self.scl_source, self.default_nodata)
+            self._local.worker = worker
+            with self._workers_lock:
+                self._thread_workers.append(worker)
+        return worker
+
+    def run(self, index, out_path, progress=None, cog=None):
+        # An index computed before from the same files and parameters is copied from the disk cache
+        names, _ = INDICES[index]
+        missing = [name for name in names if name not in self.band_sources]
+        if missing:
+            raise ValueError(f"{index} needs bands: {', '.join(missing)}")
+        disk_key = indexDiskKey(index, self.band_sources, self.reflectance_scale, self.reflectance_offset,
+                                self.resampling, self.scl_source, self.block_size, cog, self.default_nodata)
+        return cachedIndex(disk_key, out_path, lambda: self.compute(index, out_path, progress, cog), progress)
+
+    def compute(self, index, out_path, progress=None, cog=None):
+        names, _ = INDICES[index]
+        sources = {name: self.band_sources[name] for name in names}
+
+        opened = list(openBands(sources).values())
+        try:
+            grid = finestGrid(opened)
+            reference = next(band for band in opened if band.native_grid == grid)
+            profile = BandMathEngine({names[0]: reference}, block_size=self.block_size).outputProfile()
+        finally:
+            for band in opened:
+                band.close()
+
+        if self.use_processes:
+            pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initProcessWorker,
+                                       initargs=(sources, self.reflectance_scale, self.block_size,
+                                                 self.reflectance_offset, grid, self.resampling,
+                                                 self.scl_source, self.default_nodata))
+            submit = lambda window: pool.submit(computeInProcess, index, window)
+        else:
+            self._local = threading.local()
+            self._thread_workers = []
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+            submit = lambda window: pool.submit(lambda: self.threadWorker(sources, grid).compute(index, window))
+
+        # A few blocks in flight per worker keeps every core busy while bounding memory
+        max_in_flight = self.workers * 4
+        try:
+            with profiler.span('index'), openOutput(out_path, profile, cog) as dst:
+                windows = deque(window for _, window in dst.block_windows(1))
+                total = len(windows)
+                in_flight = deque()
+                done = 0
+                while windows or in_flight:
+                    while windows and len(in_flight) < max_in_flight:
+                        window = windows.popleft()
+                        in_flight.append((submit(window), window))
+
+                    if self.ordered:
+                        ready = [in_flight.popleft()]
+                    else:
+                        completed, _ = wait([future for future, _ in in_flight], return_when=FIRST_COMPLETED)
+                        ready = [item for item in in_flight if item[0] in completed]
+                        for item in ready:
+                            in_flight.remove(item)
+
+                    for future, window in ready:
+                        dst.write(future.result(), 1, window=window)
+                        done += 1
+                        if progress is not None:
+                            progress(done, total)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            for worker in self._thread_workers:
+                worker.close()
+            self._thread_workers = []
+        return out_path
+
+def computeIndex(index, band_paths, out_path, reflectance_scale=1.0, workers=1, use_processes=False,
+                 resampling=DEFAULT_RESAMPLING, cog=None, scl_path=None, default_nodata=None):
+    # Headless entry point: band_paths maps band names to raster files, or to
+    # (file, band index) pairs for bands of a multi-band stack; scl_path likewise.
+    # default_nodata is the nodata value of band files that declare none.
+    sources = {name: path if isinstance(path, tuple) else (path, 1) for name, path in band_paths.items()}
+    scl_source = scl_path if scl_path is None or isinstance(scl_path, tuple) else (scl_path, 1)
+    if workers != 1:
+        return ParallelBandMath(sources, reflectance_scale, workers, use_processes, resampling=resampling,
+                                scl_source=scl_source, default_nodata=default_nodata).run(index, out_path, cog=cog)
+
+    def compute():
+        bands = alignBands(openBands(sources, default_nodata=default_nodata), resampling=resampling)
+        mask = openMask(bands.values(), scl_source)
+        try:
+            return BandMathEngine(bands, reflectance_scale, mask=mask).run(index, out_path, cog=cog)
+        finally:
+            if mask is not None:
+                mask.close()
+            for band in bands.values():
+                band.close()
+
+    missing = [name for name in INDICES[index][0] if name not in sources]
+    if missing:
+        raise ValueError(f"{index} needs bands: {', '.join(missing)}")
+    disk_key = indexDiskKey(index, sources, reflectance_scale, 0.0, resampling, scl_source, OUTPUT_BLOCK_SIZE, cog,
+                            default_nodata)
+    return cachedIndex(disk_key, out_path, compute)
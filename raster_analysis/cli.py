@@ -0,0 +1,179 @@
+# Command-line entry point: python -m raster_analysis <command> ...
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+from .bandmath import INDICES, computeIndex
+from .composite import COMPOSITE_BANDS, COMPOSITE_METHODS, Scene, TemporalComposite, compositeGrid
+from .copernicus import CatalogueQuery, CatalogueSearch, DOWNLOAD_WORKERS
+from .diskcache import disk_cache
+from .export import CogOptions, COG_COMPRESSION, COG_COMPRESSIONS
+from .pipeline import Pipeline, PIPELINE_QUEUE_SIZE
+from .safe import CHANNEL_BANDS, SafeProduct
+from .tiles import RESAMPLING_METHODS, DEFAULT_RESAMPLING
+
+def readAoi(value):
+    # WKT given directly, or a file holding WKT or GeoJSON
+    if not os.path.exists(value):
+        return value
+    with open(value) as f:
+        text = f.read()
+    if not value.lower().endswith(('.json', '.geojson')):
+        return text.strip()
+
+    from shapely.geometry import shape
+    data = json.loads(text)
+    if data.get("type") == "FeatureCollection":
+        data = data["features"][0]
+    if data.get("type") == "Feature":
+        data = data["geometry"]
+    return shape(data).wkt
+
+def addSearchArguments(parser):
+    parser.add_argument("--aoi", required=True, help="area of interest: WKT, or a .wkt/.geojson file")
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today() - timedelta(days=1),
+                        help="first acquisition day, YYYY-MM-DD (default: yesterday)")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today(),
+                        help="day after the last acquisition day, YYYY-MM-DD (default: today)")
+    parser.add_argument("--cloud", type=float, default=100.0, help="maximum cloud cover in percent")
+    parser.add_argument("--product-type", default="S2MSI2A")
+
+def queryFromArguments(args):
+    return CatalogueQuery(readAoi(args.aoi), args.start, args.end, args.product_type, args.cloud)
+
+def parseBandPath(value):
+    path, at, band_index = value.rpartition("@") if "@" in value else (value, "", "")
+    if not at:
+        return path
+    if not band_index.isdigit():
+        raise argparse.ArgumentTypeError(f"band index must be a number, not {band_index!r}")
+    return path, int(band_index)
+
+def parseBand(value):
+    name, _, path = value.partition("=")
+    if not path:
+        raise argparse.ArgumentTypeError("bands are given as NAME=PATH[@BAND], e.g. red=B04.tif or red=stack.tif@4")
+    return name, parseBandPath(path)
+
+def runSearch(args):
+    search = CatalogueSearch()
+    try:
+        for product in search.search(queryFromArguments(args)):
+            print(f"{product['ContentDate']['Start']}  {product['Name']}")
+    finally:
+        search.index.close()
+    return 0
+
+def runIndex(args):
+    cog = CogOptions(args.compress, dtype=args.dtype, scale=args.dtype_scale) if args.cog else None
+    computeIndex(args.index, dict(args.band), args.output, args.scale, args.workers, args.processes,
+                 args.resampling, cog, args.scl, args.nodata)
+    return 0
+
+def runComposite(args):
+    band_names = tuple(args.bands.split(","))
+    unknown = [name for name in band_names if name not in CHANNEL_BANDS]
+    if unknown:
+        print(f"Unknown band(s) {', '.join(unknown)}; choose from {', '.join(CHANNEL_BANDS)}", file=sys.stderr)
+        return 2
+
+    scenes = [Scene.fromProduct(SafeProduct(path), band_names, not args.keep_clouds) for path in args.products]
+    bounds = None
+    if args.aoi:
+        from shapely import wkt
+        bounds = wkt.loads(readAoi(args.aoi)).bounds
+    grid = compositeGrid(scenes, bounds, resolution=args.resolution, bounds_crs="EPSG:4326" if bounds else None)
+    cog = CogOptions(args.compress, dtype=args.dtype, scale=args.dtype_scale)
+    TemporalComposite(scenes, args.method, band_names, grid, args.workers,
+                      resampling=args.resampling).run(args.output, cog=cog)
+    return 0
+
+def runPipeline(args):
+    username = os.getenv("copernicus_user")
+    password = os.getenv("copernicus_password")
+    if not username or not password:
+        print("Set the copernicus_user and copernicus_password environment variables.", file=sys.stderr)
+        return 2
+
+    pipeline = Pipeline(queryFromArguments(args), args.index, args.output_dir, username, password,
+                        download_dir=args.download_dir, work_dir=args.work_dir,
+                        download_workers=args.download_workers, compute_workers=args.workers,
+                        queue_size=args.queue_size, resampling=args.resampling, mask_clouds=args.mask_clouds)
+    results = pipeline.run()
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    print(f"{len(results) - len(failed)} of {len(results)} product(s) processed.")
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="raster_analysis",
+                                     description="Headless Sentinel-2 search, download and index processing.")
+    parser.add_argument("--cache-dir", help="disk cache of computed indices (default: %(default)s)",
+                        default=disk_cache.directory)
+    parser.add_argument("--no-cache", action="store_true", help="always recompute, and keep nothing in the disk cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search = commands.add_parser("search", help="list catalogue products")
+    addSearchArguments(search)
+    search.set_defaults(run=runSearch)
+
+    index = commands.add_parser("index", help="compute an index from local band files")
+    index.add_argument("--index", choices=list(INDICES), default="NDVI")
+    index.add_argument("--band", type=parseBand, action="append", required=True, metavar="NAME=PATH[@BAND]",
+                       help="input band, e.g. red=B04.tif or red=stack.tif@4; repeat for each band the index needs")
+    index.add_argument("--output", "-o", required=True)
+    index.add_argument("--scale", type=float, default=1.0, help="factor turning pixel values into reflectance")
+    index.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    index.add_argument("--processes", action="store_true", help="use worker processes instead of threads")
+    index.add_argument("--cog", action="store_true", help="write a Cloud-Optimized GeoTIFF")
+    index.add_argument("--compress", choices=COG_COMPRESSIONS, default=COG_COMPRESSION, help="COG compression")
+    index.add_argument("--dtype", choices=["float32", "int16", "uint16", "uint8"],
+                       help="COG data type (default float32)")
+    index.add_argument("--dtype-scale", type=float, default=1.0,
+                       help="factor applied before storing as an integer type, e.g. 10000")
+    index.add_argument("--resampling", choices=RESAMPLING_METHODS, default=DEFAULT_RESAMPLING,
+                       help="kernel for bands of different resolutions")
+    index.add_argument("--nodata", type=float, help="value of pixels without data in band files that declare none")
+    index.add_argument("--scl", type=parseBandPath, metavar="PATH[@BAND]",
+                       help="Sentinel-2 scene classification; nodata, cloud and shadow pixels are masked out")
+    index.set_defaults(run=runIndex)
+
+    composite = commands.add_parser("composite", help="composite Sentinel-2 products across dates and tiles")
+    composite.add_argument("products", nargs="+", metavar="PRODUCT.zip")
+    composite.add_argument("--method", choices=COMPOSITE_METHODS, default="median")
+    composite.add_argument("--bands", default=",".join(COMPOSITE_BANDS),
+                           help=f"comma-separated bands to composite (default {','.join(COMPOSITE_BANDS)})")
+    composite.add_argument("--aoi", help="area of interest to crop to: WKT, or a .wkt/.geojson file, in EPSG:4326")
+    composite.add_argument("--resolution", type=float, help="output pixel size (default: that of the first product)")
+    composite.add_argument("--output", "-o", required=True)
+    composite.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    composite.add_argument("--compress", choices=COG_COMPRESSIONS, default=COG_COMPRESSION, help="COG compression")
+    composite.add_argument("--dtype", choices=["float32", "int16", "uint16"], help="COG data type (default float32)")
+    composite.add_argument("--dtype-scale", type=float, default=1.0,
+                           help="factor applied before storing as an integer type, e.g. 10000")
+    composite.add_argument("--resampling", choices=RESAMPLING_METHODS, default=DEFAULT_RESAMPLING,
+                           help="kernel for scenes not on the output grid")
+    composite.add_argument("--keep-clouds", action="store_true",
+                           help="do not mask clouds and shadows by the scene classification of L2A products")
+    composite.set_defaults(run=runComposite)
+
+    run = commands.add_parser("run", help="search, download and compute an index for every product")
+    addSearchArguments(run)
+    run.add_argument("--index", choices=list(INDICES), default="NDVI")
+    run.add_argument("--output-dir", default=".")
+    run.add_argument("--download-dir", help="where product archives are kept (default: output dir)")
+    run.add_argument("--work-dir", help="scratch directory for intermediate rasters (default: a temporary one)")
+    run.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS)
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="index computation workers")
+    run.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE)
+    run.add_argument("--resampling", choices=RESAMPLING_METHODS, default=DEFAULT_RESAMPLING,
+                     help="kernel for bands of different resolutions")
+    run.add_argument("--mask-clouds", action="store_true",
+                     help="mask nodata, cloud and shadow pixels by the scene classification of L2A products")
+    run.set_defaults(run=runPipeline)
+
+    args = parser.parse_args(argv)
+    disk_cache.setDirectory(None if args.no_cache else args.cache_dir)
+    return args.run(args)
@@ -0,0 +1,340 @@
+# Mosaics and temporal composites of many scenes, streamed block by block into one raster
+
+import math
+import os
+import threading
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, bounds as windowBounds
+
+from .bandmath import OUTPUT_BLOCK_SIZE, ndviIndex
+from .export import openOutput
+from .profiling import profiler
+from .masks import BLOCK_EMPTY, openMask
+from .safe import CHANNEL_BANDS
+from .tiles import DEFAULT_RESAMPLING, PixelGrid, openBands
+
+# Per-pixel rules choosing among the scenes covering a pixel:
+#   median        the median reflectance of every band over the valid observations
+#   max-ndvi      all bands of the observation with the greenest (highest) NDVI
+#   least-cloudy  all bands of the first valid observation, scenes taken by cloud cover;
+#                 over scenes of one date this is a mosaic across tiles
+COMPOSITE_METHODS = ['median', 'max-ndvi', 'least-cloudy']
+
+# Bands written unless others are asked for
+COMPOSITE_BANDS = ('blue', 'green', 'red', 'nir')
+
+def defaultOpenFiles():
+    # Half the process's file descriptor limit, leaving the rest to GDAL and everything else
+    try:
+        import resource  # Unix only
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            return max(16, soft // 2)
+    except (ImportError, OSError, ValueError):
+        pass
+    return 512
+
+# Files all workers of a composite keep open together; an open scene holds one per band
+# plus its scene classification
+COMPOSITE_MAX_OPEN_FILES = defaultOpenFiles()
+
+# Memory the median buffers of all workers may take together, each holding one block of
+# every band of every scene overlapping it
+COMPOSITE_MEDIAN_BYTES = 2 * 1024 * 1024 * 1024
+
+class Scene:
+    # One acquisition of one tile: bands by name as (file path, band index), the conversion
+    # of its digital numbers to reflectance, the value of pixels outside its swath when the
+    # files do not declare one, an optional scene classification masking clouds and a cloud
+    # cover in percent ordering least-cloudy composites
+    def __init__(self, band_sources, reflectance_scale=1.0, reflectance_offset=0.0, nodata=None,
+                 scl_source=None, cloud_cover=0.0, name=None):
+        self.band_sources = band_sources
+        self.reflectance_scale = reflectance_scale
+        self.reflectance_offset = reflectance_offset
+        self.nodata = nodata
+        self.scl_source = scl_source
+        self.cloud_cover = cloud_cover
+        self.name = name or os.path.basename(next(iter(band_sources.values()))[0])
+
+    @classmethod
+    def fromProduct(cls, product, band_names=COMPOSITE_BANDS, mask_clouds=True):
+        # Scene of a SafeProduct; its scene classification masks clouds and shadows when
+        # mask_clouds is set and the product is L2A
+        sources = {name: (product.bandPath(CHANNEL_BANDS[name]), 1) for name in band_names}
+        scale, offset = product.reflectance(CHANNEL_BANDS[band_names[0]])
+        scl_path = product.classificationPath() if mask_clouds else None
+        return cls(sources, scale, offset, product.nodata, (scl_path, 1) if scl_path else None,
+                   product.cloud_cover or 0.0, os.path.basename(product.zip_path))
+
+    def bounds(self, crs=None):
+        # (west, south, east, north) of the scene's first band, in crs if given
+        path, _ = next(iter(self.band_sources.values()))
+        with rasterio.open(path) as src:
+            if crs is None or crs == src.crs:
+                return tuple(src.bounds)
+            return transform_bounds(src.crs, crs, *src.bounds)
+
+def compositeGrid(scenes, bounds=None, crs=None, resolution=None, bounds_crs=None):
+    # Grid covering every scene, or only bounds (west, south, east, north, in bounds_crs or
+    # else in the grid's crs), with the CRS and pixel size of the first scene unless given.
+    # Its origin is snapped to the pixel size, so tiles of one UTM zone keep their pixels
+    # unresampled.
+    path, _ = next(iter(scenes[0].band_sources.values()))
+    with rasterio.open(path) as src:
+        crs = crs or src.crs
+        resolution = resolution or abs(src.transform.a)
+    if bounds is not None and bounds_crs is not None:
+        bounds = transform_bounds(bounds_crs, crs, *bounds)
+
+    extents = [scene.bounds(crs) for scene in scenes]
+    west, south = min(e[0] for e in extents), min(e[1] for e in extents)
+    east, north = max(e[2] for e in extents), max(e[3] for e in extents)
+    if bounds is not None:
+        west, south = max(west, bounds[0]), max(south, bounds[1])
+        east, north = min(east, bounds[2]), min(north, bounds[3])
+        if west >= east or south >= north:
+            raise ValueError("The area of interest does not overlap any scene")
+
+    west = math.floor(west / resolution) * resolution
+    north = math.ceil(north / resolution) * resolution
+    width = int(math.ceil((east - west) / resolution))
+    height = int(math.ceil((north - south) / resolution))
+    return PixelGrid(crs, Affine(resolution, 0.0, west, 0.0, -resolution, north), width, height)
+
+class SceneReader:
+    # Dataset handles of one scene warped onto the output grid, and blocks of it as float32
+    # reflectance with NaN wherever the scene has no valid observation
+    def __init__(self, scene, grid, band_names, resampling=DEFAULT_RESAMPLING):
+        self.scene = scene
+        self.band_names = band_names
+        self.bands = openBands({name: scene.band_sources[name] for name in band_names}, grid, resampling,
+                               default_nodata=scene.nodata)
+        self.mask = openMask(self.bands.values(), scene.scl_source)
+
+    def readBlock(self, window, out):
+        # Fills out, a (bands, height, width) float32 buffer; False when nothing is valid
+        coverage, valid = self.mask.window(window) if self.mask is not None else (None, None)
+        if coverage == BLOCK_EMPTY:
+            return False
+
+        invalid = np.zeros(out.shape[1:], dtype=bool) if valid is None else ~valid
+        for plane, name in zip(out, self.band_names):
+            band = self.bands[name]
+            data = band.readWindow(window)
+            if band.nodata is not None and not np.isnan(band.nodata):
+                invalid |= data == band.nodata
+            np.copyto(plane, data, casting='unsafe')
+            if self.scene.reflectance_offset:
+                np.add(plane, self.scene.reflectance_offset, out=plane)
+            if self.scene.reflectance_scale != 1.0:
+                np.multiply(plane, self.scene.reflectance_scale, out=plane)
+        if invalid.all():
+            return False
+        out[:, invalid] = np.nan
+        return True
+
+    def close(self):
+        if self.mask is not None:
+            self.mask.close()
+        for band in self.bands.values():
+            band.close()
+
+def overlaps(bounds, footprint):
+    west, south, east, north = bounds
+    return not (east <= footprint[0] or west >= footprint[2] or north <= footprint[1] or south >= footprint[3])
+
+class CompositeWorker:
+    # One pool thread's per-block buffers and readers. A scene is opened only once a block
+    # overlaps its footprint, and at most max_open scenes stay open, the least recently
+    # used being closed first, which bounds the worker's file handles whatever the number
+    # of scenes. Median composites hold the block of every scene overlapping it at once;
+    # their buffer grows to the largest such number seen.
+    def __init__(self, scenes, footprints, grid, band_names, method, block_size, resampling, max_open):
+        self.scenes = scenes
+        self.footprints = footprints
+        self.grid = grid
+        self.band_names = band_names
+        self.method = method
+        self.resampling = resampling
+        self.max_open = max_open
+        self.readers = OrderedDict()
+        self.block_shape = (len(band_names), block_size, block_size)
+        self.scene_buffer = np.empty(self.block_shape, dtype=np.float32)
+        self.median_buffer = None
+
+    def reader(self, index):
+        reader = self.readers.get(index)
+        if reader is not None:
+            self.readers.move_to_end(index)
+            return reader
+        while len(self.readers) >= self.max_open:
+            _, evicted = self.readers.popitem(last=False)
+            evicted.close()
+        reader = SceneReader(self.scenes[index], self.grid, self.band_names, self.resampling)
+        self.readers[index] = reader
+        return reader
+
+    def overlapping(self, window):
+        # Readers of the scenes whose footprint overlaps the window, in scene order
+        bounds = windowBounds(window, self.grid.transform)
+        for index, footprint in enumerate(self.footprints):
+            if overlaps(bounds, footprint):
+                yield self.reader(index)
+
+    def compute(self, window):
+        height, width = int(window.height), int(window.width)
+        out = np.full((len(self.band_names), height, width), np.nan, dtype=np.float32)
+        block = self.scene_buffer[:, :height, :width]
+
+        if self.method == 'median':
+            readers = list(self.overlapping(window))
+            if self.median_buffer is None or len(self.median_buffer) < len(readers):
+                self.median_buffer = np.empty((len(readers),) + self.block_shape, dtype=np.float32)
+            observations = self.median_buffer[:, :, :height, :width]
+            count = 0
+            for reader in readers:
+                if reader.readBlock(window, observations[count]):
+                    count += 1
+            if count:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)  # Pixels no scene observed stay NaN
+                    np.nanmedian(observations[:count], axis=0, out=out)
+            return out
+
+        if self.method == 'max-ndvi':
+            best = np.full((height, width), -np.inf, dtype=np.float32)
+            ndvi = np.empty((height, width), dtype=np.float32)
+            tmp = np.empty_like(ndvi)
+            scratch = np.empty((height, width), dtype=bool)
+            bands = dict(zip(self.band_names, block))
+            for reader in self.overlapping(window):
+                if not reader.readBlock(window, block):
+                    continue
+                ndviIndex(bands, ndvi, tmp, scratch)
+                greener = ndvi > best  # False where NaN
+                best[greener] = ndvi[greener]
+                out[:, greener] = block[:, greener]
+            return out
+
+        # least-cloudy: scenes are in order of cloud cover; stop once every pixel is filled
+        missing = np.ones((height, width), dtype=bool)
+        for reader in self.overlapping(window):
+            if not reader.readBlock(window, block):
+                continue
+            fill = missing & ~np.isnan(block).any(axis=0)
+            out[:, fill] = block[:, fill]
+            missing &= ~fill
+            if not missing.any():
+                break
+        return out
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+class TemporalComposite:
+    # Composites scenes of any dates and tiles onto one grid (compositeGrid by default),
+    # one output block at a time on a thread pool: each block reads just that window of the
+    # scenes overlapping it and reduces it by the method, so memory depends on the block
+    # size and the number of scenes, never on their extent. Every worker thread opens its
+    # own handles to the scenes its blocks overlap. Workers are fewer than asked for when
+    # each could not otherwise keep all the scenes of one block open within max_open_files,
+    # or, for medians, when their buffers (overlapping scenes x bands x block_size^2 x 4
+    # bytes each) would exceed median_bytes. The result is float32 reflectance with NaN
+    # where no scene had a valid observation.
+    def __init__(self, scenes, method='median', band_names=COMPOSITE_BANDS, grid=None, workers=None,
+                 block_size=OUTPUT_BLOCK_SIZE, resampling=DEFAULT_RESAMPLING,
+                 max_open_files=COMPOSITE_MAX_OPEN_FILES, median_bytes=COMPOSITE_MEDIAN_BYTES):
+        if method not in COMPOSITE_METHODS:
+            raise ValueError(f"Unknown composite method {method}; choose from {', '.join(COMPOSITE_METHODS)}")
+        if method == 'max-ndvi' and not {'red', 'nir'} <= set(band_names):
+            raise ValueError("max-ndvi composites need the red and nir bands")
+        if not scenes:
+            raise ValueError("No scenes to composite")
+        self.scenes = sorted(scenes, key=lambda scene: scene.cloud_cover) if method == 'least-cloudy' else scenes
+        self.method = method
+        self.band_names = tuple(band_names)
+        self.grid = grid or compositeGrid(scenes)
+        self.block_size = block_size
+        self.resampling = resampling
+        self.footprints = [scene.bounds(self.grid.crs) for scene in self.scenes]
+
+        overlap = max(1, self.maxOverlap())
+        files_per_scene = len(self.band_names) + 1
+        workers = min(workers or os.cpu_count() or 1, max(1, max_open_files // (overlap * files_per_scene)))
+        if method == 'median':
+            median_buffer = overlap * len(self.band_names) * block_size * block_size * 4
+            workers = min(workers, max(1, median_bytes // median_buffer))
+        self.workers = workers
+        self.max_open = max(1, max_open_files // (workers * files_per_scene))
+        self._local = threading.local()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+
+    def outputProfile(self):
+        return {
+            'driver': 'GTiff', 'dtype': 'float32', 'count': len(self.band_names), 'nodata': np.nan,
+            'crs': self.grid.crs, 'transform': self.grid.transform,
+            'width': self.grid.width, 'height': self.grid.height,
+            'tiled': True, 'blockxsize': self.block_size, 'blockysize': self.block_size,
+            'compress': 'deflate', 'predictor': 3, 'interleave': 'band', 'BIGTIFF': 'IF_SAFER',
+        }
+
+    def maxOverlap(self):
+        # Most scenes overlapping any one output block
+        most = 0
+        for row_off in range(0, self.grid.height, self.block_size):
+            for col_off in range(0, self.grid.width, self.block_size):
+                window = Window(col_off, row_off, min(self.block_size, self.grid.width - col_off),
+                                min(self.block_size, self.grid.height - row_off))
+                bounds = windowBounds(window, self.grid.transform)
+                most = max(most, sum(1 for footprint in self.footprints if overlaps(bounds, footprint)))
+        return most
+
+    def threadWorker(self):
+        worker = getattr(self._local, 'worker', None)
+        if worker is None:
+            worker = CompositeWorker(self.scenes, self.footprints, self.grid, self.band_names, self.method,
+                                     self.block_size, self.resampling, self.max_open)
+            self._local.worker = worker
+            with self._workers_lock:
+                self._workers.append(worker)
+        return worker
+
+    def run(self, out_path, progress=None, cog=None):
+        # cog: CogOptions to write a Cloud-Optimized GeoTIFF instead of a plain one
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        max_in_flight = self.workers * 2
+        try:
+            with profiler.span('composite'), openOutput(out_path, self.outputProfile(), cog) as dst:
+                windows = deque(window for _, window in dst.block_windows(1))
+                total = len(windows)
+                in_flight = set()
+                done = 0
+                while windows or in_flight:
+                    while windows and len(in_flight) < max_in_flight:
+                        window = windows.popleft()
+                        future = pool.submit(lambda w=window: self.threadWorker().compute(w))
+                        future.window = window
+                        in_flight.add(future)
+                    completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        dst.write(future.result(), window=future.window)
+                        done += 1
+                        if progress is not None:
+                            progress(done, total)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+        return out_path
@@ -0,0 +1,361 @@
+# Copernicus Data Space catalogue search and product downloads
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from shapely import wkt
+from shapely.geometry import shape
+from urllib3.util.retry import Retry
+
+from .profiling import profiler
+
+# Copernicus Data Space Ecosystem endpoints
+KEYCLOAK_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+CATALOGUE_URL = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products"
+
+# Parallel product downloads, and the size of the pieces they are streamed to disk in
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Tokens are refreshed this many seconds before the server would expire them
+TOKEN_EXPIRY_MARGIN = 60
+
+# Products per catalogue page (the OData maximum), and where search results are kept
+CATALOGUE_PAGE_SIZE = 1000
+CATALOGUE_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".raster_analysis", "catalogue.sqlite")
+
+# Products keep arriving in the catalogue for a few days after acquisition, so days this
+# recent are always searched again instead of being served from the local index
+CATALOGUE_RECENT_DAYS = 3
+
+class KeycloakToken:
+    # Access token shared by all downloads; refreshed with the refresh token shortly before
+    # it expires, and only re-created from the password when that is no longer possible
+    def __init__(self, session, username, password):
+        self.session = session
+        self.username = username
+        self.password = password
+        self._access_token = None
+        self._refresh_token = None
+        self._expires_at = 0.0
+        self._refresh_expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._access_token and now < self._expires_at - TOKEN_EXPIRY_MARGIN:
+                return self._access_token
+            if self._refresh_token and now < self._refresh_expires_at - TOKEN_EXPIRY_MARGIN:
+                self.request({"client_id": "cdse-public", "grant_type": "refresh_token",
+                              "refresh_token": self._refresh_token})
+            else:
+                self.request(self.passwordGrant())
+            return self._access_token
+
+    def passwordGrant(self):
+        return {"client_id": "cdse-public", "grant_type": "password",
+                "username": self.username, "password": self.password}
+
+    def request(self, data):
+        r = self.session.post(KEYCLOAK_URL, data=data)
+        if r.status_code != 200 and data["grant_type"] == "refresh_token":
+            # Refresh token revoked early; fall back to the password grant
+            self._refresh_token = None
+            r = self.session.post(KEYCLOAK_URL, data=self.passwordGrant())
+        if r.status_code != 200:
+            raise Exception(f"Keycloak token creation failed. Response from the server was: {r.text}")
+        token = r.json()
+        now = time.monotonic()
+        self._access_token = token["access_token"]
+        self._expires_at = now + token.get("expires_in", 600)
+        self._refresh_token = token.get("refresh_token")
+        self._refresh_expires_at = now + token.get("refresh_expires_in", 0)
+
+    def invalidate(self):
+        with self._lock:
+            self._access_token = None
+
+def productFileName(product):
+    identifier = product.get("identifier") or product["Name"]
+    if identifier.endswith(".SAFE"):
+        identifier = identifier[:-len(".SAFE")]
+    return f"{identifier}.zip"
+
+def productChecksum(product):
+    # (algorithm, expected hex digest) from the OData product metadata, MD5 preferred
+    checksums = {c.get("Algorithm", "").upper(): c.get("Value") for c in product.get("Checksum") or []}
+    for algorithm in ("MD5", "SHA256", "SHA3-256"):
+        if checksums.get(algorithm):
+            return algorithm, checksums[algorithm].lower()
+    return None
+
+def fileDigest(file_path, algorithm):
+    digest = hashlib.new(algorithm.lower().replace("-", "_"))
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def productAttribute(product, name):
+    for attribute in product.get("Attributes") or []:
+        if attribute.get("Name") == name:
+            return attribute.get("Value")
+    return None
+
+class CatalogueQuery:
+    # Search parameters; all of them are pushed down into the OData $filter.
+    # Dates are datetime.date objects and the end date is exclusive.
+    def __init__(self, aoi, start, end, product_type="S2MSI2A", max_cloud=100.0, collection="SENTINEL-2"):
+        self.aoi = aoi
+        self.start = start
+        self.end = end
+        self.product_type = product_type
+        self.max_cloud = 100.0 if max_cloud is None else float(max_cloud)
+        self.collection = collection
+
+    def days(self):
+        return [self.start + timedelta(days=i) for i in range((self.end - self.start).days)]
+
+    def odataFilter(self, start, end):
+        clauses = [
+            f"Collection/Name eq '{self.collection}'",
+            f"OData.CSC.Intersects(area=geography'SRID=4326;{self.aoi}')",
+            f"ContentDate/Start ge {start.isoformat()}T00:00:00.000Z",
+            f"ContentDate/Start lt {end.isoformat()}T00:00:00.000Z",
+        ]
+        if self.product_type:
+            clauses.append("Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and "
+                           f"att/OData.CSC.StringAttribute/Value eq '{self.product_type}')")
+        if self.max_cloud < 100.0:
+            clauses.append("Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and "
+                           f"att/OData.CSC.DoubleAttribute/Value le {self.max_cloud:.2f})")
+        return " and ".join(clauses)
+
+class CatalogueIndex:
+    # Local SQLite index of catalogue products with an R*Tree over footprint bounds, plus
+    # a record of which (product type, cloud limit, AOI, day) searches it already holds
+    def __init__(self, path=CATALOGUE_INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS products (
+                rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, name TEXT, product_type TEXT,
+                cloud_cover REAL, start TEXT, footprint TEXT, json TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS products_type_start ON products (product_type, start);
+            CREATE TABLE IF NOT EXISTS coverage (
+                product_type TEXT, max_cloud REAL, aoi TEXT, day TEXT,
+                PRIMARY KEY (product_type, max_cloud, aoi, day));
+        """)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS product_bounds USING rtree(id, minx, maxx, miny, maxy)")
+        except sqlite3.OperationalError:
+            # SQLite built without R*Tree: same columns, plain B-tree
+            self.db.execute("CREATE TABLE IF NOT EXISTS product_bounds "
+                            "(id INTEGER PRIMARY KEY, minx REAL, maxx REAL, miny REAL, maxy REAL)")
+        self.db.commit()
+        self._aois = {}
+
+    def geometry(self, aoi):
+        if aoi not in self._aois:
+            self._aois[aoi] = wkt.loads(aoi)
+        return self._aois[aoi]
+
+    def insert(self, products):
+        with self.db:
+            for product in products:
+                footprint = shape(product["GeoFootprint"])
+                product_type = productAttribute(product, "productType")
+                cloud_cover = productAttribute(product, "cloudCover")
+                self.db.execute(
+                    "INSERT INTO products (id, name, product_type, cloud_cover, start, footprint, json) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET name = excluded.name, "
+                    "product_type = excluded.product_type, cloud_cover = excluded.cloud_cover, "
+                    "start = excluded.start, footprint = excluded.footprint, json = excluded.json",
+                    (product["Id"], product["Name"], product_type, cloud_cover,
+                     product["ContentDate"]["Start"], footprint.wkt, json.dumps(product)))
+                rowid = self.db.execute("SELECT rowid FROM products WHERE id = ?", (product["Id"],)).fetchone()[0]
+                minx, miny, maxx, maxy = footprint.bounds
+                self.db.execute("INSERT OR REPLACE INTO product_bounds VALUES (?, ?, ?, ?, ?)",
+                                (rowid, minx, maxx, miny, maxy))
+
+    def search(self, query):
+        aoi = self.geometry(query.aoi)
+        minx, miny, maxx, maxy = aoi.bounds
+        rows = self.db.execute(
+            "SELECT p.json, p.footprint FROM products p JOIN product_bounds b ON b.id = p.rowid "
+            "WHERE b.maxx >= ? AND b.minx <= ? AND b.maxy >= ? AND b.miny <= ? "
+            "AND p.product_type = ? AND p.start >= ? AND p.start < ? "
+            "AND (p.cloud_cover IS NULL OR p.cloud_cover <= ?) ORDER BY p.start",
+            (minx, maxx, miny, maxy, query.product_type, query.start.isoformat(), query.end.isoformat(),
+             query.max_cloud))
+        # The R*Tree only compares bounding boxes; the exact test runs on the few candidates
+        return [json.loads(product) for product, footprint in rows if wkt.loads(footprint).intersects(aoi)]
+
+    def coveredDays(self, query):
+        # Days already searched for this product type with a cloud limit at least as loose
+        # and an AOI containing this one
+        aoi = self.geometry(query.aoi)
+        rows = self.db.execute(
+            "SELECT aoi, day FROM coverage WHERE product_type = ? AND max_cloud >= ? AND day >= ? AND day < ?",
+            (query.product_type, query.max_cloud, query.start.isoformat(), query.end.isoformat()))
+        return {date.fromisoformat(day) for stored, day in rows if self.geometry(stored).contains(aoi)}
+
+    def markCovered(self, query, days):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO coverage VALUES (?, ?, ?, ?)",
+                                [(query.product_type, query.max_cloud, query.aoi, day.isoformat()) for day in days])
+
+    def close(self):
+        self.db.close()
+
+def dayRuns(days):
+    # Consecutive runs of sorted days as (first day, day after the last) pairs
+    runs = []
+    for day in days:
+        if runs and runs[-1][1] == day:
+            runs[-1][1] = day + timedelta(days=1)
+        else:
+            runs.append([day, day + timedelta(days=1)])
+    return [tuple(run) for run in runs]
+
+class CatalogueSearch:
+    # Serves searches from the local index and asks the catalogue only for the days the
+    # index does not hold yet, following @odata.nextLink through every result page
+    def __init__(self, index=None, session=None, status=None):
+        self.index = index or CatalogueIndex()
+        self.session = session or requests.Session()
+        self.status = status or print
+
+    def fetch(self, query, start, end):
+        params = {"$filter": query.odataFilter(start, end), "$orderby": "ContentDate/Start asc",
+                  "$top": CATALOGUE_PAGE_SIZE, "$expand": "Attributes"}
+        url = CATALOGUE_URL
+        while url:
+            r = self.session.get(url, params=params)
+            r.raise_for_status()
+            page = r.json()
+            yield page["value"]
+            # The next link already carries the query
+            url = page.get("@odata.nextLink")
+            params = None
+
+    def search(self, query):
+        covered = self.index.coveredDays(query)
+        missing = [day for day in query.days() if day not in covered]
+        settled = date.today() - timedelta(days=CATALOGUE_RECENT_DAYS)
+        for start, end in dayRuns(missing):
+            self.status(f"Searching the catalogue from {start} to {end}...")
+            for products in self.fetch(query, start, end):
+                self.index.insert(products)
+            self.index.markCovered(query, [day for day in query.days() if start <= day < end and day < settled])
+        return self.index.search(query)
+
+class DownloadManager:
+    # Downloads products on a bounded pool of workers sharing one pooled session and one
+    # token. Products stream to a .part file in chunks, resume with HTTP Range requests
+    # after an interruption and are checked against the catalogue checksum before the
+    # final .zip appears.
+    def __init__(self, username, password, directory=".", workers=DOWNLOAD_WORKERS,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, status=None):
+        self.directory = directory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.status = status or print
+
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=("GET", "POST"))
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers * 2, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.token = KeycloakToken(self.session, username, password)
+
+    def open(self, url, offset):
+        # Follow redirects by hand so the Authorization header survives the hop to the download host
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {self.token.get()}"}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+            response = self.session.get(url, headers=headers, allow_redirects=False, stream=True)
+            while response.status_code in (301, 302, 303, 307, 308):
+                location = response.headers["Location"]
+                response.close()
+                response = self.session.get(location, headers=headers, allow_redirects=False, stream=True)
+            if response.status_code == 401 and attempt == 0:
+                response.close()
+                self.token.invalidate()
+                continue
+            return response
+        return response
+
+    @profiler.timed('download')
+    def download(self, product):
+        name = product["Name"]
+        file_path = os.path.join(self.directory, productFileName(product))
+        part_path = file_path + ".part"
+        if os.path.exists(file_path):
+            return file_path
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        url = f"{CATALOGUE_URL}({product['Id']})/$value"
+        response = self.open(url, offset)
+        try:
+            if response.status_code == 416:
+                # Range past the end: the partial file is already complete
+                pass
+            elif response.status_code == 206:
+                self.status(f"Resuming {name} at {offset // (1024 * 1024)} MB...")
+                self.writeChunks(response, part_path, "ab")
+            elif response.status_code == 200:
+                # Either a fresh download or a server that ignored the Range header
+                self.status(f"Downloading {name}...")
+                self.writeChunks(response, part_path, "wb")
+            else:
+                raise Exception(f"HTTP {response.status_code}: {response.text[:200]}")
+        finally:
+            response.close()
+
+        checksum = productChecksum(product)
+        if checksum is not None:
+            algorithm, expected = checksum
+            actual = fileDigest(part_path, algorithm)
+            if actual != expected:
+                os.remove(part_path)
+                raise Exception(f"{algorithm} checksum mismatch (expected {expected}, got {actual})")
+
+        os.replace(part_path, file_path)
+        return file_path
+
+    def writeChunks(self, response, part_path, mode):
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    f.write(chunk)
+
+    def downloadAll(self, products):
+        # Returns {product name: file path, or the exception that stopped it}
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.download, product): product for product in products}
+            for future in futures:
+                name = futures[future]["Name"]
+                try:
+                    results[name] = future.result()
+                    self.status(f"Downloaded {name}.")
+                except Exception as e:
+                    results[name] = e
+                    self.status(f"Problem downloading {name}: {e}")
+        return results
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,276 @@
+# Persistent, content-addressed cache of rendered planes, stretch limits and index rasters
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+import numpy as np
+
+# Where cached entries live unless set otherwise; RASTER_ANALYSIS_CACHE=off disables the cache
+DISK_CACHE_DIR = os.environ.get('RASTER_ANALYSIS_CACHE') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'raster_analysis')
+
+# Size cap of all entries together; eviction frees space down to DISK_CACHE_LOW_WATER of it
+DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+DISK_CACHE_LOW_WATER = 0.9
+
+# Entries larger than this fraction of the cap are not kept, so that one big raster
+# cannot flush everything else
+MAX_ENTRY_FRACTION = 0.25
+
+# Last-access times are only rewritten when older than this, which keeps cache hits
+# from turning into index writes
+ACCESS_RESOLUTION_SECONDS = 60.0
+
+# How long an index write waits for another process holding the database lock
+INDEX_TIMEOUT_SECONDS = 30.0
+
+INDEX_NAME = 'index.sqlite'
+
+# Part of every key; raising it retires all entries written by older versions, whose
+# contents may differ (planes before invalid pixels were given their own code, for one)
+CACHE_VERSION = 2
+
+def fileFingerprint(file_path):
+    # (path, size, mtime in ns) of a file, or of the archive of a band inside a .zip;
+    # None when the file cannot be found. A rewritten file gets a new fingerprint, so its
+    # old entries are never served and age out of the cache.
+    member = ''
+    path = file_path
+    if path.startswith('/vsizip/'):
+        path = path[len('/vsizip/'):]
+        end = path.lower().index('.zip') + len('.zip')
+        path, member = path[:end], path[end:]
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path) + member, stat.st_size, stat.st_mtime_ns)
+
+def sourceFingerprint(source_key):
+    # Render graph source keys are a name, with any parameters, followed by the keys of the
+    # bands they are computed from, and band keys start with their file path. The
+    # fingerprint replaces every path with the file's fingerprint; None if a file is gone.
+    bands = []
+    for band_key in source_key[1:]:
+        fingerprint = fileFingerprint(band_key[0])
+        if fingerprint is None:
+            return None
+        bands.append((fingerprint,) + tuple(band_key[1:]))
+    return (source_key[0],) + tuple(bands)
+
+def cacheKey(*parts):
+    # Hex digest naming an entry; parts are tuples of plain values with a stable repr
+    return hashlib.sha256(repr((CACHE_VERSION,) + parts).encode('utf-8')).hexdigest()
+
+def closeConnections(connections):
+    for connection in connections:
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+    connections.clear()
+
+class DiskCache:
+    # Entries are files named by their key under directory, with an sqlite index of their
+    # sizes and last-access times for the size cap and LRU eviction. Files are written
+    # under a temporary name and moved into place with os.replace, so readers in any
+    # thread or process see either the whole entry or none; a file evicted by another
+    # process between lookup and read is a miss. Failures of the disk (full, read-only,
+    # locked for too long) are misses too, never errors: everything here can be recomputed.
+    def __init__(self, directory=DISK_CACHE_DIR, max_bytes=DISK_CACHE_BYTES):
+        self.directory = None if directory == 'off' else directory
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._unchecked_bytes = 0
+        self._lock = threading.Lock()
+        # Every thread's connection, so that all of them are closed when the directory
+        # changes and at exit; a thread whose connection is older than _generation reconnects
+        self._connections = []
+        self._generation = 0
+        self._finalizer = weakref.finalize(self, closeConnections, self._connections)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def connection(self):
+        # One connection per thread and directory; a connection is only ever used by the
+        # thread that opened it, but may be closed from another
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.generation == self._generation:
+            return connection
+        generation = self._generation
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(os.path.join(self.directory, INDEX_NAME), timeout=INDEX_TIMEOUT_SECONDS,
+                                     isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._connections.append(connection)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(key TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._local.connection = connection
+        self._local.generation = generation
+        return connection
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        # Path of a cached entry, or None
+        if not self.enabled or key is None:
+            return None
+        try:
+            connection = self.connection()
+            row = connection.execute('SELECT accessed FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            path = self.entryPath(key)
+            if not os.path.exists(path):
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            now = time.time()
+            if now - row[0] > ACCESS_RESOLUTION_SECONDS:
+                connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            return path
+        except (OSError, sqlite3.Error):
+            return None
+
+    def store(self, key, write, size_hint=0):
+        # write(path) creates the entry's file at path, a temporary name next to its final one
+        if not self.enabled or key is None or size_hint > self.max_bytes * MAX_ENTRY_FRACTION:
+            return False
+        path = self.entryPath(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=key[:8], suffix='.tmp', dir=os.path.dirname(path))
+            os.close(fd)
+            write(tmp_path)
+            size = os.path.getsize(tmp_path)
+            if size > self.max_bytes * MAX_ENTRY_FRACTION:
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, path)
+            tmp_path = None
+            self.connection().execute('INSERT OR REPLACE INTO entries (key, size, accessed) VALUES (?, ?, ?)',
+                                      (key, size, time.time()))
+        except (OSError, sqlite3.Error):
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        # The total is summed from the index only after writes worth about 1 % of the cap
+        with self._lock:
+            self._unchecked_bytes += size
+            check = self._unchecked_bytes > self.max_bytes / 100
+            if check:
+                self._unchecked_bytes = 0
+        if check:
+            self.evict()
+        return True
+
+    def evict(self, max_bytes=None):
+        # Least recently used entries go until the total is under the low-water mark. The
+        # index is locked while they are chosen, so processes evicting at once do not both
+        # delete for the same excess.
+        if not self.enabled:
+            return
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = []
+        try:
+            connection = self.connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if total > max_bytes:
+                    excess = total - max_bytes * DISK_CACHE_LOW_WATER
+                    for key, size in connection.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+                        if excess <= 0:
+                            break
+                        evicted.append(key)
+                        excess -= size
+                    connection.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+        except (OSError, sqlite3.Error):
+            return
+        for key in evicted:
+            try:
+                os.remove(self.entryPath(key))
+            except OSError:
+                pass  # Already gone, or still open elsewhere (Windows)
+
+    def getArray(self, key):
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            return np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def putArray(self, key, array):
+        def write(path):
+            with open(path, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+        return self.store(key, write, array.nbytes)
+
+    def getFile(self, key, dst_path):
+        # Copies a cached file to dst_path; False on a miss
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, dst_path)
+            return True
+        except OSError:
+            return False
+
+    def putFile(self, key, src_path):
+        try:
+            size = os.path.getsize(src_path)
+        except OSError:
+            return False
+        return self.store(key, lambda path: shutil.copyfile(src_path, path), size)
+
+    def usage(self):
+        # (entries, bytes) in the cache
+        if not self.enabled:
+            return 0, 0
+        try:
+            return tuple(self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone())
+        except (OSError, sqlite3.Error):
+            return 0, 0
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def setDirectory(self, directory):
+        # None disables the cache; entries in the previous directory stay on disk
+        self.directory = directory or None
+        self.close()
+
+    def close(self):
+        # Closes the index in every thread; the next lookup or store reopens it
+        with self._lock:
+            self._generation += 1
+            closeConnections(self._connections)
+
+    def setMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+disk_cache = DiskCache()
@@ -0,0 +1,252 @@
+# Earth Engine scripts: server-side reductions, batch task polling and parallel tiled
+# downloads into local COGs. The ee module is always passed in, never imported here, so
+# scripts run against an initialized client or against a stand-in with the same API.
+
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from .export import CogOptions, CogWriter
+from .profiling import profiler
+
+# Edge of the tiles images are fetched in; computePixels serves at most 48 MB per request
+EE_TILE_SIZE = 1024
+
+# Tile requests of one download in flight at once
+EE_DOWNLOAD_WORKERS = 8
+
+# Retries of a failed request that may succeed later, and the first wait before one,
+# doubled with every further retry
+EE_RETRIES = 5
+EE_BACKOFF_SECONDS = 1.0
+
+# Longest wait between two polls of a batch task
+EE_MAX_POLL_SECONDS = 60.0
+
+# HTTP statuses of requests worth retrying: rate limits and server errors
+TRANSIENT_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# Exception classes of failed connections and timeouts, by name so that requests' and
+# urllib3's own hierarchies count without importing them
+TRANSIENT_TYPES = ('Timeout', 'ConnectTimeout', 'ReadTimeout', 'ConnectionError', 'ChunkedEncodingError')
+
+# ee.EEException carries no status, only the server's message; these start the messages
+# of rate limits and server-side timeouts
+TRANSIENT_EE_MESSAGES = ('too many concurrent aggregations', 'too many requests', 'computation timed out',
+                         'service unavailable', 'internal error')
+
+def httpStatus(error):
+    # Status code of a failed HTTP request (requests, googleapiclient, urllib), or None
+    response = getattr(error, 'response', None)
+    for status in (getattr(response, 'status_code', None), getattr(getattr(error, 'resp', None), 'status', None),
+                   getattr(error, 'status_code', None), getattr(error, 'code', None)):
+        if status is None:
+            continue
+        try:
+            return int(status)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def isTransient(error):
+    # Whether a failed request may succeed when retried. Errors with a status are judged by
+    # it alone, so a 404 is never retried whatever its message says.
+    status = httpStatus(error)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if any(cls.__name__ in TRANSIENT_TYPES for cls in type(error).__mro__):
+        return True
+    if type(error).__name__ == 'EEException':
+        return str(error).strip().lower().startswith(TRANSIENT_EE_MESSAGES)
+    return False
+
+def withBackoff(function, retries=EE_RETRIES, delay=EE_BACKOFF_SECONDS, sleep=time.sleep):
+    # function(), retried with exponentially growing waits while it fails transiently
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == retries or not isTransient(e):
+                raise
+            sleep(delay * 2 ** attempt)
+
+def waitForTask(task, status=print, delay=EE_BACKOFF_SECONDS, max_delay=EE_MAX_POLL_SECONDS, sleep=time.sleep):
+    # Polls a started batch task (ee.batch.Task) until it ends, waiting longer between polls
+    # the longer it runs. Returns its final status; raises if it failed or was cancelled.
+    last_state = None
+    while True:
+        task_status = withBackoff(task.status, sleep=sleep)
+        state = task_status.get('state')
+        if state != last_state:
+            status(f"Task {task_status.get('description', task_status.get('id', ''))}: {state}")
+            last_state = state
+        if state in ('COMPLETED', 'SUCCEEDED'):
+            return task_status
+        if state in ('FAILED', 'CANCELLED', 'CANCEL_REQUESTED'):
+            raise RuntimeError(f"Earth Engine task {state.lower()}: {task_status.get('error_message', '')}")
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def regionStats(ee, image, geometry, scale, reducer=None):
+    # Statistics of an image over a region, reduced on the server: only the numbers come
+    # back, never the pixels. Mean, standard deviation, min and max of every band by default.
+    if reducer is None:
+        reducer = (ee.Reducer.mean()
+                   .combine(ee.Reducer.stdDev(), sharedInputs=True)
+                   .combine(ee.Reducer.minMax(), sharedInputs=True))
+    reduction = image.reduceRegion(reducer=reducer, geometry=geometry, scale=scale, maxPixels=1e13, bestEffort=True)
+    return withBackoff(reduction.getInfo)
+
+class TiledDownload:
+    # Fetches an ee.Image over bounds (west, south, east, north, in crs) at scale (crs units
+    # per pixel) as tiles of computed pixels, several requests at a time, and writes them
+    # into a COG from the calling thread as they arrive. Uses ee.data.computePixels, which
+    # returns arrays directly, or getDownloadURL with older clients.
+    def __init__(self, ee, image, bounds, crs, scale, out_path, bands=None, tile_size=EE_TILE_SIZE,
+                 workers=EE_DOWNLOAD_WORKERS, options=None, status=print):
+        self.ee = ee
+        self.image = image
+        self.crs = crs
+        self.out_path = out_path
+        self.bands = bands
+        self.tile_size = tile_size
+        self.workers = workers
+        self.options = options or CogOptions()
+        self.status = status
+
+        west, south, east, north = bounds
+        self.transform = Affine(scale, 0.0, west, 0.0, -scale, north)
+        self.width = max(1, int(math.ceil((east - west) / scale)))
+        self.height = max(1, int(math.ceil((north - south) / scale)))
+
+    def tiles(self):
+        # Window of every tile, row by row
+        return [Window(col_off, row_off, min(self.tile_size, self.width - col_off),
+                       min(self.tile_size, self.height - row_off))
+                for row_off in range(0, self.height, self.tile_size)
+                for col_off in range(0, self.width, self.tile_size)]
+
+    def tileTransform(self, col_off, row_off):
+        return self.transform * Affine.translation(col_off, row_off)
+
+    @profiler.timed('download.ee')
+    def fetchTile(self, tile):
+        # (bands, height, width) array of one tile
+        width, height = int(tile.width), int(tile.height)
+        transform = self.tileTransform(int(tile.col_off), int(tile.row_off))
+        if hasattr(self.ee.data, 'computePixels'):
+            pixels = withBackoff(lambda: self.ee.data.computePixels({
+                'expression': self.image,
+                'fileFormat': 'NUMPY_NDARRAY',
+                'bandIds': self.bands,
+                'grid': {
+                    'dimensions': {'width': width, 'height': height},
+                    'affineTransform': {'scaleX': transform.a, 'shearX': transform.b, 'translateX': transform.c,
+                                        'shearY': transform.d, 'scaleY': transform.e, 'translateY': transform.f},
+                    'crsCode': self.crs,
+                },
+            }))
+            return np.stack([pixels[name] for name in pixels.dtype.names])
+
+        import requests  # Only older clients without computePixels download through URLs
+        from rasterio.io import MemoryFile
+
+        url = withBackoff(lambda: self.image.getDownloadURL({
+            'bands': self.bands, 'crs': self.crs, 'crs_transform': list(transform)[:6],
+            'dimensions': f"{width}x{height}", 'format': 'GEO_TIFF',
+        }))
+
+        def download():
+            response = requests.get(url, timeout=300)
+            response.raise_for_status()
+            return response.content
+
+        with MemoryFile(withBackoff(download)) as memory, memory.open() as src:
+            return src.read()
+
+    def run(self, progress=None):
+        if self.bands is None:
+            self.bands = withBackoff(self.image.bandNames().getInfo)
+        tiles = deque(self.tiles())
+        total = len(tiles)
+
+        # The first tile fixes the data type of the file
+        first = tiles.popleft()
+        data = self.fetchTile(first)
+        profile = {'driver': 'GTiff', 'dtype': data.dtype.name, 'count': data.shape[0], 'crs': self.crs,
+                   'transform': self.transform, 'width': self.width, 'height': self.height}
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            with CogWriter(self.out_path, profile, self.options) as dst:
+                dst.write(data, window=first)
+                done = 1
+                if progress is not None:
+                    progress(done, total)
+                in_flight = {}
+                while tiles or in_flight:
+                    while tiles and len(in_flight) < self.workers * 2:
+                        tile = tiles.popleft()
+                        in_flight[pool.submit(self.fetchTile, tile)] = tile
+                    completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        dst.write(future.result(), window=in_flight.pop(future))
+                        done += 1
+                        if progress is not None:
+                            progress(done, total)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.status(f"Wrote {self.out_path}")
+        return self.out_path
+
+def describe(value):
+    try:
+        return json.dumps(value, indent=2, default=str)
+    except (TypeError, ValueError):
+        return str(value)
+
+def runScript(script, ee, directory='.', status=print, download_workers=EE_DOWNLOAD_WORKERS):
+    # Executes a user script against ee. Besides ee the script can use:
+    #   print(...)                                  reported through status
+    #   regionStats(image, geometry, scale)         statistics reduced on the server
+    #   download(image, name, bounds, scale, crs='EPSG:4326', bands=None)
+    #                                               the image as a local COG; returns its path
+    #   runTask(task)                               starts a batch export and waits for it
+    # A value the script assigns to `result` is computed on the server and reported.
+    # Returns the paths of the downloaded images.
+    outputs = []
+
+    def download(image, name, bounds, scale, crs='EPSG:4326', bands=None):
+        path = os.path.join(directory, f"{name}.tif")
+        status(f"Downloading {name}...")
+        TiledDownload(ee, image, bounds, crs, scale, path, bands, workers=download_workers, status=status).run()
+        outputs.append(path)
+        return path
+
+    def runTask(task):
+        task.start()
+        return waitForTask(task, status)
+
+    namespace = {
+        'ee': ee,
+        'print': lambda *values: status(" ".join(str(value) for value in values)),
+        'regionStats': lambda image, geometry, scale, reducer=None: regionStats(ee, image, geometry, scale, reducer),
+        'download': download,
+        'runTask': runTask,
+    }
+    exec(compile(script, '<script>', 'exec'), namespace)
+
+    result = namespace.get('result')
+    if result is not None:
+        if hasattr(result, 'getInfo'):
+            result = withBackoff(result.getInfo)
+        status(describe(result))
+    return outputs
@@ -0,0 +1,137 @@
+# GeoTIFF exports of loaded bands and computed products
+
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.shutil import copy as copyDataset
+
+from .profiling import profiler
+
+# Defaults for Cloud-Optimized GeoTIFF output
+COG_COMPRESSION = 'DEFLATE'
+COG_BLOCK_SIZE = 512
+COG_COMPRESSIONS = ['DEFLATE', 'ZSTD', 'LZW']
+
+@profiler.timed('export.cog')
+def translateToCog(src_path, dst_path, compress=COG_COMPRESSION, num_threads='ALL_CPUS', predictor=True,
+                   block_size=COG_BLOCK_SIZE, overview_resampling='AVERAGE'):
+    # Rewrites a GeoTIFF as a Cloud-Optimized GeoTIFF: tiled, compressed with a predictor
+    # and with internal overviews, so later partial reads only touch the blocks they need
+    copyDataset(src_path, dst_path, driver='COG', COMPRESS=compress, PREDICTOR='YES' if predictor else 'NO',
+                BLOCKSIZE=block_size, OVERVIEWS='AUTO', RESAMPLING=overview_resampling,
+                NUM_THREADS=str(num_threads), BIGTIFF='IF_SAFER')
+    return dst_path
+
+class CogOptions:
+    # How a product is written as a COG. dtype is the stored type (default: the product's);
+    # integer outputs store round(value * scale), clipped to the type's range, with the
+    # inverse scale recorded in the file so readers get the original units back.
+    def __init__(self, compress=COG_COMPRESSION, predictor=True, dtype=None, scale=1.0, nodata=None,
+                 num_threads='ALL_CPUS', block_size=COG_BLOCK_SIZE, overview_resampling='AVERAGE'):
+        if compress.upper() not in COG_COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compress}; choose from {', '.join(COG_COMPRESSIONS)}")
+        self.compress = compress.upper()
+        self.predictor = predictor
+        self.dtype = dtype
+        self.scale = scale
+        self.nodata = nodata
+        self.num_threads = num_threads
+        self.block_size = block_size
+        self.overview_resampling = overview_resampling
+
+class CogWriter:
+    # Streams blocks of any product into a COG. GDAL only builds COGs by copying a finished
+    # dataset, so blocks first go into a tiled, compressed scratch GeoTIFF next to the
+    # output, which close() translates into the COG layout with internal overviews.
+    # Behaves like the rasterio dataset it wraps for block_windows() and write().
+    def __init__(self, dst_path, profile, options=None):
+        self.dst_path = dst_path
+        self.options = options or CogOptions()
+        self.dtype = np.dtype(self.options.dtype or profile['dtype'])
+        self.nodata = self.options.nodata if self.options.nodata is not None else profile.get('nodata')
+        if self.dtype.kind in 'ui' and self.nodata is not None and np.isnan(self.nodata):
+            self.nodata = np.iinfo(self.dtype).min if self.dtype.kind == 'i' else np.iinfo(self.dtype).max
+
+        self.profile = dict(profile)
+        self.profile.update(driver='GTiff', dtype=self.dtype.name, nodata=self.nodata, tiled=True,
+                            blockxsize=self.options.block_size, blockysize=self.options.block_size,
+                            compress=self.options.compress, interleave='band', BIGTIFF='IF_SAFER',
+                            NUM_THREADS=str(self.options.num_threads))
+        if self.options.predictor:
+            self.profile['predictor'] = 3 if self.dtype.kind == 'f' else 2
+        self.profile.pop('photometric', None)
+
+        handle, self.tmp_path = tempfile.mkstemp(suffix='.tif', prefix='.export_',
+                                                 dir=os.path.dirname(os.path.abspath(dst_path)))
+        os.close(handle)
+        self._dst = rasterio.open(self.tmp_path, 'w', **self.profile)
+        if self.dtype.kind in 'ui' and self.options.scale != 1.0:
+            self._dst.scales = tuple(1.0 / self.options.scale for _ in range(self._dst.count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def count(self):
+        return self._dst.count
+
+    def block_windows(self, bidx=0):
+        return self._dst.block_windows(bidx)
+
+    def convert(self, data):
+        if data.dtype == self.dtype:
+            return data
+        if self.dtype.kind not in 'ui':
+            return data.astype(self.dtype)
+        values = data.astype(np.float64)
+        if self.options.scale != 1.0:
+            values *= self.options.scale
+        # NaN and infinite values become nodata while still floats, since casting them is undefined
+        info = np.iinfo(self.dtype)
+        np.rint(values, out=values)
+        values[~np.isfinite(values)] = self.nodata if self.nodata is not None else 0
+        np.clip(values, info.min, info.max, out=values)
+        return values.astype(self.dtype)
+
+    def write(self, data, indexes=None, window=None):
+        self._dst.write(self.convert(np.asarray(data)), indexes, window=window)
+
+    def close(self):
+        self._dst.close()
+        try:
+            translateToCog(self.tmp_path, self.dst_path, self.options.compress, self.options.num_threads,
+                           self.options.predictor, self.options.block_size, self.options.overview_resampling)
+        finally:
+            os.remove(self.tmp_path)
+
+    def abort(self):
+        self._dst.close()
+        os.remove(self.tmp_path)
+
+def openOutput(out_path, profile, cog=None):
+    # Plain GeoTIFF with the given profile, or a COG when cog options are given
+    if cog is None:
+        return rasterio.open(out_path, 'w', **profile)
+    return CogWriter(out_path, profile, cog)
+
+def exportBands(bands, dst_path, options=None, progress=None):
+    # Writes bands sharing one grid (TiledBands, e.g. the loaded channels) as a multi-band
+    # COG, one output block at a time
+    reference = bands[0]
+    profile = dict(reference.profile, count=len(bands), dtype=reference.dtype.name, nodata=reference.nodata)
+    with profiler.span('export'), CogWriter(dst_path, profile, options) as dst:
+        windows = [window for _, window in dst.block_windows(1)]
+        for done, window in enumerate(windows, start=1):
+            for index, band in enumerate(bands, start=1):
+                dst.write(band.readWindow(window), index, window=window)
+            if progress is not None:
+                progress(done, len(windows))
+    return dst_path
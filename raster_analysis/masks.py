@@ -0,0 +1,103 @@
+# Validity masks from dataset masks, nodata values and the Sentinel-2 scene classification
+
+import numpy as np
+from rasterio.enums import MaskFlags
+
+from .tiles import TiledBand, block_cache, fileMtime
+
+# Scene classification (SCL) classes of L2A products that are not usable surface: no data,
+# cloud shadows, medium and high probability clouds and thin cirrus
+SCL_NODATA_CLASSES = (0,)
+SCL_CLOUD_CLASSES = (3, 8, 9, 10)
+SCL_MASKED_CLASSES = SCL_NODATA_CLASSES + SCL_CLOUD_CLASSES
+
+# How much of a block its mask keeps
+BLOCK_EMPTY, BLOCK_PARTIAL, BLOCK_FULL = 0, 1, 2
+
+def hasMaskBand(band):
+    # Whether a band's validity is stored apart from its values, in a GDAL mask band or an
+    # alpha band. Plain nodata values are compared against the data wherever it is read.
+    flags = band.mask_flags
+    return MaskFlags.per_dataset in flags or MaskFlags.alpha in flags
+
+def invalidPixels(block, nodata=None, out=None):
+    # Pixels equal to the nodata value, and non-finite ones of float blocks
+    if out is None:
+        out = np.zeros(block.shape, dtype=bool)
+    else:
+        out[...] = False
+    if nodata is not None and not np.isnan(nodata):
+        np.equal(block, nodata, out=out)
+    if block.dtype.kind == 'f':
+        out |= ~np.isfinite(block)
+    return out
+
+def maskedClasses(classes, masked_classes=SCL_MASKED_CLASSES):
+    return np.isin(classes, masked_classes)
+
+def packMask(valid):
+    # One bit per pixel
+    return np.packbits(valid, axis=None)
+
+def unpackMask(packed, shape):
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).view(bool)
+
+class BandMask:
+    # Which pixels of a window are valid for a set of bands sharing one grid: those their
+    # mask bands keep and, given a scene classification band as (file path, band index),
+    # those it does not put in masked_classes. The classification is resampled onto the
+    # bands' grid by nearest neighbour, since its values are categories. Masks of the
+    # windows asked for are kept bit-packed in the block cache behind a coverage byte, so
+    # a window known to be fully masked costs nothing the next time and its bands are
+    # never read. They are keyed by the files and their mtimes and outlive the BandMask:
+    # the next pass over the same files (another statistics run, index or composite
+    # worker) reuses them until the cache evicts them.
+    def __init__(self, bands, scl_source=None, masked_classes=SCL_MASKED_CLASSES, cache=None):
+        bands = list(bands)
+        self.cache = cache if cache is not None else block_cache
+        self.bands = [band for band in bands if hasMaskBand(band)]
+        self.masked_classes = tuple(masked_classes)
+        self.scl = None
+        if scl_source is not None:
+            path, band_index = scl_source
+            self.scl = TiledBand(path, band_index, self.cache, bands[0].grid, 'nearest')
+        self.key = ('mask', tuple((band.key, fileMtime(band.file_path)) for band in self.bands),
+                    (self.scl.key, fileMtime(self.scl.file_path)) if self.scl is not None else None,
+                    self.masked_classes)
+
+    @property
+    def active(self):
+        return bool(self.bands) or self.scl is not None
+
+    def computeWindow(self, window):
+        valid = np.ones((int(window.height), int(window.width)), dtype=bool)
+        for band in self.bands:
+            valid &= band.readMask(window) != 0
+        if self.scl is not None:
+            valid &= ~maskedClasses(self.scl.read(window), self.masked_classes)
+        return valid
+
+    def window(self, window):
+        # (coverage, valid): valid is a bool array for partially masked windows, else None
+        height, width = int(window.height), int(window.width)
+        key = (self.key, int(window.col_off), int(window.row_off), width, height)
+        packed = self.cache.get(key)
+        if packed is None:
+            valid = self.computeWindow(window)
+            coverage = BLOCK_FULL if valid.all() else BLOCK_EMPTY if not valid.any() else BLOCK_PARTIAL
+            bits = packMask(valid) if coverage == BLOCK_PARTIAL else np.empty(0, dtype=np.uint8)
+            packed = np.concatenate((np.array([coverage], dtype=np.uint8), bits))
+            self.cache.put(key, packed)
+        coverage = int(packed[0])
+        if coverage != BLOCK_PARTIAL:
+            return coverage, None
+        return coverage, unpackMask(packed[1:], (height, width))
+
+    def close(self):
+        if self.scl is not None:
+            self.scl.close()
+
+def openMask(bands, scl_source=None, masked_classes=SCL_MASKED_CLASSES, cache=None):
+    # BandMask of the bands, or None when nothing about them is masked beyond nodata values
+    mask = BandMask(bands, scl_source, masked_classes, cache)
+    return mask if mask.active else None
@@ -0,0 +1,153 @@
+# Streaming search -> download -> open -> index -> COG export pipeline
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from .bandmath import INDICES, ParallelBandMath
+from .copernicus import CatalogueSearch, DownloadManager, DOWNLOAD_WORKERS, productFileName
+from .export import translateToCog
+from .safe import SafeProduct, CHANNEL_BANDS
+from .tiles import DEFAULT_RESAMPLING
+
+# Items waiting between two stages; small, so a fast stage waits for a slow one instead of
+# piling up downloads on disk
+PIPELINE_QUEUE_SIZE = 2
+
+# Band names mapped to Sentinel-2 bands for each index. NDRE needs the 20 m red edge, so
+# it is paired with the 20 m narrow NIR and both share one grid.
+INDEX_BANDS = {'NDRE': {'rededge': 'B05', 'nir': 'B8A'}}
+
+# Marks the end of a stage's input
+DONE = object()
+
+def indexSafeBands(index):
+    bands = INDEX_BANDS.get(index, CHANNEL_BANDS)
+    return {name: bands[name] for name in INDICES[index][0]}
+
+class Pipeline:
+    # Runs search -> download -> open -> index -> COG export with every stage on its own
+    # threads and bounded queues in between, so downloads and compute of different products
+    # overlap. Bands are read from the archives in place through /vsizip/, which decompresses
+    # them block by block as the index is computed. Needs no display and no Qt.
+    def __init__(self, query, index, output_dir, username, password, download_dir=None, work_dir=None,
+                 download_workers=DOWNLOAD_WORKERS, compute_workers=None, queue_size=PIPELINE_QUEUE_SIZE,
+                 resampling=DEFAULT_RESAMPLING, mask_clouds=False, status=None):
+        if index not in INDICES:
+            raise ValueError(f"Unknown index {index}; choose from {', '.join(INDICES)}")
+        self.query = query
+        self.index = index
+        self.output_dir = output_dir
+        self.username = username
+        self.password = password
+        self.download_dir = download_dir or output_dir
+        self.work_dir = work_dir
+        self.download_workers = download_workers
+        self.compute_workers = compute_workers
+        self.queue_size = queue_size
+        self.resampling = resampling
+        self.mask_clouds = mask_clouds
+        self.status = status or print
+        self.results = {}
+        self._results_lock = threading.Lock()
+
+    def record(self, product, result):
+        with self._results_lock:
+            self.results[product["Name"]] = result
+
+    def startStage(self, name, function, inbox, outbox, workers=1):
+        # Each worker takes (product, payload) items until DONE; the last one to stop passes DONE on
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                item = inbox.get()
+                if item is DONE:
+                    inbox.put(DONE)  # Let sibling workers see it too
+                    break
+                product, payload = item
+                try:
+                    result = function(product, payload)
+                except Exception as e:
+                    self.status(f"{name} failed for {product['Name']}: {e}")
+                    self.record(product, e)
+                    continue
+                if outbox is None:
+                    self.record(product, result)
+                else:
+                    outbox.put((product, result))
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                outbox.put(DONE)
+
+        threads = [threading.Thread(target=work, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        os.makedirs(self.download_dir, exist_ok=True)
+        work_dir = self.work_dir or tempfile.mkdtemp(prefix="raster_analysis_")
+        os.makedirs(work_dir, exist_ok=True)
+
+        manager = DownloadManager(self.username, self.password, self.download_dir,
+                                  workers=self.download_workers, status=self.status)
+        bands = indexSafeBands(self.index)
+
+        def download(product, _):
+            return manager.download(product)
+
+        def openProduct(product, zip_path):
+            return SafeProduct(zip_path)
+
+        def compute(product, safe):
+            sources = {name: (safe.bandPath(band_id), 1) for name, band_id in bands.items()}
+            scale, offset = safe.reflectance(next(iter(bands.values())))
+            out_path = os.path.join(work_dir, f"{productFileName(product)[:-len('.zip')]}_{self.index}.tif")
+            # L2A products carry a scene classification to mask clouds with; L1C products do not
+            scl_path = safe.classificationPath() if self.mask_clouds else None
+            ParallelBandMath(sources, scale, self.compute_workers, reflectance_offset=offset,
+                             resampling=self.resampling,
+                             scl_source=(scl_path, 1) if scl_path else None,
+                             default_nodata=safe.nodata).run(self.index, out_path)
+            return out_path
+
+        def export(product, tif_path):
+            cog_path = os.path.join(self.output_dir, os.path.basename(tif_path))
+            try:
+                translateToCog(tif_path, cog_path)
+            finally:
+                os.remove(tif_path)
+            self.status(f"Wrote {cog_path}")
+            return cog_path
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        threads = []
+        threads += self.startStage("Download", download, queues[0], queues[1], self.download_workers)
+        threads += self.startStage("Open", openProduct, queues[1], queues[2])
+        # Compute is already parallel across blocks; one product at a time keeps all cores on it
+        threads += self.startStage("Index", compute, queues[2], queues[3])
+        threads += self.startStage("Export", export, queues[3], None)
+
+        search = CatalogueSearch(status=self.status)
+        try:
+            products = search.search(self.query)
+            self.status(f"Found {len(products)} product(s).")
+            for product in products:
+                queues[0].put((product, None))
+        finally:
+            queues[0].put(DONE)
+            search.index.close()
+
+        for thread in threads:
+            thread.join()
+        manager.close()
+        if not self.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return self.results
@@ -0,0 +1,111 @@
+# Timing spans and peak-memory counters around the raster hot paths
+
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class SpanStats:
+    # Calls of one span: how many, their total and longest wall time in seconds, and the
+    # largest rise of traced memory above its level at the start of a call, in bytes
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.peak_bytes = 0
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def toDict(self):
+        return {'count': self.count, 'total_s': self.total, 'mean_s': self.mean, 'max_s': self.longest,
+                'peak_bytes': self.peak_bytes}
+
+class Profiler:
+    # Named spans timed with perf_counter, cheap enough to stay on in the hot paths. With
+    # memory tracking on, tracemalloc (which also sees NumPy buffers) gives each call the
+    # peak of the traced heap while it ran. The peak counter is global, so it is reset at
+    # the start of every span after being credited to all spans still open, which keeps
+    # nested and concurrent spans right at the cost of some overhead.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stats = {}
+        self._open = []
+        self._lock = threading.Lock()
+
+    @property
+    def tracking_memory(self):
+        return tracemalloc.is_tracing()
+
+    def trackMemory(self, enabled):
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def creditPeak(self):
+        # Caller holds the lock
+        _, peak = tracemalloc.get_traced_memory()
+        for entry in self._open:
+            entry[1] = max(entry[1], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        entry = None
+        if tracemalloc.is_tracing():
+            with self._lock:
+                self.creditPeak()
+                entry = [tracemalloc.get_traced_memory()[0], 0]  # [memory at start, peak seen]
+                self._open.append(entry)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                peak = 0
+                if entry is not None and tracemalloc.is_tracing():
+                    self.creditPeak()
+                    peak = max(0, entry[1] - entry[0])
+                if entry is not None:
+                    self._open.remove(entry)
+                stats = self._stats.get(name)
+                if stats is None:
+                    stats = self._stats[name] = SpanStats()
+                stats.count += 1
+                stats.total += elapsed
+                stats.longest = max(stats.longest, elapsed)
+                stats.peak_bytes = max(stats.peak_bytes, peak)
+
+    def timed(self, name):
+        # Decorator running every call of a function in a span
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.toDict() for name, stats in sorted(self._stats.items())}
+
+    def exportJson(self, path):
+        with open(path, 'w') as f:
+            json.dump({'created': time.time(), 'memory_tracked': self.tracking_memory, 'spans': self.snapshot()},
+                      f, indent=2)
+        return path
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+profiler = Profiler()
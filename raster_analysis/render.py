@@ -0,0 +1,156 @@
+# Dependency-tracked render graph: cached stretched planes feeding composites
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .bandmath import ndviIndex
+from .diskcache import cacheKey, disk_cache, sourceFingerprint
+from .masks import invalidPixels, maskedClasses
+from .stretch import applyStretch, applyColormap
+
+# Stretched uint8 tile planes kept across composites and redraws
+PLANE_CACHE_BYTES = 256 * 1024 * 1024
+
+def bandSource(pyramid):
+    # Source node of one loaded band: (key, reader of (level, window))
+    return ('band', pyramid.band.key), pyramid.readLevel
+
+def ndviSource(red, nir, classification=None, reflectance=(1.0, 0.0)):
+    # Source node of the NDVI of two band pyramids. Pixel values become reflectance as
+    # (value + offset) * scale with reflectance = (scale, offset), as in index exports, which
+    # matters for products with a radiometric offset. Nodata pixels, pixels with a zero sum
+    # and, given the pyramid of a scene classification on their grid, clouds and shadows
+    # become NaN, which the stretch limits leave out and the colormap draws transparent.
+    scale, offset = (float(value) for value in reflectance)
+
+    def read(level, window=None):
+        red_level, nir_level = red.readLevel(level, window), nir.readLevel(level, window)
+        invalid = invalidPixels(red_level, red.band.nodata) | invalidPixels(nir_level, nir.band.nodata)
+        if classification is not None:
+            invalid |= maskedClasses(classification.readLevel(level, window))
+        ndvi = np.empty(red_level.shape, dtype=np.float32)
+        bands = {'red': red_level.astype(np.float32), 'nir': nir_level.astype(np.float32)}
+        for band in bands.values():
+            if offset:
+                np.add(band, offset, out=band)
+            if scale != 1.0:
+                np.multiply(band, scale, out=band)
+        ndviIndex(bands, ndvi, np.empty_like(ndvi), np.empty(ndvi.shape, dtype=bool))
+        ndvi[invalid] = np.nan
+        return ndvi
+
+    # The name carries the reflectance conversion, the band keys follow as in every source key
+    key = (('NDVI', scale, offset), red.band.key, nir.band.key)
+    if classification is not None:
+        key += (classification.band.key,)
+    return key, read
+
+class RenderGraph:
+    # The display as a graph of cached nodes. Sources are bands, or values derived from
+    # bands such as NDVI; a plane is a source stretched to uint8 with given limits; a layer
+    # is one plane per channel, or one plane through a colormap. Planes are cached per
+    # (level, tile window) under a key built from their inputs, so changing the band of one
+    # channel, a stretch or a colormap only misses what is downstream of the change:
+    # switching composites recomputes the channels that are new and reuses the others.
+    # With persist_planes, planes also go to the disk cache under the fingerprints of their
+    # files, so a scene reopened in a later session is shown without being read or
+    # stretched again. That costs a file and an index write per tile, which only pays off
+    # for scenes reopened often, so it is off by default. Fingerprints are taken once per
+    # source rather than per tile; invalidateBand() forgets them with the planes.
+    # Rendered layer tiles are cached by the GUI under layerKey().
+    def __init__(self, max_bytes=PLANE_CACHE_BYTES, disk=None, persist_planes=False):
+        self.max_bytes = max_bytes
+        self.disk = disk if disk is not None else disk_cache
+        self.persist_planes = persist_planes
+        self.nbytes = 0
+        self._planes = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def planeKey(source_key, limits):
+        return (source_key, tuple(float(limit) for limit in limits))
+
+    @staticmethod
+    def layerKey(kind, sources, stretch, colormap=None):
+        # Identifies a layer's tiles before its stretch limits are known: limits follow
+        # from the sources and the stretch rule, which is all the key needs to hold
+        return (kind, tuple(source_key for source_key, _ in sources), stretch, colormap)
+
+    @staticmethod
+    def dependsOn(layer_key, band_key):
+        # Source keys list the band keys they are computed from after their name
+        return any(band_key in source_key[1:] for source_key in layer_key[1])
+
+    def get(self, key):
+        with self._lock:
+            plane = self._planes.get(key)
+            if plane is not None:
+                self._planes.move_to_end(key)
+            return plane
+
+    def put(self, key, plane):
+        with self._lock:
+            old = self._planes.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._planes[key] = plane
+            self.nbytes += plane.nbytes
+            while self.nbytes > self.max_bytes and len(self._planes) > 1:
+                _, evicted = self._planes.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def plane(self, source, limits, level, window):
+        # Stretched uint8 plane of a source for one tile, computed at most once
+        source_key, read = source
+        key = (self.planeKey(source_key, limits), level, int(window.col_off), int(window.row_off),
+               int(window.width), int(window.height))
+        plane = self.get(key)
+        if plane is None:
+            disk_key = self.diskKey(key)
+            plane = self.disk.getArray(disk_key)
+            if plane is None:
+                plane = np.empty((int(window.height), int(window.width)), dtype=np.uint8)
+                applyStretch(read(level, window), limits[0], limits[1], plane)
+                self.disk.putArray(disk_key, plane)
+            self.put(key, plane)
+        return plane
+
+    def diskKey(self, key):
+        # Key of a plane in the disk cache, or None while planes are not persisted or a file is gone
+        if not self.persist_planes or not self.disk.enabled:
+            return None
+        (source_key, limits), *tile = key
+        fingerprint = self.fingerprint(source_key)
+        return None if fingerprint is None else cacheKey('plane', fingerprint, limits, *tile)
+
+    def fingerprint(self, source_key):
+        with self._lock:
+            if source_key in self._fingerprints:
+                return self._fingerprints[source_key]
+        fingerprint = sourceFingerprint(source_key)
+        with self._lock:
+            self._fingerprints[source_key] = fingerprint
+        return fingerprint
+
+    def colormapped(self, source, limits, colormap, level, window, out):
+        # Single-plane layer: the cached plane gathered through the colormap into uint32 RGBA
+        return applyColormap(self.plane(source, limits, level, window), colormap, out)
+
+    def invalidateBand(self, band_key):
+        # Drops every plane computed from a band that was closed or rewritten
+        with self._lock:
+            for key in [k for k in self._planes if band_key in k[0][0][1:]]:
+                self.nbytes -= self._planes.pop(key).nbytes
+            for source_key in [k for k in self._fingerprints if band_key in k[1:]]:
+                del self._fingerprints[source_key]
+
+    def clear(self):
+        with self._lock:
+            self._planes.clear()
+            self._fingerprints.clear()
+            self.nbytes = 0
+
+render_graph = RenderGraph()
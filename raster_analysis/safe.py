@@ -0,0 +1,97 @@
+# Sentinel-2 SAFE products read straight from their .zip archives
+
+import os
+import zipfile
+from xml.etree import ElementTree
+
+from .tiles import TiledBand
+
+# Native resolution of every spectral band, in metres
+BAND_RESOLUTIONS = {
+    'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 'B06': 20, 'B07': 20,
+    'B08': 10, 'B8A': 20, 'B09': 60, 'B10': 60, 'B11': 20, 'B12': 20,
+}
+
+# Band ids in the order the product metadata numbers them (bandId="0" is B01)
+SPECTRAL_BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+# Resolution the scene classification (SCL) of L2A products is read at
+SCL_RESOLUTION = 20
+
+# Sentinel-2 bands behind the band names used by the indices and the display channels
+CHANNEL_BANDS = {'blue': 'B02', 'green': 'B03', 'red': 'B04', 'rededge': 'B05', 'nir': 'B08'}
+
+def localName(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+def vsizipPath(zip_path, member):
+    return f"/vsizip/{os.path.abspath(zip_path)}/{member}"
+
+class SafeProduct:
+    # Bands of an L1C or L2A product opened in place through GDAL's /vsizip/ filesystem,
+    # located by the IMAGE_FILE entries of its MTD_MSIL1C/MTD_MSIL2A.xml instead of
+    # extracting the archive or picking files by hand
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path) as archive:
+            metadata_member = next((m for m in archive.namelist()
+                                    if os.path.basename(m) in ('MTD_MSIL2A.xml', 'MTD_MSIL1C.xml')), None)
+            if metadata_member is None:
+                raise ValueError(f"{zip_path} is not a Sentinel-2 SAFE archive")
+            root = ElementTree.fromstring(archive.read(metadata_member))
+
+        self.level = 'L2A' if metadata_member.endswith('MTD_MSIL2A.xml') else 'L1C'
+        safe_dir = os.path.dirname(metadata_member)
+
+        # (band id, resolution) -> archive member; L1C files carry no resolution suffix
+        self.files = {}
+        self.quantification = 10000.0
+        self.offsets = {}
+        self.nodata = 0
+        self.cloud_cover = None
+        for element in root.iter():
+            tag = localName(element)
+            if tag == 'IMAGE_FILE' and element.text:
+                parts = os.path.basename(element.text.strip()).split('_')
+                if parts[-1].endswith('m') and parts[-1][:-1].isdigit():
+                    band_id, resolution = parts[-2], int(parts[-1][:-1])
+                else:
+                    band_id = parts[-1]
+                    resolution = BAND_RESOLUTIONS.get(band_id)
+                member = f"{safe_dir}/{element.text.strip()}.jp2" if safe_dir else f"{element.text.strip()}.jp2"
+                self.files[(band_id, resolution)] = member
+            elif tag in ('BOA_QUANTIFICATION_VALUE', 'QUANTIFICATION_VALUE') and element.text:
+                self.quantification = float(element.text)
+            elif tag in ('BOA_ADD_OFFSET', 'RADIO_ADD_OFFSET') and element.text:
+                # Processing baseline 04.00 and later shift digital numbers by an offset per band
+                self.offsets[SPECTRAL_BANDS[int(element.get('band_id'))]] = float(element.text)
+            elif tag == 'Special_Values':
+                # Digital number of pixels outside the swath; the band files do not declare it
+                values = {localName(child): (child.text or '').strip() for child in element}
+                if values.get('SPECIAL_VALUE_TEXT') == 'NODATA' and values.get('SPECIAL_VALUE_INDEX', '').isdigit():
+                    self.nodata = int(values['SPECIAL_VALUE_INDEX'])
+            elif tag == 'Cloud_Coverage_Assessment' and element.text:
+                self.cloud_cover = float(element.text)
+
+    def bands(self):
+        return sorted(self.files)
+
+    def bandPath(self, band_id, resolution=None):
+        resolution = resolution or BAND_RESOLUTIONS.get(band_id)
+        member = self.files.get((band_id, resolution))
+        if member is None:
+            raise KeyError(f"Band {band_id} at {resolution} m is not in {os.path.basename(self.zip_path)}")
+        return vsizipPath(self.zip_path, member)
+
+    def classificationPath(self):
+        # Scene classification band of an L2A product; None for L1C, which has none
+        if ('SCL', SCL_RESOLUTION) not in self.files:
+            return None
+        return self.bandPath('SCL', SCL_RESOLUTION)
+
+    def band(self, band_id, resolution=None):
+        return TiledBand(self.bandPath(band_id, resolution), 1)
+
+    def reflectance(self, band_id):
+        # (scale, offset) turning digital numbers into reflectance: (value + offset) * scale
+        return 1.0 / self.quantification, self.offsets.get(band_id, 0.0)
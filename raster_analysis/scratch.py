@@ -0,0 +1,84 @@
+# Disk-backed scratch arrays for large intermediate rasters
+
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+# Where scratch files go unless set otherwise; None means the system temporary directory
+SCRATCH_DIR = os.environ.get('RASTER_ANALYSIS_SCRATCH') or None
+
+# Arrays smaller than this stay on the heap; larger ones are memory-mapped files
+SCRATCH_MIN_BYTES = 64 * 1024 * 1024
+
+class ScratchArrays:
+    # Named np.memmap arrays in a private directory under the scratch location. Asking for
+    # a key again with the same shape and dtype returns the same array with its contents,
+    # so intermediates survive redraws; the OS pages them in and out instead of the
+    # process swapping. The directory is removed when the manager goes away or at exit.
+    def __init__(self, directory=SCRATCH_DIR, min_bytes=SCRATCH_MIN_BYTES):
+        self.directory = directory
+        self.min_bytes = min_bytes
+        self._arrays = {}
+        self._dir = None
+        self._finalizer = None
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+
+    def privateDir(self):
+        if self._dir is None:
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+            self._dir = tempfile.mkdtemp(prefix='raster_analysis_scratch_', dir=self.directory)
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self._dir, True)
+        return self._dir
+
+    def array(self, key, shape, dtype):
+        # (array, reused): reused is True when the array already held data for this key
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        if int(np.prod(shape)) * dtype.itemsize < self.min_bytes:
+            return np.empty(shape, dtype=dtype), False
+
+        with self._lock:
+            entry = self._arrays.get(key)
+            if entry is not None and entry[0].shape == shape and entry[0].dtype == dtype:
+                return entry[0], True
+            if entry is not None:
+                self._remove(key)
+            path = os.path.join(self.privateDir(), f"{next(self._names)}.dat")
+            array = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+            self._arrays[key] = (array, path)
+            return array, False
+
+    def release(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._arrays.pop(key, None)
+        if entry is None:
+            return
+        array, path = entry
+        del array, entry
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Still mapped elsewhere (Windows); the directory goes at exit
+
+    def setDirectory(self, directory):
+        # Arrays already handed out keep their files until released; new ones go to directory
+        with self._lock:
+            self.directory = directory or None
+            self._dir = None
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._arrays):
+                self._remove(key)
+
+scratch_arrays = ScratchArrays()
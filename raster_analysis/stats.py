@@ -0,0 +1,273 @@
+# One-pass, block-streaming band statistics with a JSON sidecar cache
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .profiling import profiler
+from .masks import BLOCK_EMPTY, openMask
+from .tiles import TiledBand, archivePath, fileMtime
+
+# Histogram bins of float (and 32-bit integer) bands; 8- and 16-bit integers get one bin per value
+STATS_HISTOGRAM_BINS = 4096
+
+# Appended to a raster's path to name its statistics sidecar
+STATS_SIDECAR_SUFFIX = '.stats.json'
+
+def exactHistogram(dtype):
+    # 8- and 16-bit integers are counted per value, which makes percentiles exact
+    dtype = np.dtype(dtype)
+    return dtype.kind in 'ui' and dtype.itemsize <= 2
+
+def countPercentiles(counts, edges, percentiles, exact=False):
+    # Percentiles read off a cumulative histogram; exact bins return their lower edge,
+    # others interpolate linearly within the bin
+    cumulative = np.cumsum(counts)
+    results = []
+    for percentile in percentiles:
+        target = percentile / 100.0 * cumulative[-1]
+        i = min(int(np.searchsorted(cumulative, target, side='left')), len(counts) - 1)
+        below = cumulative[i - 1] if i > 0 else 0
+        fraction = (target - below) / counts[i] if counts[i] else 0.0
+        if exact:
+            results.append(float(edges[i]))
+        else:
+            results.append(float(edges[i] + fraction * (edges[i + 1] - edges[i])))
+    return tuple(results)
+
+def rebinned(counts, low, high, new_low, new_high, bins):
+    # Counts moved onto another uniform binning, each old bin landing where its centre falls
+    if len(counts) == bins and low == new_low and high == new_high:
+        return counts
+    centres = low + (np.arange(len(counts)) + 0.5) * ((high - low) / len(counts))
+    moved, _ = np.histogram(centres, bins=bins, range=(new_low, new_high), weights=counts)
+    return moved.astype(np.int64)
+
+class BandStats:
+    # Count, mean, variance (Welford's M2), min, max and a histogram of one band or part of
+    # it. Partial results of separate blocks merge exactly (Chan et al.'s parallel update),
+    # so blocks can be reduced in any order on any thread. Exact histograms have unit bins
+    # from low to high; the others have STATS_HISTOGRAM_BINS bins over [low, high].
+    def __init__(self, count=0, nodata_count=0, mean=0.0, m2=0.0, minimum=np.inf, maximum=-np.inf,
+                 counts=None, low=0.0, high=0.0, exact=False):
+        self.count = count
+        self.nodata_count = nodata_count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.counts = counts
+        self.low = low
+        self.high = high
+        self.exact = exact
+
+    @classmethod
+    def fromBlock(cls, block, nodata=None, bins=STATS_HISTOGRAM_BINS, valid=None):
+        # valid: optional bool mask of the pixels to count, on top of the nodata value
+        total = block.size
+        values = block.ravel() if valid is None else block[valid]
+        if nodata is not None and not np.isnan(nodata):
+            values = values[values != nodata]
+        if values.dtype.kind == 'f':
+            values = values[np.isfinite(values)]
+        exact = exactHistogram(values.dtype)
+        if values.size == 0:
+            return cls(nodata_count=total, exact=exact)
+
+        minimum, maximum = values.min(), values.max()
+        mean = float(values.mean(dtype=np.float64))
+        m2 = float(values.var(dtype=np.float64)) * values.size
+        if exact:
+            low = int(minimum)
+            counts = np.bincount((values.astype(np.int32) - low), minlength=int(maximum) - low + 1)
+            high = low + len(counts)
+        else:
+            counts, edges = np.histogram(values, bins=bins, range=(float(minimum), float(maximum)))
+            low, high = float(edges[0]), float(edges[-1])
+        return cls(values.size, total - values.size, mean, m2, float(minimum), float(maximum),
+                   counts.astype(np.int64), low, high, exact)
+
+    def merge(self, other):
+        nodata_count = self.nodata_count + other.nodata_count
+        if other.count == 0 or self.count == 0:
+            source = self if other.count == 0 else other
+            merged = BandStats(**vars(source))
+            merged.nodata_count = nodata_count
+            return merged
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+
+        low, high = min(self.low, other.low), max(self.high, other.high)
+        if self.exact:
+            counts = np.zeros(int(high - low), dtype=np.int64)
+            for part in (self, other):
+                start = int(part.low - low)
+                counts[start:start + len(part.counts)] += part.counts
+        else:
+            bins = max(len(self.counts), len(other.counts))
+            counts = (rebinned(self.counts, self.low, self.high, low, high, bins) +
+                      rebinned(other.counts, other.low, other.high, low, high, bins))
+        return BandStats(count, nodata_count, mean, m2, min(self.minimum, other.minimum),
+                         max(self.maximum, other.maximum), counts, low, high, self.exact)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, len(self.counts) + 1)
+
+    def percentiles(self, percentiles):
+        if not self.count:
+            return tuple(0.0 for _ in percentiles)
+        return countPercentiles(self.counts, self.edges, percentiles, self.exact)
+
+    def toDict(self):
+        return {
+            'count': self.count, 'nodata_count': self.nodata_count, 'mean': self.mean, 'm2': self.m2,
+            'min': self.minimum if self.count else None, 'max': self.maximum if self.count else None,
+            'histogram': None if self.counts is None else {
+                'low': self.low, 'high': self.high, 'exact': self.exact, 'counts': self.counts.tolist()},
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        histogram = data['histogram'] or {'low': 0.0, 'high': 0.0, 'exact': False, 'counts': None}
+        counts = None if histogram['counts'] is None else np.array(histogram['counts'], dtype=np.int64)
+        return cls(data['count'], data['nodata_count'], data['mean'], data['m2'],
+                   np.inf if data['min'] is None else data['min'],
+                   -np.inf if data['max'] is None else data['max'],
+                   counts, histogram['low'], histogram['high'], histogram['exact'])
+
+@profiler.timed('stats')
+def computeBandStats(file_path, band_index=1, workers=None, bins=STATS_HISTOGRAM_BINS, progress=None,
+                     scl_source=None, default_nodata=None):
+    # One read of every block, spread over a thread pool. Each worker keeps its own dataset
+    # handle and a running BandStats; the workers' results are merged at the end. Pixels
+    # masked by the band's mask band or by a scene classification (see BandMask) are left
+    # out, and blocks masked entirely are counted without being read. default_nodata is
+    # the nodata value of files that declare none (see TiledBand).
+    band = TiledBand(file_path, band_index, default_nodata=default_nodata)
+    try:
+        windows = [window for _, window in band.blockWindows()]
+        nodata = band.nodata
+    finally:
+        band.close()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(windows)))
+    done = [0]
+    lock = threading.Lock()
+
+    def reduceWindows(chunk):
+        handle = TiledBand(file_path, band_index, default_nodata=default_nodata)
+        mask = openMask([handle], scl_source)
+        try:
+            stats = BandStats()
+            for window in chunk:
+                coverage, valid = mask.window(window) if mask is not None else (None, None)
+                if coverage == BLOCK_EMPTY:
+                    part = BandStats(nodata_count=int(window.height) * int(window.width))
+                else:
+                    part = BandStats.fromBlock(handle.readWindow(window), nodata, bins, valid)
+                stats = stats.merge(part)
+                if progress is not None:
+                    with lock:
+                        done[0] += 1
+                        progress(done[0], len(windows))
+            return stats
+        finally:
+            if mask is not None:
+                mask.close()
+            handle.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(reduceWindows, [windows[i::workers] for i in range(workers)]))
+    total = BandStats()
+    for part in parts:
+        total = total.merge(part)
+    return total
+
+class StatsCache:
+    # Band statistics kept in memory and in a <file>.stats.json sidecar, keyed by the
+    # file's mtime, so a band is scanned once and later sessions start from the sidecar.
+    # Sidecars of bands inside a .zip sit next to the archive. Statistics restricted by a
+    # scene classification are kept apart from the band's unrestricted ones.
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def sidecarPath(self, file_path):
+        if file_path.startswith('/vsizip/'):
+            member = os.path.basename(file_path)
+            return f"{archivePath(file_path)}.{member}{STATS_SIDECAR_SUFFIX}"
+        return file_path + STATS_SIDECAR_SUFFIX
+
+    def readSidecar(self, file_path, mtime):
+        try:
+            with open(self.sidecarPath(file_path)) as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return sidecar.get('bands', {}) if sidecar.get('mtime') == mtime else {}
+
+    def writeSidecar(self, file_path, mtime, name, stats):
+        bands = self.readSidecar(file_path, mtime)
+        bands[name] = stats.toDict()
+        path = self.sidecarPath(file_path)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'mtime': mtime, 'bands': bands}, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass  # Read-only location: the statistics stay cached in memory only
+
+    def entryName(self, band_index, scl_source=None, default_nodata=None):
+        # Name of the statistics in the sidecar and in memory
+        name = str(band_index)
+        if default_nodata is not None:
+            name += f":nodata:{default_nodata:g}"
+        if scl_source is not None:
+            scl_path, scl_index = scl_source
+            name += f":scl:{os.path.basename(scl_path)}@{scl_index}:{fileMtime(scl_path)}"
+        return name
+
+    def peek(self, file_path, band_index=1, scl_source=None, default_nodata=None):
+        with self._lock:
+            return self._stats.get((file_path, self.entryName(band_index, scl_source, default_nodata),
+                                    fileMtime(file_path)))
+
+    def bandStats(self, file_path, band_index=1, workers=None, progress=None, scl_source=None, default_nodata=None):
+        mtime = fileMtime(file_path)
+        name = self.entryName(band_index, scl_source, default_nodata)
+        key = (file_path, name, mtime)
+        with self._lock:
+            stats = self._stats.get(key)
+        if stats is not None:
+            return stats
+
+        stored = self.readSidecar(file_path, mtime).get(name)
+        if stored is not None:
+            stats = BandStats.fromDict(stored)
+        else:
+            stats = computeBandStats(file_path, band_index, workers, progress=progress, scl_source=scl_source,
+                                     default_nodata=default_nodata)
+            self.writeSidecar(file_path, mtime, name, stats)
+        with self._lock:
+            self._stats[key] = stats
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+stats_cache = StatsCache()
@@ -0,0 +1,168 @@
+# Display stretches and the lookup tables they are rendered through
+
+import threading
+
+import numpy as np
+
+from .diskcache import disk_cache
+from .profiling import profiler
+from .stats import fileMtime, exactHistogram, countPercentiles, stats_cache
+
+# Longer side of the pyramid level stretches of derived layers (NDVI, ...) are sampled from
+STRETCH_SAMPLE_SIZE = 1024
+
+# Bins of the histogram percentiles are read from, for float data
+STRETCH_HISTOGRAM_BINS = 4096
+
+# Stretched code of float pixels without a value (NaN); colormaps draw it transparent
+INVALID_CODE = 0
+
+def histogramPercentiles(data, percentiles, nodata=None, bins=STRETCH_HISTOGRAM_BINS):
+    # Percentiles read off a cumulative histogram instead of sorting the data; exact for
+    # 8- and 16-bit integers, to within one of `bins` bins for everything else
+    values = data.ravel()
+    if nodata is not None and not np.isnan(nodata):
+        values = values[values != nodata]
+    if values.dtype.kind == 'f':
+        values = values[np.isfinite(values)]
+    if values.size == 0:
+        return tuple(0.0 for _ in percentiles)
+
+    exact = exactHistogram(values.dtype)
+    if exact:
+        low = int(values.min())
+        counts = np.bincount(values.astype(np.int32) - low)
+        edges = np.arange(low, low + len(counts) + 1, dtype=np.float64)
+    else:
+        counts, edges = np.histogram(values, bins=bins)
+    return countPercentiles(counts, edges, percentiles, exact)
+
+def stretchToUint8(data, low, high):
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return np.clip((data - low) * scale, 0, 255).astype(np.uint8)
+
+def stretchFloatToUint8(data, low, high, out):
+    # Float planes hold NaN where pixels are masked. Those get INVALID_CODE and valid
+    # pixels 1-255, so no NaN reaches the cast and colormaps can draw them transparent.
+    valid = np.isfinite(data)
+    scale = 254.0 / (high - low) if high > low else 0.0
+    stretched = np.clip((np.where(valid, data, low) - low) * scale, 0, 254)
+    np.add(stretched, 1, out=stretched)
+    np.copyto(out, stretched, casting='unsafe')
+    out[~valid] = INVALID_CODE
+    return out
+
+class StretchCache:
+    # 2/98 % stretch limits, computed once per band and reused by every composite and
+    # redraw. Band limits come from the full-resolution histogram of the statistics cache;
+    # derived layers such as NDVI use a histogram of an overview-sized sample. Keys include
+    # the file mtime, so a rewritten file gets a fresh stretch. Sampled limits given a
+    # disk_key are also kept in the disk cache, since the sample is a read of the whole scene.
+    def __init__(self, low=2, high=98):
+        self.low = low
+        self.high = high
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def limits(self, key, sample, nodata=None, disk_key=None):
+        with self._lock:
+            limits = self._limits.get(key)
+        if limits is not None:
+            return limits
+        stored = disk_cache.getArray(disk_key)
+        if stored is not None:
+            limits = tuple(float(limit) for limit in stored)
+        else:
+            with profiler.span('stretch.limits'):
+                limits = histogramPercentiles(sample(), (self.low, self.high), nodata)
+            disk_cache.putArray(disk_key, np.asarray(limits, dtype=np.float64))
+        with self._lock:
+            self._limits[key] = limits
+        return limits
+
+    def bandLimits(self, pyramid, progress=None, scl_source=None):
+        # progress(done, total) is called per block if the band's statistics must be computed.
+        # Given a scene classification, clouds and shadows are left out of the limits.
+        band = pyramid.band
+        key = band.key + (fileMtime(band.file_path), scl_source, band.default_nodata)
+        with self._lock:
+            limits = self._limits.get(key)
+        if limits is None:
+            with profiler.span('stretch.limits'):
+                stats = stats_cache.bandStats(band.file_path, band.band_index, progress=progress,
+                                              scl_source=scl_source, default_nodata=band.default_nodata)
+                limits = stats.percentiles((self.low, self.high))
+            with self._lock:
+                self._limits[key] = limits
+        return limits
+
+    def clear(self):
+        with self._lock:
+            self._limits.clear()
+
+stretch_cache = StretchCache()
+
+# Ustawienia palet kolorystycznych
+COLORMAPS = {
+    'RGB': ["#800000", "#ff0000", "#00ff00", "#0000ff", "#000080"],
+    'CIR': ["#ffffcc", "#ffeda0", "#fed976", "#feb24c", "#fd8d3c", "#fc4e2a", "#e31a1c"],
+    'Red Edge': ["#fee8c8", "#fdd49e", "#fdbb84", "#fc8d59", "#ef6548", "#d7301f", "#990000"],
+    'Custom': ["#800080", "#ff0000", "#ffff00", "#00ff00", "#0000ff", "#ff00ff", "#00ffff"],
+    'NDVI': ["#a50026", "#f46d43", "#fee08b", "#d9ef8b", "#66bd63", "#006837"],
+}
+
+class LutCache:
+    # uint8 lookup tables built once and shared by every render: stretch tables indexed
+    # by the raw bit pattern of 8/16-bit bands, and 256-entry RGBA colormap tables whose
+    # first entry, INVALID_CODE, is transparent
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def stretchLut(self, dtype, low, high):
+        dtype = np.dtype(dtype)
+        if dtype.kind not in 'ui' or dtype.itemsize > 2:
+            return None
+        key = ('stretch', dtype.str, low, high)
+        with self._lock:
+            lut = self._tables.get(key)
+            if lut is None:
+                codes = np.arange(1 << (8 * dtype.itemsize), dtype=np.uint32)
+                codes = codes.astype(np.uint16 if dtype.itemsize == 2 else np.uint8)
+                # Signed types are indexed by their unsigned bit pattern
+                lut = stretchToUint8(codes.view(dtype).astype(np.float64), low, high)
+                self._tables[key] = lut
+            return lut
+
+    def colormapLut(self, name):
+        key = ('colormap', name)
+        with self._lock:
+            lut = self._tables.get(key)
+            if lut is None:
+                from matplotlib.colors import LinearSegmentedColormap  # Loaded with the first legend
+
+                colormap = LinearSegmentedColormap.from_list(name, COLORMAPS[name])
+                lut = np.zeros((256, 4), dtype=np.uint8)  # INVALID_CODE stays transparent
+                lut[1:] = colormap(np.linspace(0.0, 1.0, 255), bytes=True)
+                self._tables[key] = lut
+            return lut
+
+lut_cache = LutCache()
+
+@profiler.timed('stretch')
+def applyStretch(data, low, high, out):
+    # One gather per pixel through the cached table; float bands fall back to arithmetic
+    lut = lut_cache.stretchLut(data.dtype, low, high)
+    if lut is None and data.dtype.kind == 'f':
+        return stretchFloatToUint8(data, low, high, out)
+    if lut is None:
+        out[...] = stretchToUint8(data, low, high)
+        return out
+    codes = data.view(np.uint16 if data.dtype.itemsize == 2 else np.uint8)
+    return np.take(lut, codes, out=out, mode='clip')
+
+@profiler.timed('colormap')
+def applyColormap(codes, name, out):
+    # codes: uint8 plane; out: uint32 plane whose bytes are RGBA
+    lut = lut_cache.colormapLut(name).view(np.uint32).ravel()
+    return np.take(lut, codes, out=out, mode='clip')
@@ -0,0 +1,487 @@
+# Lazy, block-cached raster bands, their overview pyramids and alignment onto a common grid
+
+import os
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from .profiling import profiler
+from .scratch import scratch_arrays
+
+# Raster blocks kept in memory across all loaded bands
+BLOCK_CACHE_BYTES = 512 * 1024 * 1024
+
+# Minimum number of pixels in one read unit for striped (non-tiled) files
+MIN_BLOCK_PIXELS = 256 * 256
+
+# Pyramid levels stop once the longer side fits in this many pixels
+MIN_LEVEL_SIZE = 256
+
+# Decimated levels up to this many pixels are built once and kept, on the heap or, when
+# large, in memory-mapped scratch files
+MAX_CACHED_LEVEL_PIXELS = 256 * 1024 * 1024
+
+# Kernels offered for resampling bands onto a finer or coarser grid
+RESAMPLING_METHODS = ['bilinear', 'nearest', 'cubic', 'average', 'lanczos']
+DEFAULT_RESAMPLING = 'bilinear'
+
+# Pixel grid of a band: what two bands must share to be combined pixel by pixel
+PixelGrid = namedtuple('PixelGrid', 'crs transform width height')
+
+def fileMtime(file_path):
+    # Bands inside an archive take the archive's modification time
+    if file_path.startswith('/vsizip/'):
+        file_path = archivePath(file_path)
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return 0.0
+
+def archivePath(vsizip_path):
+    path = vsizip_path[len('/vsizip/'):]
+    return path[:path.lower().index('.zip') + len('.zip')]
+
+def finestGrid(bands):
+    # Native grid with the smallest pixels among the bands, so that aligning never loses detail
+    return min((band.native_grid for band in bands), key=lambda grid: abs(grid.transform.a * grid.transform.e))
+
+class BlockCache:
+    # Bounded LRU of raster blocks keyed by (band key, block row, block col). Any number of
+    # bands may be open on one file and band, sharing its blocks: the displayed band and the
+    # short-lived handles of statistics, index and export workers. Each counts as a user of
+    # its key, and the blocks are only dropped when the last user closes, since the file may
+    # be rewritten before it is opened again.
+    def __init__(self, max_bytes=BLOCK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._blocks = OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block):
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            # Always keep the newest block, even if it alone exceeds the budget
+            while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def discard(self, band_key):
+        with self._lock:
+            self._discard(band_key)
+
+    def _discard(self, band_key):
+        for key in [k for k in self._blocks if k[0] == band_key]:
+            self.nbytes -= self._blocks.pop(key).nbytes
+
+    def acquire(self, band_key):
+        with self._lock:
+            self._users[band_key] = self._users.get(band_key, 0) + 1
+
+    def release(self, band_key):
+        # Drops a band's blocks once no open band uses them any more
+        with self._lock:
+            users = self._users.get(band_key, 0) - 1
+            if users > 0:
+                self._users[band_key] = users
+                return
+            self._users.pop(band_key, None)
+            self._discard(band_key)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+block_cache = BlockCache()
+
+@profiler.timed('open')
+def openOnGrid(file_path, grid=None, resampling=DEFAULT_RESAMPLING, default_nodata=None):
+    # (file, dataset to read from, its grid): the file itself when grid is None or its own,
+    # otherwise a WarpedVRT resampling the file onto grid. Pixels of grid outside the file
+    # must never read as data: they are filled with the nodata value of the file, else
+    # default_nodata, which the warp also leaves out of resampling; files without either
+    # get an alpha band that masks them.
+    file = rasterio.open(file_path)
+    native_grid = PixelGrid(file.crs, file.transform, file.width, file.height)
+    if grid is None or grid == native_grid:
+        return file, file, native_grid
+    options = {}
+    if file.nodata is None and default_nodata is not None:
+        options = {'src_nodata': default_nodata, 'nodata': default_nodata}
+    elif file.nodata is None and not any(MaskFlags.alpha in flags for flags in file.mask_flag_enums):
+        options = {'add_alpha': True}
+    vrt = WarpedVRT(file, crs=grid.crs, transform=grid.transform, width=grid.width, height=grid.height,
+                    resampling=Resampling[resampling], **options)
+    return file, vrt, grid
+
+class TiledBand:
+    # Lazy, block-aligned view of one band of a raster file. Pixels are read
+    # only for the blocks a window touches and kept in the shared block cache.
+    # Given a grid other than its own, the band is warped onto it through a WarpedVRT,
+    # which resamples only the windows that are read, never a full upsampled copy.
+    # Bands of a RasterStack share its dataset handle and its block reads. default_nodata
+    # is the value of pixels without data in files that declare none, such as the JP2
+    # bands of Sentinel-2 products, whose nodata value is given in the product metadata.
+    def __init__(self, file_path, band_index=1, cache=None, grid=None, resampling=DEFAULT_RESAMPLING, stack=None,
+                 default_nodata=None):
+        self.file_path = file_path
+        self.band_index = band_index
+        self.default_nodata = default_nodata
+        self.cache = cache if cache is not None else block_cache
+        self.resampling = resampling
+        self.stack = stack
+        if stack is None:
+            self._file, self._src, self.grid = openOnGrid(file_path, grid, resampling, default_nodata)
+            self._lock = threading.Lock()  # GDAL dataset handles are not thread-safe
+        else:
+            self._file, self._src, self.grid, self._lock = stack._file, stack._src, stack.grid, stack._lock
+
+        self.native_grid = PixelGrid(self._file.crs, self._file.transform, self._file.width, self._file.height)
+        if self.aligned:
+            self.key = (file_path, band_index, tuple(self.grid.transform)[:6], self.grid.width, self.grid.height,
+                        resampling)
+        else:
+            self.key = (file_path, band_index)
+        self.closed = False
+        self.cache.acquire(self.key)
+
+        self.profile = self._src.profile
+        self.width = self._src.width
+        self.height = self._src.height
+        self.dtype = np.dtype(self._src.dtypes[band_index - 1])
+        self.nodata = self._src.nodatavals[band_index - 1]
+        if self.nodata is None:
+            self.nodata = default_nodata
+        self.mask_flags = self._src.mask_flag_enums[band_index - 1]
+        self.overviews = self._src.overviews(band_index)
+
+        block_height, block_width = self._src.block_shapes[band_index - 1]
+        if block_height * block_width < MIN_BLOCK_PIXELS:
+            # Striped files report one-row blocks; group whole strips into a read unit
+            strips = -(-MIN_BLOCK_PIXELS // (block_height * block_width))
+            block_height = min(self.height, block_height * strips)
+        self.block_height = block_height
+        self.block_width = block_width
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def aligned(self):
+        return self._src is not self._file
+
+    @property
+    def blockCount(self):
+        return (-(-self.height // self.block_height), -(-self.width // self.block_width))
+
+    def blockWindow(self, row, col):
+        row_off = row * self.block_height
+        col_off = col * self.block_width
+        return Window(col_off, row_off,
+                      min(self.block_width, self.width - col_off),
+                      min(self.block_height, self.height - row_off))
+
+    def blockWindows(self):
+        rows, cols = self.blockCount
+        for row in range(rows):
+            for col in range(cols):
+                yield (row, col), self.blockWindow(row, col)
+
+    def readBlock(self, row, col):
+        key = (self.key, row, col)
+        block = self.cache.get(key)
+        if block is None and self.stack is not None:
+            block = self.stack.readBlock(self, row, col)
+        elif block is None:
+            with self._lock, profiler.span('read'):
+                block = self._src.read(self.band_index, window=self.blockWindow(row, col))
+            self.cache.put(key, block)
+        return block
+
+    def read(self, window=None, out=None):
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        window = window.round_offsets().round_lengths()
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        if out is None:
+            out = np.empty((height, width), dtype=self.dtype)
+
+        first_row, last_row = row_off // self.block_height, (row_off + height - 1) // self.block_height
+        first_col, last_col = col_off // self.block_width, (col_off + width - 1) // self.block_width
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                block = self.readBlock(row, col)
+                block_row_off = row * self.block_height
+                block_col_off = col * self.block_width
+                # Intersection of the block with the requested window
+                top = max(row_off, block_row_off)
+                bottom = min(row_off + height, block_row_off + block.shape[0])
+                left = max(col_off, block_col_off)
+                right = min(col_off + width, block_col_off + block.shape[1])
+                out[top - row_off:bottom - row_off, left - col_off:right - col_off] = \
+                    block[top - block_row_off:bottom - block_row_off, left - block_col_off:right - block_col_off]
+        return out
+
+    def readWindow(self, window, out=None):
+        # Uncached read, for one-off passes over the whole band
+        with self._lock, profiler.span('read'):
+            return self._src.read(self.band_index, window=window, out=out)
+
+    def readMask(self, window, out=None):
+        # GDAL's validity mask of the window: 0 where masked, 255 where valid
+        with self._lock:
+            return self._src.read_masks(self.band_index, window=window, out=out)
+
+    def readDecimated(self, out_height, out_width, window=None, resampling=Resampling.nearest):
+        # Reduced-resolution read; GDAL serves it from overviews when present
+        with self._lock, profiler.span('read.decimated'):
+            return self._src.read(self.band_index, window=window, out_shape=(out_height, out_width),
+                                  resampling=resampling)
+
+    def realigned(self, grid, resampling=DEFAULT_RESAMPLING):
+        # This band on another grid; returns itself when nothing would change
+        if grid == self.grid and (not self.aligned or resampling == self.resampling):
+            return self
+        return TiledBand(self.file_path, self.band_index, self.cache, grid, resampling,
+                         default_nodata=self.default_nodata)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cache.release(self.key)
+        if self.stack is not None:
+            self.stack.release(self)
+            return
+        if self.aligned:
+            self._src.close()
+        self._file.close()
+
+class RasterStack:
+    # Bands of one multi-band file behind a single dataset handle. A block missing from
+    # the cache is read for every band in use at once, with one src.read(indexes=[...])
+    # into a band-sequential buffer, instead of one open and one read per band. The file
+    # is closed with the last of its bands.
+    # The GUI thread adds and releases bands while workers read blocks: the bands in use
+    # are guarded by _bands_lock and the dataset by _lock, and a read after the file was
+    # closed fails with RasterioIOError like any read of a closed dataset.
+    def __init__(self, file_path, cache=None, grid=None, resampling=DEFAULT_RESAMPLING, default_nodata=None):
+        self.file_path = file_path
+        self.cache = cache if cache is not None else block_cache
+        self.resampling = resampling
+        self.default_nodata = default_nodata
+        self._file, self._src, self.grid = openOnGrid(file_path, grid, resampling, default_nodata)
+        self._lock = threading.Lock()
+        self.count = self._file.count  # Not counting an alpha band added by the warp
+        self.dtype = np.dtype(self._src.dtypes[0])
+        self.closed = False
+        self._bands = {}
+        self._bands_lock = threading.Lock()
+
+    def band(self, band_index):
+        if not 1 <= band_index <= self.count:
+            raise IndexError(f"{self.file_path} has no band {band_index}")
+        with self._bands_lock:
+            if self.closed:
+                raise RasterioIOError(f"{self.file_path} is closed")
+            band = self._bands.get(band_index)
+            if band is None:
+                band = TiledBand(self.file_path, band_index, self.cache, self.grid, self.resampling, stack=self,
+                                 default_nodata=self.default_nodata)
+                self._bands[band_index] = band
+            return band
+
+    def readWindow(self, band_indexes, window, out=None):
+        # Uncached read of several bands; out is a (bands, height, width) buffer
+        with self._lock, profiler.span('read'):
+            if self.closed:
+                raise RasterioIOError(f"{self.file_path} is closed")
+            return self._src.read(list(band_indexes), window=window, out=out)
+
+    def readBlock(self, band, row, col):
+        # Block of one band, read together with that block of every other band in use. A
+        # band released meanwhile is still read, for as long as the file is open.
+        with self._bands_lock:
+            bands = [other for other in self._bands.values() if other is not band]
+        bands.insert(0, band)
+        window = band.blockWindow(row, col)
+        planes = np.empty((len(bands), int(window.height), int(window.width)), dtype=self.dtype)
+        self.readWindow([other.band_index for other in bands], window, out=planes)
+        for other, plane in zip(bands, planes):
+            if not other.closed:
+                self.cache.put((other.key, row, col), plane)
+        return planes[0]
+
+    def release(self, band):
+        with self._bands_lock:
+            if self._bands.get(band.band_index) is band:
+                del self._bands[band.band_index]
+            if not self._bands:
+                self.closeFile()
+
+    def close(self):
+        with self._bands_lock:
+            self.closeFile()
+
+    def closeFile(self):
+        # Called with _bands_lock held, so that no band is added while the file closes
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._src is not self._file:
+                self._src.close()
+            self._file.close()
+
+def openBands(sources, grid=None, resampling=DEFAULT_RESAMPLING, cache=None, default_nodata=None):
+    # Bands by name from (file path, band index) pairs; bands of the same file share one RasterStack
+    stacks = {}
+    for path, _ in sources.values():
+        if path not in stacks:
+            shared = sum(1 for other, _ in sources.values() if other == path) > 1
+            stacks[path] = RasterStack(path, cache, grid, resampling, default_nodata) if shared else None
+    return {name: stacks[path].band(band_index) if stacks[path] is not None
+            else TiledBand(path, band_index, cache, grid, resampling, default_nodata=default_nodata)
+            for name, (path, band_index) in sources.items()}
+
+def alignBands(bands, grid=None, resampling=DEFAULT_RESAMPLING):
+    # Puts a dict of bands onto one grid, the finest of theirs unless given. Bands that had
+    # to be reopened are closed and replaced in the returned dict.
+    grid = grid or finestGrid(bands.values())
+    aligned = {}
+    for name, band in bands.items():
+        aligned[name] = band.realigned(grid, resampling)
+        if aligned[name] is not band:
+            band.close()
+    return aligned
+
+def releaseScratch(scratch, keys):
+    for key in keys:
+        scratch.release(key)
+
+class RasterPyramid:
+    # Resolution levels of a band; level n is decimated by 2 ** n. Levels come from
+    # the file's overviews when it has them, otherwise they are built from the band's
+    # blocks and cached once they are small enough to keep. Large cached levels live in
+    # scratch arrays, released when the pyramid is collected.
+    def __init__(self, band, scratch=None):
+        self.band = band
+        self.scratch = scratch if scratch is not None else scratch_arrays
+        self.factors = [1]
+        while max(band.height, band.width) // self.factors[-1] > MIN_LEVEL_SIZE:
+            self.factors.append(self.factors[-1] * 2)
+        self._levels = {}
+        self._lock = threading.Lock()
+        keys = [('pyramid', id(self), level) for level in range(self.levelCount)]
+        weakref.finalize(self, releaseScratch, self.scratch, keys)  # Must not refer to self
+
+    @property
+    def shape(self):
+        return self.band.shape
+
+    @property
+    def levelCount(self):
+        return len(self.factors)
+
+    def levelShape(self, level):
+        factor = self.factors[level]
+        return (-(-self.band.height // factor), -(-self.band.width // factor))
+
+    def levelForScale(self, scale):
+        # Coarsest level whose pixels are still no larger than a screen pixel
+        level = 0
+        for i, factor in enumerate(self.factors):
+            if factor * scale <= 1.0:
+                level = i
+        return level
+
+    def levelForSize(self, max_size):
+        # Finest level whose longer side fits in max_size pixels
+        for level in range(self.levelCount):
+            if max(self.levelShape(level)) <= max_size:
+                return level
+        return self.levelCount - 1
+
+    def readLevel(self, level, window=None):
+        # Window is given in pixels of the requested level
+        level_height, level_width = self.levelShape(level)
+        if window is None:
+            window = Window(0, 0, level_width, level_height)
+        if level == 0:
+            return self.band.read(window)
+
+        factor = self.factors[level]
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        full_window = Window(col_off * factor, row_off * factor,
+                             min(width * factor, self.band.width - col_off * factor),
+                             min(height * factor, self.band.height - row_off * factor))
+
+        if self.band.overviews and min(self.band.overviews) <= factor:
+            return self.band.readDecimated(height, width, window=full_window)
+
+        cached = self.cachedLevel(level)
+        if cached is not None:
+            return cached[row_off:row_off + height, col_off:col_off + width]
+
+        # Too large to keep: decimate the touched full-resolution blocks on demand
+        return self.band.read(full_window)[::factor, ::factor]
+
+    def cachedLevel(self, level):
+        height, width = self.levelShape(level)
+        if height * width > MAX_CACHED_LEVEL_PIXELS:
+            return None
+
+        with self._lock:
+            if not self._levels:
+                # One pass over the band builds the finest cacheable level; coarser ones derive from it
+                finest = next(l for l in range(1, self.levelCount)
+                              if self.levelShape(l)[0] * self.levelShape(l)[1] <= MAX_CACHED_LEVEL_PIXELS)
+                self._levels[finest] = self.buildLevel(finest)
+            if level not in self._levels:
+                source = max(l for l in self._levels if l < level)
+                step = self.factors[level] // self.factors[source]
+                out = self.levelArray(level)
+                out[...] = self._levels[source][::step, ::step]
+                self._levels[level] = out
+            return self._levels[level]
+
+    def levelArray(self, level):
+        array, _ = self.scratch.array(('pyramid', id(self), level), self.levelShape(level), self.band.dtype)
+        return array
+
+    def buildLevel(self, level):
+        factor = self.factors[level]
+        out = self.levelArray(level)
+        for _, window in self.band.blockWindows():
+            block = self.band.readWindow(window)
+            row_off, col_off = int(window.row_off), int(window.col_off)
+            # Keep every factor-th pixel of the whole band, whatever the block alignment
+            row_start = -row_off % factor
+            col_start = -col_off % factor
+            sample = block[row_start::factor, col_start::factor]
+            top = (row_off + row_start) // factor
+            left = (col_off + col_start) // factor
+            out[top:top + sample.shape[0], left:left + sample.shape[1]] = sample
+        return out
@@ -0,0 +1,137 @@
+# Stand-in for the ee module with the parts of its API that raster_analysis.earthengine
+# uses. Images are functions of map coordinates, evaluated at pixel centres, so tests can
+# compare what was downloaded against the same function.
+
+import itertools
+from types import SimpleNamespace
+
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+
+class EEException(Exception):
+    pass
+
+class Computed:
+    # A server-side value; getInfo() brings it back
+    def __init__(self, value):
+        self.value = value
+
+    def getInfo(self):
+        return self.value
+
+class Reducer:
+    def __init__(self, names):
+        self.names = names
+
+    @classmethod
+    def mean(cls):
+        return cls(('mean',))
+
+    @classmethod
+    def stdDev(cls):
+        return cls(('stdDev',))
+
+    @classmethod
+    def minMax(cls):
+        return cls(('min', 'max'))
+
+    def combine(self, other, sharedInputs=False):
+        return Reducer(self.names + other.names)
+
+    def reduce(self, values):
+        functions = {'mean': np.mean, 'stdDev': np.std, 'min': np.min, 'max': np.max}
+        return {name: float(functions[name](values)) for name in self.names}
+
+class Geometry:
+    # Only rectangles, as (west, south, east, north)
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    @staticmethod
+    def Rectangle(coords):
+        return Geometry(tuple(coords))
+
+class Image:
+    # bands maps band names to f(x, y) over arrays of map coordinates
+    def __init__(self, bands, dtype='float32'):
+        self.bands = dict(bands)
+        self.dtype = np.dtype(dtype)
+        self.download_params = {}
+        self._urls = itertools.count()
+
+    @classmethod
+    def constant(cls, value):
+        return cls({'constant': lambda x, y: np.full(np.broadcast(x, y).shape, value)})
+
+    def bandNames(self):
+        return Computed(list(self.bands))
+
+    def pixels(self, transform, width, height, bands=None):
+        # (bands, height, width) array of the image on a grid
+        cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+        x, y = transform * (cols, rows)
+        return np.stack([np.asarray(self.bands[name](x, y), dtype=self.dtype) for name in bands or self.bands])
+
+    def reduceRegion(self, reducer, geometry, scale, maxPixels=None, bestEffort=False):
+        west, south, east, north = geometry.bounds
+        width, height = max(1, int((east - west) / scale)), max(1, int((north - south) / scale))
+        data = self.pixels(Affine(scale, 0.0, west, 0.0, -scale, north), width, height)
+        return Computed({f"{name}_{stat}": value
+                         for name, band in zip(self.bands, data)
+                         for stat, value in reducer.reduce(band).items()})
+
+    def getDownloadURL(self, params):
+        url = f"https://earthengine.test/download/{next(self._urls)}"
+        self.download_params[url] = params
+        return url
+
+    def geoTiff(self, url):
+        # Bytes of the GeoTIFF a download URL serves
+        params = self.download_params[url]
+        width, height = (int(value) for value in params['dimensions'].split('x'))
+        transform = Affine(*params['crs_transform'])
+        data = self.pixels(transform, width, height, params['bands'])
+        with MemoryFile() as memory:
+            with memory.open(driver='GTiff', width=width, height=height, count=data.shape[0],
+                             dtype=data.dtype.name, crs=params['crs'], transform=transform) as dst:
+                dst.write(data)
+            return memory.read()
+
+def computePixels(request):
+    # Structured array with a field per band, as fileFormat NUMPY_NDARRAY returns
+    grid = request['grid']
+    affine = grid['affineTransform']
+    transform = Affine(affine['scaleX'], affine['shearX'], affine['translateX'],
+                       affine['shearY'], affine['scaleY'], affine['translateY'])
+    image = request['expression']
+    names = request['bandIds'] or list(image.bands)
+    data = image.pixels(transform, grid['dimensions']['width'], grid['dimensions']['height'], names)
+    pixels = np.empty(data.shape[1:], dtype=[(name, data.dtype) for name in names])
+    for name, band in zip(names, data):
+        pixels[name] = band
+    return pixels
+
+class Task:
+    # Batch task going through states, one per status() call; the last one repeats
+    def __init__(self, states, description='export', error_message=''):
+        self.states = list(states)
+        self.description = description
+        self.error_message = error_message
+        self.started = False
+        self.polls = 0
+
+    def start(self):
+        self.started = True
+
+    def status(self):
+        state = self.states[min(self.polls, len(self.states) - 1)]
+        self.polls += 1
+        return {'state': state, 'description': self.description, 'error_message': self.error_message}
+
+def fakeEE(compute_pixels=True):
+    # Module-like namespace; without compute_pixels it acts like a client from before
+    # ee.data.computePixels existed
+    data = SimpleNamespace(computePixels=computePixels) if compute_pixels else SimpleNamespace()
+    return SimpleNamespace(Image=Image, Reducer=Reducer, Geometry=Geometry, Number=Computed,
+                           EEException=EEException, data=data, batch=SimpleNamespace(Task=Task))
@@ -0,0 +1,23 @@
+# Small GeoTIFFs written for the tests
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+CRS = 'EPSG:32633'
+
+# Upper left corner of the written rasters, in CRS units
+ORIGIN = (500000.0, 5600000.0)
+
+def writeRaster(path, data, nodata=None, transform=None, crs=CRS, block_size=16):
+    # data is (height, width) or (bands, height, width); tiled in block_size blocks
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    profile = {'driver': 'GTiff', 'dtype': data.dtype.name, 'count': data.shape[0], 'height': data.shape[1],
+               'width': data.shape[2], 'crs': crs, 'nodata': nodata,
+               'transform': transform or from_origin(ORIGIN[0], ORIGIN[1], 10, 10),
+               'tiled': True, 'blockxsize': block_size, 'blockysize': block_size}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data)
+    return str(path)
@@ -0,0 +1,64 @@
+# Spectral indices computed serially, on threads and on processes
+
+import numpy as np
+import pytest
+import rasterio
+
+from raster_analysis.bandmath import computeIndex
+from raster_analysis.diskcache import disk_cache
+from raster_analysis.masks import SCL_MASKED_CLASSES
+
+from rasters import writeRaster
+
+# Wider than one 512 px output block, so that the pools have several blocks to hand out
+SHAPE = (40, 600)
+
+@pytest.fixture(autouse=True)
+def noDiskCache(monkeypatch):
+    monkeypatch.setattr(disk_cache, 'directory', None)
+
+def bandFiles(tmp_path):
+    rng = np.random.default_rng(3)
+    red = rng.integers(1, 5000, SHAPE).astype(np.uint16)
+    nir = rng.integers(1, 5000, SHAPE).astype(np.uint16)
+    red[5, :100] = 0
+    nir[30, 550:] = 0
+    paths = {'red': writeRaster(tmp_path / 'red.tif', red, nodata=0),
+             'nir': writeRaster(tmp_path / 'nir.tif', nir, nodata=0)}
+    return paths, red, nir
+
+def expectedNdvi(red, nir):
+    red, nir = red.astype(np.float64), nir.astype(np.float64)
+    ndvi = (nir - red) / (nir + red)
+    ndvi[(red == 0) | (nir == 0)] = np.nan
+    return ndvi
+
+def readIndex(path):
+    with rasterio.open(path) as src:
+        assert src.dtypes[0] == 'float32'
+        return src.read(1)
+
+@pytest.mark.parametrize('workers, use_processes', [(1, False), (3, False), (2, True)])
+def test_ndvi_matches_numpy(tmp_path, workers, use_processes):
+    paths, red, nir = bandFiles(tmp_path)
+    out_path = computeIndex('NDVI', paths, str(tmp_path / 'ndvi.tif'), reflectance_scale=1e-4,
+                            workers=workers, use_processes=use_processes)
+    np.testing.assert_allclose(readIndex(out_path), expectedNdvi(red, nir), rtol=1e-5, equal_nan=True)
+
+def test_scene_classification_masks_clouds(tmp_path):
+    paths, red, nir = bandFiles(tmp_path)
+    scl = np.full(SHAPE, 4, dtype=np.uint8)
+    scl[:, 300:320] = 9
+    scl[10:20, :] = 3
+    scl_path = writeRaster(tmp_path / 'scl.tif', scl)
+    expected = expectedNdvi(red, nir)
+    expected[np.isin(scl, SCL_MASKED_CLASSES)] = np.nan
+    for workers in (1, 2):
+        out_path = computeIndex('NDVI', paths, str(tmp_path / f"ndvi{workers}.tif"), workers=workers,
+                                scl_path=scl_path)
+        np.testing.assert_allclose(readIndex(out_path), expected, rtol=1e-5, equal_nan=True)
+
+def test_missing_band_is_rejected(tmp_path):
+    paths, _, _ = bandFiles(tmp_path)
+    with pytest.raises(ValueError, match='needs bands: blue'):
+        computeIndex('EVI', paths, str(tmp_path / 'evi.tif'))
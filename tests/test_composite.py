@@ -0,0 +1,42 @@
+# Temporal composites of overlapping scenes
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_analysis.composite import Scene, TemporalComposite
+
+from rasters import ORIGIN, writeRaster
+
+def shiftedScene(tmp_path, name, value, col_off, nodata=None, cloud_cover=0.0):
+    # 32 x 32 scene of one value, col_off pixels east of ORIGIN, its file declaring no nodata
+    path = writeRaster(tmp_path / f"{name}.tif", np.full((32, 32), value, dtype=np.uint16),
+                       transform=from_origin(ORIGIN[0] + col_off * 10, ORIGIN[1], 10, 10))
+    return Scene({'red': (path, 1)}, nodata=nodata, cloud_cover=cloud_cover, name=name)
+
+def composite(tmp_path, scenes, method):
+    out_path = str(tmp_path / f"{method}.tif")
+    TemporalComposite(scenes, method, band_names=('red',), workers=2, block_size=16, resampling='nearest').run(out_path)
+    with rasterio.open(out_path) as src:
+        return src.read(1)
+
+@pytest.mark.parametrize('nodata', [None, 0])
+def test_median_ignores_pixels_outside_footprints(tmp_path, nodata):
+    scenes = [shiftedScene(tmp_path, 'west', 1000, 0, nodata), shiftedScene(tmp_path, 'east', 3000, 8, nodata)]
+    result = composite(tmp_path, scenes, 'median')
+    assert result.shape == (32, 40)
+    np.testing.assert_array_equal(result[:, :8], 1000)
+    np.testing.assert_array_equal(result[:, 8:32], 2000)
+    np.testing.assert_array_equal(result[:, 32:], 3000)
+
+def test_least_cloudy_fills_from_clearest_scene(tmp_path):
+    scenes = [shiftedScene(tmp_path, 'cloudy', 1000, 0, cloud_cover=40.0),
+              shiftedScene(tmp_path, 'clear', 3000, 8, cloud_cover=5.0)]
+    result = composite(tmp_path, scenes, 'least-cloudy')
+    np.testing.assert_array_equal(result[:, :8], 1000)
+    np.testing.assert_array_equal(result[:, 8:], 3000)
+
+def test_unknown_method_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='Unknown composite method'):
+        TemporalComposite([shiftedScene(tmp_path, 'scene', 1000, 0)], 'mean')
@@ -0,0 +1,107 @@
+# Product downloads: Range resume, servers that ignore it, and checksum checks
+
+import hashlib
+import os
+
+import pytest
+
+from raster_analysis.copernicus import DownloadManager, KEYCLOAK_URL
+
+PAYLOAD = bytes(range(256)) * 40
+
+class Response:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.text = content.decode('latin-1')
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def json(self):
+        return {'access_token': 'token', 'expires_in': 600}
+
+    def close(self):
+        self.closed = True
+
+class FakeSession:
+    # Serves PAYLOAD from the download host behind one redirect, honouring Range headers
+    # unless ignore_range is set
+    def __init__(self, ignore_range=False):
+        self.ignore_range = ignore_range
+        self.requests = []
+
+    def post(self, url, data):
+        assert url == KEYCLOAK_URL
+        return Response(200)
+
+    def get(self, url, headers, allow_redirects, stream):
+        assert headers['Authorization'] == 'Bearer token'
+        if not url.startswith('https://download.example/'):
+            return Response(307, headers={'Location': 'https://download.example/product'})
+        self.requests.append(headers.get('Range'))
+        if 'Range' not in headers or self.ignore_range:
+            return Response(200, PAYLOAD)
+        offset = int(headers['Range'][len('bytes='):-1])
+        if offset >= len(PAYLOAD):
+            return Response(416)
+        return Response(206, PAYLOAD[offset:])
+
+    def close(self):
+        pass
+
+def product(checksum=None):
+    return {'Id': 'abc', 'Name': 'S2A_MSIL2A_TEST.SAFE',
+            'Checksum': [{'Algorithm': 'MD5', 'Value': checksum or hashlib.md5(PAYLOAD).hexdigest()}]}
+
+def manager(tmp_path, session):
+    downloads = DownloadManager('user', 'password', str(tmp_path), workers=1, chunk_size=1000, status=lambda _: None)
+    downloads.session = downloads.token.session = session
+    return downloads
+
+def partial(tmp_path, size):
+    part_path = tmp_path / 'S2A_MSIL2A_TEST.zip.part'
+    part_path.write_bytes(PAYLOAD[:size])
+    return part_path
+
+def test_download_streams_to_zip(tmp_path):
+    session = FakeSession()
+    file_path = manager(tmp_path, session).download(product())
+    assert file_path == str(tmp_path / 'S2A_MSIL2A_TEST.zip')
+    assert open(file_path, 'rb').read() == PAYLOAD
+    assert session.requests == [None]
+    assert not os.path.exists(file_path + '.part')
+
+def test_interrupted_download_resumes_with_range(tmp_path):
+    partial(tmp_path, 3000)
+    session = FakeSession()
+    file_path = manager(tmp_path, session).download(product())
+    assert session.requests == ['bytes=3000-']
+    assert open(file_path, 'rb').read() == PAYLOAD
+
+def test_server_ignoring_range_rewrites_part(tmp_path):
+    partial(tmp_path, 3000)
+    session = FakeSession(ignore_range=True)
+    file_path = manager(tmp_path, session).download(product())
+    assert open(file_path, 'rb').read() == PAYLOAD
+
+def test_complete_part_is_not_downloaded_again(tmp_path):
+    partial(tmp_path, len(PAYLOAD))
+    session = FakeSession()
+    file_path = manager(tmp_path, session).download(product())
+    assert session.requests == [f"bytes={len(PAYLOAD)}-"]
+    assert open(file_path, 'rb').read() == PAYLOAD
+
+def test_checksum_mismatch_discards_part(tmp_path):
+    with pytest.raises(Exception, match='MD5 checksum mismatch'):
+        manager(tmp_path, FakeSession()).download(product('0' * 32))
+    assert os.listdir(tmp_path) == []
+
+def test_existing_zip_is_kept(tmp_path):
+    (tmp_path / 'S2A_MSIL2A_TEST.zip').write_bytes(b'done')
+    session = FakeSession()
+    manager(tmp_path, session).download(product())
+    assert session.requests == []
@@ -0,0 +1,97 @@
+# The persistent cache: size cap, LRU eviction, fingerprints of rewritten files and persisted planes
+
+import os
+
+import numpy as np
+from rasterio.windows import Window
+
+from raster_analysis import diskcache
+from raster_analysis.diskcache import DiskCache, cacheKey, sourceFingerprint
+from raster_analysis.render import RenderGraph
+
+# .npy files of 2000 float64 values, header included
+ENTRY = np.zeros(2000)
+ENTRY_BYTES = 16128
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    # Every lookup refreshes its entry's access time
+    monkeypatch.setattr(diskcache, 'ACCESS_RESOLUTION_SECONDS', -1.0)
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=100000)
+    keys = [cacheKey('entry', i) for i in range(7)]
+    for key in keys[:6]:
+        assert cache.putArray(key, ENTRY)
+    assert cache.usage() == (6, 6 * ENTRY_BYTES)
+    assert cache.getArray(keys[0]) is not None
+
+    # Over the cap: the two least recently used entries go, bringing the total under 90 %
+    assert cache.putArray(keys[6], ENTRY)
+    assert cache.usage() == (5, 5 * ENTRY_BYTES)
+    assert [cache.getArray(key) is not None for key in keys] == [True, False, False, True, True, True, True]
+    assert not os.path.exists(cache.entryPath(keys[1]))
+    cache.close()
+
+def test_oversized_entries_are_not_stored(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=100000)
+    assert not cache.putArray(cacheKey('large'), np.zeros(4000))
+    assert cache.usage() == (0, 0)
+    cache.close()
+
+def test_set_directory_closes_connections(tmp_path):
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    cache = DiskCache(first, max_bytes=100000)
+    key = cacheKey('entry')
+    cache.putArray(key, ENTRY)
+    assert len(cache._connections) == 1
+
+    cache.setDirectory(second)
+    assert cache._connections == []
+    assert cache.getArray(key) is None
+    cache.setDirectory(first)
+    np.testing.assert_array_equal(cache.getArray(key), ENTRY)
+
+    cache.setDirectory(None)
+    assert not cache.enabled
+    assert not cache.putArray(key, ENTRY)
+    assert cache._connections == []
+
+def test_source_fingerprint_follows_files(tmp_path):
+    path = tmp_path / 'band.tif'
+    path.write_bytes(b'first')
+    source_key = ('NDVI', (str(path), 1), (str(path), 2))
+    fingerprint = sourceFingerprint(source_key)
+    assert fingerprint == sourceFingerprint(source_key)
+    assert fingerprint[0] == 'NDVI'
+
+    path.write_bytes(b'second')
+    os.utime(path, ns=(0, 12345))
+    assert sourceFingerprint(source_key) != fingerprint
+    path.unlink()
+    assert sourceFingerprint(source_key) is None
+
+def test_persisted_planes_are_reused_until_the_file_changes(tmp_path):
+    path = tmp_path / 'band.tif'
+    path.write_bytes(b'pixels')
+    disk = DiskCache(str(tmp_path / 'cache'))
+    reads = []
+
+    def read(level, window):
+        reads.append(window)
+        return np.arange(16 * 16, dtype=np.uint16).reshape(16, 16)
+
+    source = (('band', (str(path), 1)), read)
+    window = Window(0, 0, 16, 16)
+    plane = RenderGraph(disk=disk, persist_planes=True).plane(source, (0, 255), 0, window)
+    assert len(reads) == 1
+
+    # A later session finds the plane on disk
+    np.testing.assert_array_equal(RenderGraph(disk=disk, persist_planes=True).plane(source, (0, 255), 0, window), plane)
+    assert len(reads) == 1
+
+    os.utime(path, ns=(0, 12345))
+    RenderGraph(disk=disk, persist_planes=True).plane(source, (0, 255), 0, window)
+    assert len(reads) == 2
+
+    # Without persist_planes nothing goes to disk
+    RenderGraph(disk=disk).plane(source, (0, 255), 0, window)
+    assert len(reads) == 3
+    disk.close()
@@ -0,0 +1,141 @@
+# Earth Engine scripts, downloads and task polling against the stand-in in fake_ee
+
+import numpy as np
+import pytest
+import rasterio
+import requests
+from rasterio.transform import from_origin
+
+from raster_analysis.earthengine import TiledDownload, isTransient, runScript, waitForTask, withBackoff
+
+from fake_ee import EEException, Image, Task, fakeEE
+
+# 35 x 21 pixels of 10 m, which 16 px tiles cover with partial tiles on both edges
+BOUNDS = (500000.0, 5599790.0, 500350.0, 5600000.0)
+CRS = 'EPSG:32633'
+SCALE = 10.0
+
+def gradient():
+    return Image({'B4': lambda x, y: (x - BOUNDS[0]) + 1000 * (BOUNDS[3] - y),
+                  'B8': lambda x, y: (y - BOUNDS[1]) * 2})
+
+def expected(image):
+    return image.pixels(from_origin(BOUNDS[0], BOUNDS[3], SCALE, SCALE), 35, 21)
+
+class Response:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+def test_run_script_reports_print_and_result():
+    messages = []
+    script = "print('bands', 2)\nresult = ee.Number(42)\n"
+    assert runScript(script, fakeEE(), status=messages.append) == []
+    assert messages == ['bands 2', '42']
+
+def test_run_script_reports_region_stats(tmp_path):
+    messages = []
+    script = ("image = ee.Image.constant(3)\n"
+              "result = regionStats(image, ee.Geometry.Rectangle([0, 0, 100, 100]), 10)\n")
+    runScript(script, fakeEE(), directory=str(tmp_path), status=messages.append)
+    assert '"constant_mean": 3.0' in messages[-1]
+    assert '"constant_max": 3.0' in messages[-1]
+
+def test_run_script_downloads(tmp_path):
+    script = f"download(ee.Image.constant(7), 'constant', {BOUNDS!r}, {SCALE}, crs={CRS!r})\n"
+    outputs = runScript(script, fakeEE(), directory=str(tmp_path), status=lambda message: None)
+    assert outputs == [str(tmp_path / 'constant.tif')]
+    with rasterio.open(outputs[0]) as src:
+        assert (src.read(1) == 7).all()
+
+def test_tiled_download_assembles_cog(tmp_path):
+    image = gradient()
+    out_path = str(tmp_path / 'tiles.tif')
+    progress = []
+    TiledDownload(fakeEE(), image, BOUNDS, CRS, SCALE, out_path, tile_size=16, workers=3,
+                  status=lambda message: None).run(lambda done, total: progress.append((done, total)))
+    with rasterio.open(out_path) as src:
+        assert (src.width, src.height, src.count) == (35, 21, 2)
+        assert src.crs.to_string() == CRS
+        assert src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT') == 'COG'
+        np.testing.assert_array_equal(src.read(), expected(image))
+    assert progress == [(done, 6) for done in range(1, 7)]
+
+def test_tiled_download_falls_back_to_download_urls(tmp_path, monkeypatch):
+    image = gradient()
+    urls = []
+
+    def get(url, timeout=None):
+        urls.append(url)
+        return Response(image.geoTiff(url))
+
+    monkeypatch.setattr(requests, 'get', get)
+    out_path = str(tmp_path / 'urls.tif')
+    TiledDownload(fakeEE(compute_pixels=False), image, BOUNDS, CRS, SCALE, out_path, bands=['B8'],
+                  tile_size=16, workers=2, status=lambda message: None).run()
+    assert len(urls) == 6
+    with rasterio.open(out_path) as src:
+        np.testing.assert_array_equal(src.read(), expected(image)[1:])
+
+def test_wait_for_task_backs_off_until_completed():
+    task = Task(['READY', 'RUNNING', 'RUNNING', 'RUNNING', 'RUNNING', 'COMPLETED'])
+    sleeps, messages = [], []
+    status = waitForTask(task, messages.append, delay=1.0, max_delay=4.0, sleep=sleeps.append)
+    assert status['state'] == 'COMPLETED'
+    assert sleeps == [1.0, 2.0, 4.0, 4.0, 4.0]
+    assert messages == ['Task export: READY', 'Task export: RUNNING', 'Task export: COMPLETED']
+
+def test_wait_for_task_raises_when_failed():
+    task = Task(['READY', 'RUNNING', 'FAILED'], error_message='User memory limit exceeded.')
+    sleeps = []
+    with pytest.raises(RuntimeError, match='failed: User memory limit exceeded'):
+        waitForTask(task, lambda message: None, delay=1.0, sleep=sleeps.append)
+    assert sleeps == [1.0, 2.0]
+
+def test_run_task_starts_task():
+    messages = []
+    runScript("task = ee.batch.Task(['COMPLETED'])\nrunTask(task)\nresult = task.started\n", fakeEE(),
+              status=messages.append)
+    assert messages == ['Task export: COMPLETED', 'true']
+
+def test_with_backoff_retries_transient_errors_only():
+    calls, sleeps = [], []
+
+    def flaky():
+        calls.append(None)
+        if len(calls) < 3:
+            raise EEException('Too many concurrent aggregations.')
+        return 'done'
+
+    assert withBackoff(flaky, delay=0.5, sleep=sleeps.append) == 'done'
+    assert sleeps == [0.5, 1.0]
+
+    def missing():
+        raise EEException('Image.load: Image asset not found.')
+
+    with pytest.raises(EEException):
+        withBackoff(missing, sleep=sleeps.append)
+    assert sleeps == [0.5, 1.0]
+
+@pytest.mark.parametrize('error, transient', [
+    (EEException('Too many concurrent aggregations.'), True),
+    (EEException('Computation timed out.'), True),
+    (EEException('Collection query aborted after accumulating over 5000 elements (timeout: 500).'), False),
+    (EEException('Image.select: Pattern "B99" did not match any bands.'), False),
+    (ValueError('HTTP 500 in band name'), False),
+    (ConnectionResetError(), True),
+    (TimeoutError(), True),
+    (requests.ConnectionError(), True),
+    (requests.ReadTimeout(), True),
+])
+def test_is_transient(error, transient):
+    assert isTransient(error) is transient
+
+@pytest.mark.parametrize('status, transient', [(429, True), (503, True), (400, False), (404, False)])
+def test_is_transient_by_http_status(status, transient):
+    error = requests.HTTPError('Too many requests', response=Response(b'', status))
+    assert isTransient(error) is transient
@@ -0,0 +1,28 @@
+# COG export of float products as scaled integers
+
+import warnings
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from raster_analysis.export import CogOptions, CogWriter
+
+from rasters import CRS, ORIGIN
+
+def floatProfile(width, height):
+    return {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'width': width, 'height': height, 'crs': CRS,
+            'transform': from_origin(ORIGIN[0], ORIGIN[1], 10, 10), 'nodata': np.nan}
+
+def test_integer_export_maps_nan_to_nodata_without_warnings(tmp_path):
+    data = np.array([[0.25, np.nan, -np.inf], [7.0, np.inf, 0.5]], dtype=np.float32)
+    out_path = str(tmp_path / 'scaled.tif')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        with CogWriter(out_path, floatProfile(3, 2), CogOptions(dtype='uint16', scale=10000, nodata=0)) as dst:
+            dst.write(data[np.newaxis])
+    with rasterio.open(out_path) as src:
+        assert src.nodata == 0
+        assert src.scales == pytest.approx((1e-4,))
+        np.testing.assert_array_equal(src.read(1), [[2500, 0, 0], [65535, 0, 5000]])
@@ -0,0 +1,86 @@
+# Validity masks from mask bands and the scene classification, and their bit-packed cache entries
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from raster_analysis.masks import (BLOCK_EMPTY, BLOCK_FULL, BLOCK_PARTIAL, SCL_MASKED_CLASSES, BandMask, openMask,
+                                   packMask, unpackMask)
+from raster_analysis.tiles import BlockCache, TiledBand
+
+from rasters import writeRaster
+
+@pytest.mark.parametrize('shape', [(1, 1), (3, 5), (16, 16), (7, 13)])
+def test_pack_round_trip(shape):
+    valid = np.random.default_rng(4).random(shape) < 0.5
+    packed = packMask(valid)
+    assert packed.nbytes == (valid.size + 7) // 8
+    np.testing.assert_array_equal(unpackMask(packed, shape), valid)
+
+def sclScene(tmp_path):
+    # 32 x 32 scene: the upper left block clear, the upper right one cloudy, the lower half mixed
+    scl = np.full((32, 32), 4, dtype=np.uint8)
+    scl[:16, 16:] = 9
+    scl[16:, ::3] = 8
+    scl[20, :] = 0
+    band = TiledBand(writeRaster(tmp_path / 'band.tif', np.ones((32, 32), dtype=np.uint16), nodata=0),
+                     cache=BlockCache())
+    return band, writeRaster(tmp_path / 'scl.tif', scl), scl
+
+def test_scene_classification_coverage(tmp_path):
+    band, scl_path, scl = sclScene(tmp_path)
+    mask = BandMask([band], (scl_path, 1), cache=band.cache)
+    try:
+        assert mask.window(Window(0, 0, 16, 16)) == (BLOCK_FULL, None)
+        assert mask.window(Window(16, 0, 16, 16)) == (BLOCK_EMPTY, None)
+        coverage, valid = mask.window(Window(0, 16, 32, 16))
+        assert coverage == BLOCK_PARTIAL
+        np.testing.assert_array_equal(valid, ~np.isin(scl[16:], SCL_MASKED_CLASSES))
+    finally:
+        mask.close()
+        band.close()
+
+def test_masks_are_reused_from_the_cache(tmp_path, monkeypatch):
+    band, scl_path, scl = sclScene(tmp_path)
+    first = BandMask([band], (scl_path, 1), cache=band.cache)
+    expected = first.window(Window(0, 16, 32, 16))
+    first.close()
+
+    def recompute(self, window):
+        raise AssertionError("the mask should come from the cache")
+
+    monkeypatch.setattr(BandMask, 'computeWindow', recompute)
+    second = BandMask([band], (scl_path, 1), cache=band.cache)
+    try:
+        coverage, valid = second.window(Window(0, 16, 32, 16))
+        assert coverage == expected[0]
+        np.testing.assert_array_equal(valid, expected[1])
+    finally:
+        second.close()
+        band.close()
+
+def test_nodata_values_need_no_mask(tmp_path):
+    band = TiledBand(writeRaster(tmp_path / 'band.tif', np.ones((16, 16), dtype=np.uint16), nodata=0),
+                     cache=BlockCache())
+    try:
+        assert openMask([band]) is None
+    finally:
+        band.close()
+
+def test_dataset_mask_band(tmp_path):
+    path = writeRaster(tmp_path / 'band.tif', np.ones((16, 16), dtype=np.uint16))
+    kept = np.zeros((16, 16), dtype=bool)
+    kept[:, :10] = True
+    with rasterio.open(path, 'r+') as dst:
+        dst.write_mask(kept)
+    band = TiledBand(path, cache=BlockCache())
+    mask = openMask([band], cache=band.cache)
+    try:
+        assert mask is not None
+        coverage, valid = mask.window(Window(0, 0, 16, 16))
+        assert coverage == BLOCK_PARTIAL
+        np.testing.assert_array_equal(valid, kept)
+    finally:
+        mask.close()
+        band.close()
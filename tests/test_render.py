@@ -0,0 +1,23 @@
+# Render graph sources
+
+import numpy as np
+
+from raster_analysis.render import ndviSource
+from raster_analysis.tiles import BlockCache, RasterPyramid, TiledBand
+
+from rasters import writeRaster
+
+def test_ndvi_source_applies_reflectance_offset(tmp_path):
+    cache = BlockCache()
+    red = TiledBand(writeRaster(tmp_path / 'red.tif', np.full((32, 32), 2000, dtype=np.uint16), nodata=0), cache=cache)
+    nir = TiledBand(writeRaster(tmp_path / 'nir.tif', np.full((32, 32), 4000, dtype=np.uint16), nodata=0), cache=cache)
+    try:
+        pyramids = RasterPyramid(red), RasterPyramid(nir)
+        raw_key, raw = ndviSource(*pyramids)
+        offset_key, offset = ndviSource(*pyramids, reflectance=(1e-4, -1000.0))
+        np.testing.assert_allclose(raw(0), 1 / 3, rtol=1e-6)
+        np.testing.assert_allclose(offset(0), 0.5, rtol=1e-6)
+        assert raw_key != offset_key
+    finally:
+        red.close()
+        nir.close()
@@ -0,0 +1,92 @@
+# Streaming band statistics: block merges, histogram rebinning and the sidecar cache
+
+import os
+
+import numpy as np
+import pytest
+
+from raster_analysis import stats as stats_module
+from raster_analysis.stats import BandStats, StatsCache, computeBandStats, rebinned
+
+from rasters import writeRaster
+
+def assertSameStats(merged, whole):
+    assert merged.count == whole.count
+    assert merged.nodata_count == whole.nodata_count
+    assert merged.mean == pytest.approx(whole.mean)
+    assert merged.variance == pytest.approx(whole.variance)
+    assert (merged.minimum, merged.maximum) == (whole.minimum, whole.maximum)
+
+def test_merge_of_exact_histograms_matches_one_pass():
+    rng = np.random.default_rng(1)
+    first = rng.integers(100, 200, (20, 30)).astype(np.uint16)
+    second = rng.integers(150, 400, (10, 30)).astype(np.uint16)
+    second[0, :5] = 0
+    merged = BandStats.fromBlock(first, nodata=0).merge(BandStats.fromBlock(second, nodata=0))
+    whole = BandStats.fromBlock(np.concatenate([first, second]), nodata=0)
+    assertSameStats(merged, whole)
+    assert merged.nodata_count == 5
+    assert merged.exact
+    np.testing.assert_array_equal(merged.counts, whole.counts)
+    assert merged.percentiles([2, 50, 98]) == whole.percentiles([2, 50, 98])
+
+def test_merge_with_empty_part_keeps_nodata_count():
+    part = BandStats.fromBlock(np.arange(1, 11, dtype=np.uint8))
+    merged = BandStats(nodata_count=7).merge(part)
+    assert merged.count == 10
+    assert merged.nodata_count == 7
+
+def test_merge_of_float_histograms_rebins_onto_common_range():
+    rng = np.random.default_rng(2)
+    first = rng.normal(0.2, 0.05, 5000).astype(np.float32)
+    second = rng.normal(0.6, 0.1, 5000).astype(np.float32)
+    second[:10] = np.nan
+    merged = BandStats.fromBlock(first).merge(BandStats.fromBlock(second))
+    whole = BandStats.fromBlock(np.concatenate([first, second]))
+    assertSameStats(merged, whole)
+    assert merged.nodata_count == 10
+    assert merged.counts.sum() == merged.count
+    assert (merged.low, merged.high) == (whole.low, whole.high)
+    bin_width = (whole.high - whole.low) / len(whole.counts)
+    for percentile, expected in zip(merged.percentiles([2, 50, 98]), whole.percentiles([2, 50, 98])):
+        assert percentile == pytest.approx(expected, abs=2 * bin_width)
+
+def test_rebinned_keeps_counts():
+    counts = np.array([1, 2, 3, 4], dtype=np.int64)
+    assert rebinned(counts, 0.0, 4.0, 0.0, 4.0, 4) is counts
+    moved = rebinned(counts, 0.0, 4.0, -4.0, 4.0, 4)
+    np.testing.assert_array_equal(moved, [0, 0, 3, 7])
+
+def test_compute_band_stats_over_blocks_and_workers(tmp_path):
+    data = np.arange(1, 50 * 70 + 1, dtype=np.uint16).reshape(50, 70) % 1000
+    path = writeRaster(tmp_path / 'band.tif', data, nodata=0)
+    stats = computeBandStats(path, workers=3)
+    valid = data[data != 0].astype(np.float64)
+    assert stats.count == valid.size
+    assert stats.nodata_count == data.size - valid.size
+    assert stats.mean == pytest.approx(valid.mean())
+    assert stats.std == pytest.approx(valid.std())
+    assert (stats.minimum, stats.maximum) == (valid.min(), valid.max())
+
+def test_sidecar_round_trip(tmp_path, monkeypatch):
+    data = np.arange(1, 33 * 33 + 1, dtype=np.uint16).reshape(33, 33)
+    path = writeRaster(tmp_path / 'band.tif', data)
+    computed = StatsCache().bandStats(path)
+
+    def recompute(*args, **kwargs):
+        raise AssertionError("statistics should come from the sidecar")
+
+    monkeypatch.setattr(stats_module, 'computeBandStats', recompute)
+    stored = StatsCache().bandStats(path)
+    assert vars(stored).keys() == vars(computed).keys()
+    for name, value in vars(computed).items():
+        np.testing.assert_array_equal(getattr(stored, name), value)
+
+def test_sidecar_of_rewritten_file_is_ignored(tmp_path):
+    path = writeRaster(tmp_path / 'band.tif', np.full((16, 16), 5, dtype=np.uint16))
+    assert StatsCache().bandStats(path).mean == 5
+    sidecar = StatsCache().sidecarPath(path)
+    writeRaster(tmp_path / 'band.tif', np.full((16, 16), 9, dtype=np.uint16))
+    os.utime(path, (0, 12345))
+    assert StatsCache().bandStats(path).mean == 9
+    assert os.path.exists(sidecar)
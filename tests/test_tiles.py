@@ -0,0 +1,84 @@
+# Lazy bands and the block cache their handles share
+
+import threading
+
+import numpy as np
+import pytest
+from rasterio.errors import RasterioIOError
+from rasterio.windows import Window
+
+from raster_analysis.tiles import BlockCache, RasterStack, TiledBand
+
+from rasters import writeRaster
+
+def cachedBlocks(cache, band_key):
+    return sum(1 for key in cache._blocks if key[0] == band_key)
+
+def test_read_assembles_blocks(tmp_path):
+    data = np.arange(40 * 50, dtype=np.uint16).reshape(40, 50)
+    band = TiledBand(writeRaster(tmp_path / 'band.tif', data), cache=BlockCache())
+    try:
+        np.testing.assert_array_equal(band.read(), data)
+        np.testing.assert_array_equal(band.read(Window(7, 13, 30, 20)), data[13:33, 7:37])
+    finally:
+        band.close()
+
+def test_closing_one_handle_keeps_shared_blocks(tmp_path):
+    path = writeRaster(tmp_path / 'band.tif', np.ones((64, 64), dtype=np.uint16))
+    cache = BlockCache()
+    displayed = TiledBand(path, cache=cache)
+    displayed.read()
+    assert cachedBlocks(cache, displayed.key) == 16
+
+    worker = TiledBand(path, cache=cache)
+    worker.read()
+    worker.close()
+    worker.close()
+    assert cachedBlocks(cache, displayed.key) == 16
+
+    displayed.close()
+    assert cachedBlocks(cache, displayed.key) == 0
+
+def stackData():
+    return np.arange(4 * 48 * 48, dtype=np.uint16).reshape(4, 48, 48)
+
+def test_stack_reads_released_bands_until_closed(tmp_path):
+    data = stackData()
+    stack = RasterStack(writeRaster(tmp_path / 'stack.tif', data), cache=BlockCache())
+    red, green = stack.band(1), stack.band(2)
+    green.close()
+    np.testing.assert_array_equal(red.read(), data[0])
+    np.testing.assert_array_equal(green.read(), data[1])
+    red.close()
+    assert stack.closed
+    with pytest.raises(RasterioIOError):
+        red.read()
+    with pytest.raises(RasterioIOError):
+        stack.band(3)
+
+def test_stack_bands_swapped_while_reading(tmp_path):
+    # The GUI thread swaps bands in and out while tile workers read blocks of the displayed one
+    data = stackData()
+    stack = RasterStack(writeRaster(tmp_path / 'stack.tif', data), cache=BlockCache())
+    displayed = stack.band(1)
+    errors = []
+    stop = threading.Event()
+
+    def render():
+        try:
+            while not stop.is_set():
+                np.testing.assert_array_equal(displayed.read(), data[0])
+                stack.cache.clear()
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=render) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for i in range(200):
+        stack.band(2 + i % 3).close()
+    stop.set()
+    for worker in workers:
+        worker.join()
+    displayed.close()
+    assert errors == []